@@ -19,11 +19,13 @@
 
 import collections
 import logging
+import random
 
 import dbus
 from dbus import SessionBus
 from dbus.mainloop.glib import DBusGMainLoop
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
 
 # yes, they can be imported! pylint: disable=F0401,E0611
 from ubuntuone.platform.tools import SyncDaemonTool, is_already_running
@@ -50,6 +52,15 @@ DBUSERR_PYKEYERROR = 'org.freedesktop.DBus.Python.KeyError'
 # some constants
 NOT_SYNCHED_PATH = "Not a valid path!"
 
+# the sides of the shares, and the one of each share type in the signals
+SHARES_TO_ME = 'to_me'
+SHARES_TO_OTHERS = 'to_others'
+SHARES_SIDES = (SHARES_TO_ME, SHARES_TO_OTHERS)
+SHARE_TYPE_SIDES = {
+    'Share': SHARES_TO_ME,
+    'Shared': SHARES_TO_OTHERS,
+}
+
 
 class ShareOperationError(Exception):
     """Error on an operation on a share."""
@@ -59,6 +70,27 @@ class ShareOperationError(Exception):
         super(ShareOperationError, self).__init__(error)
 
 
+class UnresponsiveError(Exception):
+    """Syncdaemon is not answering."""
+
+
+class CallTimeoutError(UnresponsiveError):
+    """A call to syncdaemon didn't finish in time."""
+    def __init__(self, method, timeout):
+        self.method = method
+        self.timeout = timeout
+        super(CallTimeoutError, self).__init__(
+            "%s didn't finish in %s seconds" % (method, timeout))
+
+
+class CircuitOpenError(UnresponsiveError):
+    """A call was not done, as syncdaemon is not answering lately."""
+    def __init__(self, method):
+        self.method = method
+        super(CircuitOpenError, self).__init__(
+            "%s not called, syncdaemon is not answering" % (method,))
+
+
 class FolderOperationError(Exception):
     """Error on an operation on a folder.
 
@@ -80,24 +112,456 @@ def _is_retry_exception(err):
     return False
 
 
-def retryable(func):
-    """Call the function until its deferred succeed (max 5 times)."""
+class RetryPolicy(object):
+    """How a call is retried when syncdaemon doesn't answer.
+
+    The call is done up to 'attempts' times, waiting 'delay' seconds before
+    the first retry and 'backoff' times more before each next one, up to
+    'max_delay', everything randomly moved up to 'jitter' (a fraction).
+    """
+
+    def __init__(self, attempts=10, delay=.1, max_delay=5, backoff=2,
+                 jitter=.1):
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+
+    def get_delay(self, retry):
+        """Return the seconds to wait before a retry (the first is 0)."""
+        delay = min(self.delay * self.backoff ** retry, self.max_delay)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class RetryBudget(object):
+    """Retries that all the calls can do, recovered as time passes.
+
+    There are up to 'size' retries available, and one more is available
+    each 1 / 'rate' seconds.
+    """
+
+    def __init__(self, size, rate):
+        self.size = size
+        self.rate = rate
+        self._available = size
+        self._last = None
+
+    def spend(self):
+        """Spend a retry, return if there was one available."""
+        now = reactor.seconds()
+        if self._last is not None:
+            self._available = min(self.size, self._available +
+                                  (now - self._last) * self.rate)
+        self._last = now
+        if self._available < 1:
+            return False
+        self._available -= 1
+        return True
+
+
+# policies for the calls that the user is waiting for, for the ones that
+# can wait, and for the rest
+DEFAULT_RETRY_POLICY = RetryPolicy()
+HOT_RETRY_POLICY = RetryPolicy(attempts=5, delay=.05, max_delay=.5)
+BACKGROUND_RETRY_POLICY = RetryPolicy(attempts=10, delay=1, max_delay=30)
+
+# the retries of all the calls, and how many were done, denied by the
+# budget or exhausted by the policy, for each method
+retry_budget = RetryBudget(size=20, rate=1)
+retry_stats = collections.defaultdict(collections.Counter)
+
+
+def retryable(func=None, policy=None):
+    """Call the function until its deferred succeed, following a policy.
+
+    Use it directly, with the default policy, or giving the policy:
+
+        @retryable(policy=HOT_RETRY_POLICY)
+    """
+    if func is None:
+        return lambda func: retryable(func, policy)
+    name = func.__name__
 
     @defer.inlineCallbacks
     def f(*a, **k):
         """Built func."""
-        opportunities = 10
-        while opportunities:
+        pol = DEFAULT_RETRY_POLICY if policy is None else policy
+        stats = retry_stats[name]
+        retry = 0
+        while True:
             try:
                 res = yield func(*a, **k)
             except Exception, err:  # pylint: disable=W0703
-                opportunities -= 1
-                if opportunities == 0 or not _is_retry_exception(err):
+                if not _is_retry_exception(err):
                     raise
+                if retry + 1 >= pol.attempts:
+                    stats['exhausted'] += 1
+                    raise
+                if not retry_budget.spend():
+                    stats['denied'] += 1
+                    logger.warning("No retries left for %s", name)
+                    raise
+                stats['retried'] += 1
+                delay = pol.get_delay(retry)
+                logger.debug("Retrying %s in %.3f seconds", name, delay)
+                yield task.deferLater(reactor, delay, lambda: None)
+                retry += 1
             else:
                 break
         defer.returnValue(res)
 
+    f.__name__ = name
+    f.__doc__ = func.__doc__
+    return f
+
+
+# seconds to wait for each call to finish, by method, before cancelling it
+DEFAULT_CALL_TIMEOUT = 30
+CALL_TIMEOUTS = {
+    'get_status': 10,
+    'get_metadata': 10,
+    'get_public_files': 60,
+    'start': 60,
+    '_probe_status': 10,
+}
+
+# how many calls timed out, for each method
+timeout_stats = collections.Counter()
+
+
+def with_deadline(func):
+    """Cancel the call if it doesn't finish in time.
+
+    The call then fails with CallTimeoutError. The time for each method is
+    in the DBusInterface's call_timeouts, or DEFAULT_CALL_TIMEOUT.
+    """
+    name = func.__name__
+
+    def f(self, *args):
+        """Built func."""
+        timeout = self.call_timeouts.get(name, DEFAULT_CALL_TIMEOUT)
+        d = defer.maybeDeferred(func, self, *args)
+        if d.called or not timeout:
+            return d
+
+        timed_out = []
+
+        def expire():
+            """The time is over."""
+            timed_out.append(True)
+            d.cancel()
+
+        def finish(result):
+            """The call finished, by itself or cancelled."""
+            if call.active():
+                call.cancel()
+            if timed_out:
+                timeout_stats[name] += 1
+                logger.warning("Call to %s timed out after %s seconds",
+                               name, timeout)
+                raise CallTimeoutError(name, timeout)
+            return result
+
+        call = reactor.callLater(timeout, expire)
+        d.addBoth(finish)
+        return d
+
+    f.__name__ = name
+    f.__doc__ = func.__doc__
+    return f
+
+
+# priority classes of the calls: the interactive ones go before anything
+# else, and the background ones after everything else
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# priority of the calls, by the scheduled method (the helpers that do the
+# actual call for the share and folder operations, and for the public
+# files); the ones not here are normal
+CALL_PRIORITIES = {
+    'start': PRIORITY_INTERACTIVE,
+    'quit': PRIORITY_INTERACTIVE,
+    'connect': PRIORITY_INTERACTIVE,
+    'disconnect': PRIORITY_INTERACTIVE,
+    'get_metadata': PRIORITY_INTERACTIVE,
+    'get_free_space': PRIORITY_INTERACTIVE,
+    '_answer_share': PRIORITY_INTERACTIVE,
+    'send_share_invitation': PRIORITY_INTERACTIVE,
+    '_folder_operation': PRIORITY_INTERACTIVE,
+    'change_public_access': PRIORITY_INTERACTIVE,
+    'get_current_downloads': PRIORITY_BACKGROUND,
+    'get_current_uploads': PRIORITY_BACKGROUND,
+    '_ask_public_files': PRIORITY_BACKGROUND,
+}
+
+# how many calls can be running at the same time, and how many of them
+# only for the interactive calls
+MAX_CALLS_IN_FLIGHT = 4
+INTERACTIVE_CALLS_RESERVED = 1
+
+
+class CallScheduler(object):
+    """Do the calls by priority, with a limit of calls at the same time.
+
+    The calls wait in a queue for each priority class, and the ones of the
+    highest class go first. Inside a class each method has its own queue,
+    and they take turns, so a burst of one method doesn't make the others
+    wait behind all of it.
+
+    The last 'reserved' slots are only for the interactive calls, so they
+    don't wait behind the rest if those get stuck. The room made by a call
+    that finished is used in the next reactor iteration, after the other
+    calls that expire at the same time are out of the queues.
+    """
+
+    def __init__(self, max_in_flight, reserved=0):
+        self.max_in_flight = max_in_flight
+        self.reserved = reserved
+        self.in_flight = 0
+        self._queues = collections.defaultdict(collections.OrderedDict)
+        self._dispatch_call = None
+
+    def run(self, priority, name, func, *args):
+        """Do the call when its turn arrives; return its deferred.
+
+        Cancelling the deferred takes the call out of its queue, or
+        cancels it if already running.
+        """
+        running = []
+
+        def cancel(_):
+            """Cancel the call, wherever it is."""
+            if running:
+                running[0].cancel()
+            else:
+                self._remove(priority, name, call)
+
+        d = defer.Deferred(cancel)
+        call = (d, func, args, running)
+        queues = self._queues[priority]
+        queues.setdefault(name, collections.deque()).append(call)
+        self._dispatch()
+        return d
+
+    def _remove(self, priority, name, call):
+        """Take a call out of its queue."""
+        queues = self._queues[priority]
+        queue = queues[name]
+        queue.remove(call)
+        if not queue:
+            del queues[name]
+
+    def _next(self):
+        """Return the next call to do, if any."""
+        shared_full = self.in_flight >= self.max_in_flight - self.reserved
+        for priority in sorted(self._queues):
+            if shared_full and priority != PRIORITY_INTERACTIVE:
+                break
+            queues = self._queues[priority]
+            if queues:
+                name, queue = queues.popitem(last=False)
+                call = queue.popleft()
+                if queue:
+                    # its turn is done, to the end of the line
+                    queues[name] = queue
+                return call
+
+    def _dispatch(self):
+        """Start the next calls, while there is room for them."""
+        self._dispatch_call = None
+        while self.in_flight < self.max_in_flight:
+            call = self._next()
+            if call is None:
+                break
+            d, func, args, running = call
+            self.in_flight += 1
+            inner = defer.maybeDeferred(func, *args)
+            running.append(inner)
+            inner.addBoth(self._finished, d)
+
+    def _finished(self, result, d):
+        """A call finished, answer it and make room for the next one."""
+        self.in_flight -= 1
+        if not d.called:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        waiting = any(self._queues.itervalues())
+        if waiting and self._dispatch_call is None:
+            self._dispatch_call = reactor.callLater(0, self._dispatch)
+
+
+def scheduled(func):
+    """Do the call through the DBusInterface's scheduler.
+
+    The priority of each method is in the DBusInterface's call_priorities,
+    or PRIORITY_NORMAL.
+
+    Put it under retryable, so each attempt takes a slot only while it's
+    running, and the slots are free while waiting to retry.
+    """
+    name = func.__name__
+
+    def f(self, *args):
+        """Built func."""
+        priority = self.call_priorities.get(name, PRIORITY_NORMAL)
+        return self.scheduler.run(priority, name, func, self, *args)
+
+    f.__name__ = name
+    f.__doc__ = func.__doc__
+    return f
+
+
+# states of the circuit breaker: closed while syncdaemon answers, open when
+# it stopped answering, and half open while checking if it answers again
+CIRCUIT_CLOSED = u"CLOSED"
+CIRCUIT_OPEN = u"OPEN"
+CIRCUIT_HALF_OPEN = u"HALF_OPEN"
+
+# calls in a row without answer to open the circuit, and seconds to wait
+# before checking if syncdaemon answers again
+CIRCUIT_MAX_FAILURES = 5
+CIRCUIT_RESET_TIMEOUT = 10
+
+
+class CircuitBreaker(object):
+    """Stop calling syncdaemon while it doesn't answer.
+
+    After 'max_failures' calls in a row without answer the circuit opens,
+    and the calls fail right away. 'reset_timeout' seconds later it's half
+    open, and 'probe' is called: if it succeeds the circuit is closed
+    again, else it opens for another while. The callback is called with
+    each new state.
+    """
+
+    def __init__(self, max_failures, reset_timeout, probe, callback):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.callback = callback
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self._call = None
+
+    def _set_state(self, state):
+        """Change the state, and let know."""
+        if state != self.state:
+            logger.warning("Circuit to syncdaemon is now %s", state)
+            self.state = state
+            self.callback(state)
+
+    def succeeded(self):
+        """A call got an answer."""
+        self.failures = 0
+        if self.state != CIRCUIT_CLOSED:
+            self.stop()
+            self._set_state(CIRCUIT_CLOSED)
+
+    def failed(self):
+        """A call didn't get an answer."""
+        self.failures += 1
+        if (self.state == CIRCUIT_CLOSED and
+                self.failures >= self.max_failures):
+            self._open()
+
+    def _open(self):
+        """Open the circuit, and check later if it can be closed."""
+        self._set_state(CIRCUIT_OPEN)
+        self._call = reactor.callLater(self.reset_timeout, self._probe)
+
+    def _probe(self):
+        """Check if syncdaemon answers again."""
+        self._call = None
+        self._set_state(CIRCUIT_HALF_OPEN)
+        d = defer.maybeDeferred(self.probe)
+        d.addCallbacks(lambda _: self.succeeded(), lambda _: self._open())
+
+    def stop(self):
+        """Stop waiting to check syncdaemon."""
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+
+def _is_unanswered(failure):
+    """Tell if the failure means that syncdaemon didn't answer."""
+    return (failure.check(CallTimeoutError) is not None or
+            _is_retry_exception(failure.value))
+
+
+def guarded(func):
+    """Do the call only if the circuit breaker is closed.
+
+    Otherwise fail it right away with CircuitOpenError. The result of the
+    call tells the circuit breaker if syncdaemon answered.
+    """
+    name = func.__name__
+
+    def f(self, *args):
+        """Built func."""
+        circuit = self.circuit
+        if circuit.state != CIRCUIT_CLOSED:
+            return defer.fail(CircuitOpenError(name))
+
+        def check(result):
+            """Let the circuit breaker know how the call went."""
+            if isinstance(result, Failure) and _is_unanswered(result):
+                circuit.failed()
+            else:
+                circuit.succeeded()
+            return result
+
+        d = defer.maybeDeferred(func, self, *args)
+        d.addBoth(check)
+        return d
+
+    f.__name__ = name
+    f.__doc__ = func.__doc__
+    return f
+
+
+# how many calls shared the result of one already running ('hit'), or
+# had to do their own ('miss'), for each method
+single_flight_stats = collections.defaultdict(collections.Counter)
+
+
+def single_flight(func):
+    """Share the result of a call with the same ones done while it runs.
+
+    Concurrent calls with the same arguments get each their own deferred,
+    fired with the result of the first call, instead of asking syncdaemon
+    again.
+    """
+    name = func.__name__
+
+    def f(self, *args):
+        """Built func."""
+        key = (name,) + args
+        stats = single_flight_stats[name]
+        d = defer.Deferred()
+        waiting = self._in_flight.get(key)
+        if waiting is not None:
+            stats['hit'] += 1
+            waiting.append(d)
+            return d
+
+        stats['miss'] += 1
+        self._in_flight[key] = [d]
+
+        def done(result):
+            """Give the result to all the callers."""
+            for caller in self._in_flight.pop(key):
+                caller.callback(result)
+
+        defer.maybeDeferred(func, self, *args).addBoth(done)
+        return d
+
+    f.__name__ = name
+    f.__doc__ = func.__doc__
     return f
 
 
@@ -110,6 +574,22 @@ class DBusInterface(object):
         logger.info("DBus interface starting")
         self._public_files_deferred = None
 
+        # the callers waiting for each read call that is running, and the
+        # seconds that each call can take
+        self._in_flight = {}
+        self.call_timeouts = dict(CALL_TIMEOUTS)
+
+        # all the calls wait their turn, by priority
+        self.call_priorities = dict(CALL_PRIORITIES)
+        self.scheduler = CallScheduler(MAX_CALLS_IN_FLIGHT,
+                                       INTERACTIVE_CALLS_RESERVED)
+
+        # stop calling syncdaemon while it doesn't answer
+        self.circuit = CircuitBreaker(CIRCUIT_MAX_FAILURES,
+                                      CIRCUIT_RESET_TIMEOUT,
+                                      self._probe_status,
+                                      self.msd.on_sd_circuit_changed)
+
         # set up dbus and related stuff
         loop = DBusGMainLoop(set_as_default=True)
         self._bus = bus = SessionBus(mainloop=loop)
@@ -147,6 +627,8 @@ class DBusInterface(object):
         """Shut down the SyncDaemon."""
         logger.info("DBus interface going down")
 
+        self.circuit.stop()
+
         # remove the signals from DBus
         remove = self._bus.remove_signal_receiver
         for match, dbus_interface, signal in self._dbus_matches:
@@ -164,7 +646,11 @@ class DBusInterface(object):
         return (name, description, is_error, is_connected,
                 is_online, queues, connection)
 
-    @retryable
+    @single_flight
+    @guarded
+    @with_deadline
+    @retryable(policy=HOT_RETRY_POLICY)
+    @scheduled
     def get_status(self):
         """Get SD status."""
         logger.info("Getting status")
@@ -172,7 +658,17 @@ class DBusInterface(object):
         d.addCallback(self._process_status)
         return d
 
+    @with_deadline
+    @scheduled
+    def _probe_status(self):
+        """Ask for the status once, to see if SD answers."""
+        logger.info("Checking if SD answers")
+        return self.sync_daemon_tool.get_status()
+
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def get_free_space(self, volume_id):
         """Get the free space for a volume."""
@@ -180,7 +676,10 @@ class DBusInterface(object):
         logger.info("Free space for volume %r is %r", volume_id, result)
         defer.returnValue(result)
 
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def get_real_shares_dir(self):
         """Get the real directory for the shares."""
@@ -188,7 +687,10 @@ class DBusInterface(object):
         logger.info("Real shares dir: %r", result)
         defer.returnValue(result)
 
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def get_link_shares_dir(self):
         """Get the link directory for the shares."""
@@ -202,7 +704,10 @@ class DBusInterface(object):
              for t in transfers if 'deflated_size' in t]
         return r
 
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def get_current_downloads(self):
         """Get the current_downloads."""
@@ -211,7 +716,10 @@ class DBusInterface(object):
         logger.info("Get current downloads: %d items", len(processed))
         defer.returnValue(processed)
 
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def get_current_uploads(self):
         """Get the current_uploads."""
@@ -253,40 +761,61 @@ class DBusInterface(object):
                           int(op_data['deflated_size']))
         self.msd.on_sd_download_progress(transf)
 
-    def _on_folder_created(self, _):
+    def _send_folder(self, data, callback):
+        """Send the folder in the signal, or all of them changed if can't."""
+        try:
+            folder = self._get_folder_data(data)
+        except (KeyError, TypeError):
+            logger.warning("Bad folder data in signal: %r", data)
+            self.msd.on_sd_folders_changed()
+        else:
+            callback(folder)
+
+    def _on_folder_created(self, data):
         """Call the SD callback."""
         logger.info("Received Folder created")
-        self.msd.on_sd_folders_changed()
+        self._send_folder(data, self.msd.on_sd_folder_changed)
 
-    def _on_folder_deleted(self, _):
+    def _on_folder_deleted(self, data):
         """Call the SD callback."""
         logger.info("Received Folder deleted")
-        self.msd.on_sd_folders_changed()
+        self._send_folder(data, self.msd.on_sd_folder_deleted)
 
-    def _on_folder_subscribed(self, _):
+    def _on_folder_subscribed(self, data):
         """Call the SD callback."""
         logger.info("Received Folder subscribed")
-        self.msd.on_sd_folders_changed()
+        self._send_folder(data, self.msd.on_sd_folder_changed)
 
-    def _on_folder_unsubscribed(self, _):
+    def _on_folder_unsubscribed(self, data):
         """Call the SD callback."""
         logger.info("Received Folder unsubscribed")
-        self.msd.on_sd_folders_changed()
+        self._send_folder(data, self.msd.on_sd_folder_changed)
+
+    def _send_share(self, data, deleted=False):
+        """Send the share in the signal, or all of them changed if can't."""
+        try:
+            side = SHARE_TYPE_SIDES[data['type']]
+            (share,) = self._process_share_info([data])
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Bad share data in signal: %r", data)
+            self.msd.on_sd_shares_changed()
+        else:
+            self.msd.on_sd_share_changed(share, side, deleted)
 
-    def _on_share_created(self, _):
+    def _on_share_created(self, data):
         """Call the SD callback."""
         logger.info("Received Share created")
-        self.msd.on_sd_shares_changed()
+        self._send_share(data)
 
-    def _on_share_deleted(self, _):
+    def _on_share_deleted(self, data):
         """Call the SD callback."""
         logger.info("Received Share deleted")
-        self.msd.on_sd_shares_changed()
+        self._send_share(data, deleted=True)
 
-    def _on_share_changed(self, _):
+    def _on_share_changed(self, data):
         """Call the SD callback."""
         logger.info("Received Share changed")
-        self.msd.on_sd_shares_changed()
+        self._send_share(data)
 
     def _on_public_files_changed(self, data):
         """Call the SD callback."""
@@ -308,11 +837,14 @@ class DBusInterface(object):
 
         return processed
 
+    @single_flight
+    @guarded
+    @with_deadline
     @defer.inlineCallbacks
     def get_public_files(self):
         """Ask the Public Files info to syncdaemon."""
         try:
-            result = yield self.sync_daemon_tool.get_public_files()
+            result = yield self._ask_public_files()
             logger.debug("Public files asked ok.")
         except AttributeError:
             logger.warning('Method sdtool.get_public_files is not available, '
@@ -324,6 +856,12 @@ class DBusInterface(object):
 
         defer.returnValue(self._on_public_files_list(result))
 
+    @retryable(policy=BACKGROUND_RETRY_POLICY)
+    @scheduled
+    def _ask_public_files(self):
+        """Ask the Public Files info to SDT."""
+        return self.sync_daemon_tool.get_public_files()
+
     def get_public_files_old(self):
         """Ask the Public Files info to syncdaemon (old approach)."""
         # yes, they can be imported! pylint: disable=F0401,E0611,W0404
@@ -353,13 +891,21 @@ class DBusInterface(object):
                            error_handler=call_error)
         return d
 
+    @single_flight
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     def get_queue_content(self):
         """Get the queue content from SDT."""
         logger.info("Getting queue content")
         return self.sync_daemon_tool.waiting()
 
+    @single_flight
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     def get_folders(self):
         """Get the folders info from SDT."""
 
@@ -378,21 +924,31 @@ class DBusInterface(object):
         d.addCallback(process)
         return d
 
+    @with_deadline
+    @scheduled
     def start(self):
         """Start SDT."""
         logger.info("Calling start")
         return self.sync_daemon_tool.start()
 
+    @with_deadline
+    @scheduled
     def quit(self):
         """Stop SDT."""
         logger.info("Calling quit")
         return self.sync_daemon_tool.quit()
 
+    @guarded
+    @with_deadline
+    @scheduled
     def connect(self):
         """Connect SDT."""
         logger.info("Calling connect")
         return self.sync_daemon_tool.connect()
 
+    @guarded
+    @with_deadline
+    @scheduled
     def disconnect(self):
         """Disconnect SDT."""
         logger.info("Calling disconnect")
@@ -430,7 +986,11 @@ class DBusInterface(object):
             all_items.append(s)
         return all_items
 
+    @single_flight
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     def get_shares_to_me(self):
         """Get the shares to me ('shares') info from SDT."""
 
@@ -444,7 +1004,11 @@ class DBusInterface(object):
         d.addCallback(process)
         return d
 
+    @single_flight
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     def get_shares_to_others(self):
         """Get the shares to others ('shared') info from SDT."""
 
@@ -458,7 +1022,10 @@ class DBusInterface(object):
         d.addCallback(process)
         return d
 
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     def get_metadata(self, path):
         """Return the raw metadata."""
         logger.info("Getting metadata for %r", path)
@@ -480,6 +1047,7 @@ class DBusInterface(object):
         return d
 
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def _answer_share(self, share_id, method, action_name):
         """Effectively accept or reject a share."""
@@ -499,27 +1067,38 @@ class DBusInterface(object):
         if 'error' in result:
             raise ShareOperationError(share_id=share_id, error=result['error'])
 
+    @guarded
+    @with_deadline
     def accept_share(self, share_id):
         """Accept a share."""
         return self._answer_share(share_id,
                                   self.sync_daemon_tool.accept_share, "Accept")
 
+    @guarded
+    @with_deadline
     def reject_share(self, share_id):
         """Reject a share."""
         return self._answer_share(share_id,
                                   self.sync_daemon_tool.reject_share, "Reject")
 
+    @guarded
+    @with_deadline
     def subscribe_share(self, share_id):
         """Subscribe a share."""
         args = share_id, self.sync_daemon_tool.subscribe_share, "Subscribe"
         return self._answer_share(*args)
 
+    @guarded
+    @with_deadline
     def unsubscribe_share(self, share_id):
         """Unsubscribe a share."""
         args = share_id, self.sync_daemon_tool.unsubscribe_share, "Unsubscribe"
         return self._answer_share(*args)
 
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def send_share_invitation(self, path, mail_address,
                               share_name, access_level):
@@ -549,6 +1128,7 @@ class DBusInterface(object):
         return f
 
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def _folder_operation(self, act_name, action, val_name, value):
         """Generic folder operation."""
@@ -569,30 +1149,41 @@ class DBusInterface(object):
             folder = self._get_folder_data(result)
             defer.returnValue(folder)
 
+    @guarded
+    @with_deadline
     def create_folder(self, path):
         """Create a folder."""
         args = 'Create', self.sync_daemon_tool.create_folder, 'path', path
         return self._folder_operation(*args)
 
+    @guarded
+    @with_deadline
     def delete_folder(self, volume_id):
         """Delete a folder."""
         args = ('Delete', self.sync_daemon_tool.delete_folder,
                 'volume_id', volume_id)
         return self._folder_operation(*args)
 
+    @guarded
+    @with_deadline
     def subscribe_folder(self, volume_id):
         """Subscribe a folder."""
         args = ('Subscribe', self.sync_daemon_tool.subscribe_folder,
                 'volume_id', volume_id)
         return self._folder_operation(*args)
 
+    @guarded
+    @with_deadline
     def unsubscribe_folder(self, volume_id):
         """Unsubscribe a folder."""
         args = ('Unsubscribe', self.sync_daemon_tool.unsubscribe_folder,
                 'volume_id', volume_id)
         return self._folder_operation(*args)
 
+    @guarded
+    @with_deadline
     @retryable
+    @scheduled
     @defer.inlineCallbacks
     def change_public_access(self, path, is_public):
         """Make a file public or not."""
@@ -171,6 +171,10 @@ class MagicicadaUI(Buildable):
         self.sd.on_initial_data_ready_callback = self.on_initial_data_ready
         self.sd.on_initial_online_data_ready_callback = \
             self.on_initial_online_data_ready
+        self.sd.on_status_ready_callback = self.on_status_ready
+        self.sd.on_queue_ready_callback = self.on_queue_ready
+        self.sd.on_folders_ready_callback = self.on_folders_ready
+        self.sd.on_shares_ready_callback = self.on_shares_ready
 
     def destroy(self, *a, **kw):
         """Destroy all widgets."""
@@ -213,11 +217,30 @@ class MagicicadaUI(Buildable):
         else:
             self.indicator.set_icon('alert')
 
+    @log(logger, level=logging.INFO)
+    def on_status_ready(self):
+        """Initial status is now available in syncdaemon."""
+        self.status.on_status_ready()
+
+    @log(logger, level=logging.INFO)
+    def on_queue_ready(self):
+        """Initial queue content is now available in syncdaemon."""
+        self.operations.load()
+
+    @log(logger, level=logging.INFO)
+    def on_folders_ready(self):
+        """Initial folders are now available in syncdaemon."""
+        self.status.on_folders_ready()
+
+    @log(logger, level=logging.INFO)
+    def on_shares_ready(self):
+        """Initial shares are now available in syncdaemon."""
+        self.status.on_shares_ready()
+
     @log(logger, level=logging.INFO)
     def on_initial_data_ready(self):
         """Initial data is now available in syncdaemon."""
         self.status.on_initial_data_ready()
-        self.operations.load()
 
     @log(logger, level=logging.INFO)
     def on_initial_online_data_ready(self):
@@ -55,6 +55,7 @@ STARTING = _(u'Starting')
 STOP = _(u'Stop')
 STOPPED = _(u'Not running')
 STOPPING = _(u'Stopping')
+UNRESPONSIVE = _(u'Not answering')
 WORKING = _(u'Working')
 
 logger = logging.getLogger('magicicada.gui.gtk.status')
@@ -103,12 +104,12 @@ class MetadataDialog(Buildable):
         self.filetype_image.set_from_stock(icon, Gtk.IconSize.MENU)
 
         # set the data in the elements
-        if data == NOT_SYNCHED_PATH:
-            # metadata path doesn't exist for syncdaemon, show crude path,
-            # error message, and quit
+        if data in (NOT_SYNCHED_PATH, syncdaemon.METADATA_UNAVAILABLE):
+            # metadata path doesn't exist for syncdaemon, or it didn't
+            # answer: show crude path, error message, and quit
             self.path_label.set_text(path)
             self.filepath_hbox.show()
-            self.basic_info_label.set_text(NOT_SYNCHED_PATH)
+            self.basic_info_label.set_text(data)
             self.basic_info_label.show()
             return
 
@@ -176,6 +177,7 @@ class Status(Buildable, Gtk.Alignment):
         else:
             self.sd = syncdaemon.SyncDaemon()
         self.sd.on_metadata_ready_callback = self.on_metadata_ready
+        self.sd.on_circuit_changed_callback = self.on_circuit_changed
 
         self._sd_actions = {
             CONNECT: (self.sd.connect, DISCONNECT),
@@ -186,15 +188,20 @@ class Status(Buildable, Gtk.Alignment):
         self._metadata_dialogs = {}
         self._status_images = build_icon_dict(48)
 
-        folders = FoldersButton(syncdaemon_instance=self.sd)
-        shares_to_me = SharesToMeButton(syncdaemon_instance=self.sd)
-        shares_to_others = SharesToOthersButton(syncdaemon_instance=self.sd)
+        self.folders = FoldersButton(syncdaemon_instance=self.sd)
+        self.shares_to_me = SharesToMeButton(syncdaemon_instance=self.sd)
+        self.shares_to_others = SharesToOthersButton(
+            syncdaemon_instance=self.sd)
         self.public_files = PublicFilesButton(syncdaemon_instance=self.sd)
 
-        buttons = (folders, shares_to_me, shares_to_others, self.public_files)
+        buttons = (self.folders, self.shares_to_me, self.shares_to_others,
+                   self.public_files)
         for button in buttons:
             self.toolbar.insert(button, -1)
-        self.toolbar.set_sensitive(False)
+
+        # each button is enabled when its data is ready
+        for n_button in xrange(self.toolbar.get_n_items()):
+            self.toolbar.get_nth_item(n_button).set_sensitive(False)
 
         self.action_button.set_use_stock(True)
 
@@ -247,11 +254,40 @@ class Status(Buildable, Gtk.Alignment):
 
     # SyncDaemon callbacks
 
+    @log(logger, level=logging.INFO)
+    def on_status_ready(self):
+        """Initial status is now available in syncdaemon."""
+        self.metadata.set_sensitive(True)
+
+    @log(logger, level=logging.INFO)
+    def on_folders_ready(self):
+        """Initial folders are now available in syncdaemon."""
+        self.folders.set_sensitive(True)
+
+    @log(logger, level=logging.INFO)
+    def on_shares_ready(self):
+        """Initial shares are now available in syncdaemon."""
+        self.shares_to_me.set_sensitive(True)
+        self.shares_to_others.set_sensitive(True)
+
     @log(logger, level=logging.INFO)
     def on_initial_data_ready(self):
-        """Initial data is now available in syncdaemon."""
-        self.toolbar.set_sensitive(True)
-        self.public_files.set_sensitive(False)
+        """Initial data is now available in syncdaemon.
+
+        The buttons of the datasets that syncdaemon didn't answer are left
+        disabled, they are enabled when each one gets ready.
+        """
+        datasets = {
+            self.metadata: 'status',
+            self.folders: 'folders',
+            self.shares_to_me: 'shares',
+            self.shares_to_others: 'shares',
+        }
+        unavailable = self.sd.initial_data_unavailable
+        for n_button in xrange(self.toolbar.get_n_items()):
+            button = self.toolbar.get_nth_item(n_button)
+            button.set_sensitive(button is not self.public_files and
+                                 datasets.get(button) not in unavailable)
 
     @log(logger, level=logging.INFO)
     def on_initial_online_data_ready(self):
@@ -269,6 +305,11 @@ class Status(Buildable, Gtk.Alignment):
         dialog = self._metadata_dialogs[path]
         dialog.got_metadata(path, metadata)
 
+    @log(logger, level=logging.INFO)
+    def on_circuit_changed(self, circuit):
+        """Syncdaemon stopped or started answering."""
+        self.update()
+
     def update(self, *args, **kwargs):
         """Update UI based on SD current state."""
         current_state = self.sd.current_state
@@ -276,7 +317,11 @@ class Status(Buildable, Gtk.Alignment):
 
         state = current_state.state
         status, next_action = ACTION_MAP[state]
-        if state == syncdaemon.STATE_IDLE:
+        if current_state.circuit != syncdaemon.CIRCUIT_CLOSED:
+            # syncdaemon is not answering, whatever its last state was
+            status = UNRESPONSIVE
+            self.status_image.set_from_pixbuf(self._status_images['alert'])
+        elif state == syncdaemon.STATE_IDLE:
             self.status_image.set_from_pixbuf(self._status_images['idle'])
         elif state in (syncdaemon.STATE_CONNECTING, syncdaemon.STATE_STARTING,
                        syncdaemon.STATE_WORKING):
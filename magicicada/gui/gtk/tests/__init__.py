@@ -132,16 +132,22 @@ class FakedSyncdaemon(Recorder):
     no_wrap = [
         '_called', '_next_id', '_meta_paths',
         'current_state',
+        'initial_data_unavailable',
+        'on_circuit_changed_callback',
         'on_connected_callback',
         'on_disconnected_callback',
         'on_folder_op_error_callback',
+        'on_folders_ready_callback',
         'on_initial_data_ready_callback',
         'on_initial_online_data_ready_callback',
         'on_metadata_ready_callback',
         'on_node_ops_changed_callback',
         'on_offline_callback',
         'on_online_callback',
+        'on_queue_ready_callback',
+        'on_shares_ready_callback',
         'on_started_callback',
+        'on_status_ready_callback',
         'on_stopped_callback',
         'queue_content',
         'status_changed_callback',
@@ -153,6 +159,7 @@ class FakedSyncdaemon(Recorder):
         self._meta_paths = []
 
         self.current_state = syncdaemon.State()
+        self.initial_data_unavailable = set()
         self.queue_content = FakedQueueContent()
 
         self.on_started_callback = NO_OP
@@ -166,7 +173,12 @@ class FakedSyncdaemon(Recorder):
         self.on_metadata_ready_callback = None  # mandatory
         self.on_initial_data_ready_callback = NO_OP
         self.on_initial_online_data_ready_callback = NO_OP
+        self.on_status_ready_callback = NO_OP
+        self.on_queue_ready_callback = NO_OP
+        self.on_folders_ready_callback = NO_OP
+        self.on_shares_ready_callback = NO_OP
         self.on_folder_op_error_callback = NO_OP
+        self.on_circuit_changed_callback = NO_OP
 
         self.shutdown = NO_OP
 
@@ -112,11 +112,43 @@ class MagicicadaUITestCase(BaseTestCase):
 
         self.assertEqual(self._called, ((), {}))
 
-    def test_on_initial_data_ready_updates_operations_widget(self):
-        """On initial data ready, the status widget is updated."""
+    def test_ready_callbacks_connected(self):
+        """The callbacks of each initial dataset are connected to SD."""
+        for name in ('status', 'queue', 'folders', 'shares'):
+            callback = 'on_%s_ready' % name
+            self.assertEqual(getattr(self.ui.sd, callback + '_callback'),
+                             getattr(self.ui, callback),
+                             "%s should be connected." % callback)
+
+    def test_on_queue_ready_updates_operations_widget(self):
+        """On queue ready, the operations widget is updated."""
         self.patch(self.ui.operations, 'load', self._set_called)
 
-        self.ui.on_initial_data_ready()
+        self.ui.on_queue_ready()
+
+        self.assertEqual(self._called, ((), {}))
+
+    def test_on_status_ready_updates_status_widget(self):
+        """On status ready, the status widget is updated."""
+        self.patch(self.ui.status, 'on_status_ready', self._set_called)
+
+        self.ui.on_status_ready()
+
+        self.assertEqual(self._called, ((), {}))
+
+    def test_on_folders_ready_updates_status_widget(self):
+        """On folders ready, the status widget is updated."""
+        self.patch(self.ui.status, 'on_folders_ready', self._set_called)
+
+        self.ui.on_folders_ready()
+
+        self.assertEqual(self._called, ((), {}))
+
+    def test_on_shares_ready_updates_status_widget(self):
+        """On shares ready, the status widget is updated."""
+        self.patch(self.ui.status, 'on_shares_ready', self._set_called)
+
+        self.ui.on_shares_ready()
 
         self.assertEqual(self._called, ((), {}))
 
@@ -113,6 +113,16 @@ class MetadataDialogTestCase(BaseMetadataTestCase):
         self.assertEqual(self.ui.basic_info_label.get_text(),
                          status.NOT_SYNCHED_PATH)
 
+    def test_unavailable(self):
+        """Special case: syncdaemon didn't answer."""
+        self.ui.got_metadata(TEST_FILE, syncdaemon.METADATA_UNAVAILABLE)
+        self.assertFalse(self.ui.spinner.get_visible())
+        self.assertTrue(self.ui.path_label.get_visible())
+        self.assertEqual(self.ui.path_label.get_text(), TEST_FILE)
+        self.assertTrue(self.ui.basic_info_label.get_visible())
+        self.assertEqual(self.ui.basic_info_label.get_text(),
+                         syncdaemon.METADATA_UNAVAILABLE)
+
     def test_path_label(self):
         """Check it puts the correct path in the label."""
         formatted_path = "specially formatted path"
@@ -212,7 +222,10 @@ class StatusTestCase(BaseTestCase):
         current_state = self.ui.sd.current_state
 
         state = current_state.state
-        if state == syncdaemon.STATE_IDLE:
+        if current_state.circuit != syncdaemon.CIRCUIT_CLOSED:
+            expected_image = self.ui._status_images['alert']
+            expected_status = status.UNRESPONSIVE
+        elif state == syncdaemon.STATE_IDLE:
             expected_image = self.ui._status_images['idle']
             expected_status = status.IDLE
         elif state == syncdaemon.STATE_WORKING:
@@ -245,8 +258,11 @@ class StatusTestCase(BaseTestCase):
         self.assertEqual(self.ui.status_image.get_pixbuf(), expected_image)
 
     def assert_widget_availability(self, enabled=True,
-                                   public_files_enabled=True):
-        """Check button availability according to 'enabled'."""
+                                   public_files_enabled=True, **buttons):
+        """Check button availability according to 'enabled'.
+
+        The availability of other specific buttons can be given by name.
+        """
         widget = self.ui.toolbar
         self.assertTrue(widget.get_visible(), 'Should be visible.')
         # all children should be visible
@@ -256,18 +272,14 @@ class StatusTestCase(BaseTestCase):
             self.assertTrue(button.get_visible(),
                             'Children should be visible.')
 
-        sensitive = widget.is_sensitive()
-        msg = 'Should %sbe sensitive.' % ('' if enabled else 'not ')
-        self.assertTrue(sensitive if enabled else not sensitive, msg)
+        expected_by_button = dict((getattr(self.ui, name), value)
+                                  for name, value in buttons.items())
+        expected_by_button[self.ui.public_files] = public_files_enabled
 
         for n_button in xrange(self.ui.toolbar.get_n_items()):
             button = self.ui.toolbar.get_nth_item(n_button)
             sensitive = button.is_sensitive()
-
-            if button is self.ui.public_files:
-                expected = public_files_enabled
-            else:
-                expected = enabled
+            expected = expected_by_button.get(button, enabled)
 
             msg = 'Button %i should %sbe sensitive.'
             self.assertTrue(sensitive if expected else not sensitive,
@@ -279,6 +291,26 @@ class StatusTestCase(BaseTestCase):
                          self.ui.on_metadata_ready,
                          'on_metadata_ready_callback callback must be set.')
 
+    def test_circuit_callback_is_connected(self):
+        """Circuit changed callback is connected."""
+        self.assertEqual(self.ui.sd.on_circuit_changed_callback,
+                         self.ui.on_circuit_changed,
+                         'on_circuit_changed_callback callback must be set.')
+
+    def test_on_circuit_changed_updates(self):
+        """The status is updated when the circuit changes."""
+        self.patch(self.ui, 'update', self._set_called)
+        self.ui.on_circuit_changed(syncdaemon.CIRCUIT_OPEN)
+        self.assertEqual(self._called, ((), {}))
+
+    def test_update_is_correct_when_unresponsive(self):
+        """The status shows that syncdaemon is not answering."""
+        self.ui.sd.current_state.set(state=syncdaemon.STATE_IDLE,
+                                     circuit=syncdaemon.CIRCUIT_OPEN)
+        self.ui.update()
+        self.assert_status_correct()
+        self.assertEqual(self.ui.status_label.get_text(), status.UNRESPONSIVE)
+
     def test_update_is_called_at_startup(self):
         """Update is called at startup."""
         self.patch(self.ui_class, 'update', self._set_called)
@@ -313,6 +345,42 @@ class StatusTestCase(BaseTestCase):
         self.ui.on_initial_data_ready()
         self.assert_widget_availability(public_files_enabled=False)
 
+    def test_unavailable_data_disabled(self):
+        """The datasets that syncdaemon didn't answer are kept disabled."""
+        self.ui.sd.initial_data_unavailable.update(['status', 'shares'])
+        self.ui.on_initial_data_ready()
+        self.assert_widget_availability(public_files_enabled=False,
+                                        metadata=False,
+                                        shares_to_me=False,
+                                        shares_to_others=False)
+
+        # enabled when each one gets ready
+        self.ui.on_shares_ready()
+        self.assert_widget_availability(public_files_enabled=False,
+                                        metadata=False)
+
+    def test_metadata_enabled_when_status_ready(self):
+        """The metadata is enabled when the status is ready."""
+        self.ui.on_status_ready()
+        self.assert_widget_availability(enabled=False,
+                                        public_files_enabled=False,
+                                        metadata=True)
+
+    def test_folders_enabled_when_folders_ready(self):
+        """The folders are enabled when the folders are ready."""
+        self.ui.on_folders_ready()
+        self.assert_widget_availability(enabled=False,
+                                        public_files_enabled=False,
+                                        folders=True)
+
+    def test_shares_enabled_when_shares_ready(self):
+        """The shares are enabled when the shares are ready."""
+        self.ui.on_shares_ready()
+        self.assert_widget_availability(enabled=False,
+                                        public_files_enabled=False,
+                                        shares_to_me=True,
+                                        shares_to_others=True)
+
     def test_public_files_disabled_until_initial_online_data_ready(self):
         """Widget is disabled until initial online data ready."""
         # disabled at startup
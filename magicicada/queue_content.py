@@ -19,6 +19,8 @@
 """The structure for the operations in the queue."""
 
 import collections
+import gc
+import itertools
 import logging
 import time
 import os
@@ -42,15 +44,106 @@ DONE = '__done__'
 PATH_DEFAULT = 'path'
 PATH_SPECIALS = {OP_MOVE: 'path_from'}
 
+# the only operation data that is kept in the structure
+OP_DATA_FIELDS = ('path', 'path_from', 'path_to')
+
+# where the size of the transferred content lives in the operation data
+SIZE_FIELD = 'deflated_size'
+
 # type of operations
 NODE_OP, INTERNAL_OP = "Node Internal".split()
 
+# how many internal operations are kept
+INTERNAL_OPS_CAPACITY = 1000
+
+# kind of changes in the node structure
+DELTA_CREATED, DELTA_OPS_CHANGED, DELTA_DONE, DELTA_REMOVED = \
+    "Created OpsChanged Done Removed".split()
+
 # log!
 logger = logging.getLogger('magicicada.queue_content')
 
 
+# interned operation names, as they are repeated a lot
+_op_names = {}
+
+
+class Operation(object):
+    """An operation in a node.
+
+    It's accessed as the (op_id, op_name, op_data) tuple it replaces, where
+    op_data also holds if the operation is done (that mapping is built only
+    when asked, and kept until the operation is done). The size is the one
+    of the content to transfer, 0 if not known.
+    """
+
+    __slots__ = ('op_id', 'op_name', 'data', 'done', 'size', '_op_data')
+
+    def __init__(self, op_id, op_name, op_data, done=False):
+        self.op_id = op_id
+        self.op_name = _op_names.setdefault(op_name, op_name)
+        self.data = tuple((k, op_data[k])
+                          for k in OP_DATA_FIELDS if k in op_data)
+        self.done = done
+        try:
+            self.size = int(op_data.get(SIZE_FIELD, 0))
+        except (TypeError, ValueError):
+            self.size = 0
+        self._op_data = None
+
+    def _get_op_data(self):
+        """Return the operation data, including the done flag."""
+        op_data = self._op_data
+        if op_data is None or op_data[DONE] != self.done:
+            op_data = dict(self.data)
+            op_data[DONE] = self.done
+            self._op_data = op_data
+        return op_data
+
+    op_data = property(_get_op_data)
+
+    def __getitem__(self, pos):
+        if pos == 0:
+            return self.op_id
+        if pos == 1:
+            return self.op_name
+        if pos == 2:
+            return self.op_data
+        return (self.op_id, self.op_name, self.op_data)[pos]
+
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        return iter((self.op_id, self.op_name, self.op_data))
+
+    def __eq__(self, other):
+        if not isinstance(other, (tuple, Operation)):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __str__(self):
+        return str(tuple(self))
+    __repr__ = __str__
+
+
 class Node(object):
-    """A node in the tree structure."""
+    """A node in the tree structure.
+
+    The subtree statistics count the pending and done operations, and the
+    known bytes to transfer of the pending ones, in this node and all the
+    nodes below it.
+    """
+
+    __slots__ = ('kind', 'last_modified', 'operations', 'done', 'pending',
+                 'children', 'parent', 'name', 'generation',
+                 'subtree_pending', 'subtree_done', 'subtree_bytes')
 
     def __init__(self, name, parent, kind, last_modified=None,
                  operations=None, done=None):
@@ -58,14 +151,19 @@ class Node(object):
         self.last_modified = last_modified
         self.operations = [] if operations is None else operations
         self.done = done
+        self.pending = 0
+        self.generation = 0
+        self.subtree_pending = 0
+        self.subtree_done = 0
+        self.subtree_bytes = 0
         self.children = {}
         self.parent = parent
         self.name = name
 
     def __str__(self):
-        return ("<Node %(name)s %(kind)r last_modified=%(last_modified)s "
-                "done=%(done)s operations=%(operations)s "
-                "children=%(children)s>" % self.__dict__)
+        return ("<Node %s %r last_modified=%s done=%s operations=%s "
+                "children=%s>" % (self.name, self.kind, self.last_modified,
+                                  self.done, self.operations, self.children))
     __repr__ = __str__
 
 
@@ -73,17 +171,26 @@ class Node(object):
 # it's camel case because it mimics a class
 Internal = collections.namedtuple("Collections",
                                   "timestamp op_name op_id op_data action")
+Delta = collections.namedtuple("Delta", "kind path node")
 
 
 class QueueContent(object):
     """Structure to support a tree from the content of the request queue."""
 
-    def __init__(self, home):
+    def __init__(self, home, internal_ops_capacity=INTERNAL_OPS_CAPACITY):
         self.home = home
         self.share_real = None
         self.share_link = None
         self._node_ops = {}
-        self.internal_ops = []
+        self._node_index = {}
+        self._pending_ops = {}
+        # the done nodes, in the order they finished
+        self._done_nodes = collections.OrderedDict()
+        self._deltas = []
+        self.on_deltas_callback = None
+        self.generation = 0
+        self.internal_ops = collections.deque(maxlen=internal_ops_capacity)
+        self.internal_ops_count = 0
         self._transferring = set()
 
     def _get_node_ops(self):
@@ -100,33 +207,136 @@ class QueueContent(object):
 
     transferring = property(_get_transferring)
 
+    def _get_internal_ops_evicted(self):
+        """Return how many internal ops were dropped for lack of room."""
+        return self.internal_ops_count - len(self.internal_ops)
+
+    internal_ops_evicted = property(_get_internal_ops_evicted)
+
+    def get_internal_ops(self, since=0):
+        """Return the internal ops from the sequence number 'since' onwards.
+
+        The sequence number of an internal op is its position among all
+        the ones that were stored, so asking with the previous value of
+        'internal_ops_count' returns only the new ones. The already evicted
+        ops are not returned.
+        """
+        quantity = min(self.internal_ops_count - since, len(self.internal_ops))
+        if quantity <= 0:
+            return []
+        result = list(itertools.islice(reversed(self.internal_ops), quantity))
+        result.reverse()
+        return result
+
+    def _node_changed(self, kind, path, node):
+        """A node changed, mark it and its ancestors with the generation.
+
+        Also store the change, if somebody wants them.
+        """
+        if self.on_deltas_callback is not None:
+            self._deltas.append(Delta(kind, path, node))
+
+        # a removed node is not in the structure anymore, but its parent
+        # changed; stop when reaching a node already in this generation
+        if kind == DELTA_REMOVED:
+            node = node.parent
+        generation = self.generation
+        while node is not None and node.generation != generation:
+            node.generation = generation
+            node = node.parent
+
+    def get_changed_nodes(self, since):
+        """Return the nodes that changed after the 'since' generation.
+
+        A node changed if it was created, its operations changed, or the
+        same happened to any of its descendants (including removals). Only
+        the changed branches are walked. The result is a list of (path,
+        node) with the parents before their children.
+        """
+        result = []
+        pending = [(name, node) for name, node in self._node_ops.items()
+                   if node.generation > since]
+        while pending:
+            path, node = pending.pop()
+            result.append((path, node))
+            pending.extend((path + os.path.sep + name, child)
+                           for name, child in node.children.items()
+                           if child.generation > since)
+        return result
+
+    def _send_deltas(self):
+        """Send the stored changes, if any."""
+        if self._deltas:
+            deltas = self._deltas
+            self._deltas = []
+            self.on_deltas_callback(deltas)
+
     def clear(self):
-        """Clear the finished commands."""
-
-        def inspect(children):
-            """Inspect recursively."""
-
-            for _, data in children.items():
-                if data.done:
-                    if data.children:
-                        # just fix ops and state, and leave it
-                        data.done = None
-                        data.operations[:] = []
-                    else:
-                        # remove it, and go backwards
-                        while data.parent is not None:
-                            parent = data.parent
-                            del parent.children[data.name]
-                            if parent.done is not None or parent.children:
-                                break
-                            data = data.parent
-                        else:
-                            # special root handling
-                            if not children:
-                                del self._node_ops['']
-                inspect(data.children)
-
-        inspect(self._node_ops)
+        """Clear the finished commands.
+
+        Only the done nodes are visited, as they are kept in a registry.
+        """
+        self.generation += 1
+        done_nodes = self._done_nodes
+        self._done_nodes = collections.OrderedDict()
+        for node in done_nodes:
+            self._clear_node(node)
+        self._send_deltas()
+
+    def prune(self, max_age=None, max_done=None, limit=None):
+        """Clear the oldest finished commands.
+
+        The done nodes that finished more than 'max_age' seconds ago are
+        cleared, and also the oldest ones when there are more than
+        'max_done' of them. No more than 'limit' nodes are cleared in
+        one call; return how many were.
+        """
+        self.generation += 1
+        done_nodes = self._done_nodes
+        oldest = time.time() - max_age if max_age is not None else None
+        cleared = 0
+        while done_nodes and (limit is None or cleared < limit):
+            node = next(iter(done_nodes))
+            too_many = max_done is not None and len(done_nodes) > max_done
+            too_old = oldest is not None and node.last_modified < oldest
+            if not too_many and not too_old:
+                # the rest finished later, nothing else to do
+                break
+            del done_nodes[node]
+            self._clear_node(node)
+            cleared += 1
+        self._send_deltas()
+        return cleared
+
+    def _clear_node(self, node):
+        """Clear a done node, already taken out of the registry."""
+        if node.children:
+            # just fix ops and state, and leave it
+            self._add_stats(node, 0, -len(node.operations), 0)
+            node.done = None
+            node.operations[:] = []
+            path = self._get_node_path(node)
+            self._node_changed(DELTA_OPS_CHANGED, path, node)
+            return
+
+        # remove it, and go backwards while the parents are left empty
+        # and without operations
+        self._add_stats(node.parent, -node.subtree_pending,
+                        -node.subtree_done, -node.subtree_bytes)
+        while True:
+            parent = node.parent
+            if parent is None:
+                children = self._node_ops
+            else:
+                children = parent.children
+            del children[node.name]
+            path = self._get_node_path(node)
+            del self._node_index[path]
+            self._node_changed(DELTA_REMOVED, path, node)
+            if (parent is None or parent.done is not None or
+                    parent.pending or parent.children):
+                break
+            node = parent
 
     def set_shares_dirs(self, share_link, share_real):
         """Set shares dirs."""
@@ -137,9 +347,66 @@ class QueueContent(object):
         self.share_link = share_link
 
     def set_content(self, data):
-        """Set the whole structures with the received data."""
-        for op_info in data:
-            self.add(*op_info)
+        """Set the whole structures with the received data.
+
+        The result is the same than adding the operations one by one, but
+        all of them share the same timestamp, and the parent node is
+        searched only once for consecutive operations in the same directory
+        (and the subtree statistics of its ancestors adjusted once for all
+        of them). The garbage collector is paused meanwhile, as only new
+        objects are created and it would otherwise run a lot of times for
+        nothing.
+
+        The operations already pending (because they were added before,
+        one by one) are not added again.
+        """
+        self.generation += 1
+        timestamp = time.time()
+        parent_path = parent = None
+        pending = done = size = 0
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for op_name, op_id, op_data in data:
+                if op_name not in NODE_OPS:
+                    self._add_internal(op_name, op_id, op_data, timestamp)
+                    continue
+                if op_id in self._pending_ops:
+                    continue
+
+                elements = self._get_path_elements(op_name, op_data)
+                this_parent_path = os.path.sep.join(elements[:-1])
+                if this_parent_path != parent_path:
+                    self._add_stats(parent, pending, done, size)
+                    pending = done = size = 0
+                    parent_path = this_parent_path
+                    parent = self._get_parent(elements)
+                stats = self._add_node_to_parent(parent, elements, op_name,
+                                                 op_id, op_data, timestamp)
+                pending += stats[0]
+                done += stats[1]
+                size += stats[2]
+            self._add_stats(parent, pending, done, size)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self._send_deltas()
+
+    def _add_stats(self, node, pending, done, size):
+        """Adjust the subtree statistics of the node and its ancestors."""
+        while node is not None:
+            node.subtree_pending += pending
+            node.subtree_done += done
+            node.subtree_bytes += size
+            node = node.parent
+
+    def _get_node_path(self, node):
+        """Return the path of the node, as used in the index."""
+        elements = []
+        while node is not None:
+            elements.append(node.name)
+            node = node.parent
+        return os.path.sep.join(reversed(elements))
 
     def _get_path_elements(self, op_name, data):
         """Extract the path from data and adjust it."""
@@ -157,40 +424,67 @@ class QueueContent(object):
     def add(self, op_name, op_id, op_data):
         """Add an operation to the structures."""
         f = self._add_node if op_name in NODE_OPS else self._add_internal
-        return f(op_name, op_id, op_data)
+        result = f(op_name, op_id, op_data)
+        self._send_deltas()
+        return result
 
-    def _add_internal(self, op_name, op_id, op_data):
+    def _add_internal(self, op_name, op_id, op_data, timestamp=None):
         """Add an internal operation."""
+        if timestamp is None:
+            timestamp = time.time()
         op = Internal(op_name=op_name, op_id=op_id, op_data=op_data,
-                      timestamp=time.time(), action=ACTION_ADDED)
+                      timestamp=timestamp, action=ACTION_ADDED)
         self.internal_ops.append(op)
+        self.internal_ops_count += 1
         return INTERNAL_OP
 
+    def _get_parent(self, elements):
+        """Get the parent node for the path elements.
+
+        All the needed nodes in the middle are created, from the deepest one
+        that already exists.
+        """
+        node = None   # root parent ;)
+        pos = len(elements) - 1
+        while pos > 0:
+            node = self._node_index.get(os.path.sep.join(elements[:pos]))
+            if node is not None:
+                break
+            pos -= 1
+        for pos in range(pos, len(elements) - 1):
+            elem = elements[pos]
+            children = self._node_ops if node is None else node.children
+            node = Node(elem, node, KIND_DIR)
+            children[elem] = node
+            path = os.path.sep.join(elements[:pos + 1])
+            self._node_index[path] = node
+            self._node_changed(DELTA_CREATED, path, node)
+        return node
+
     def _add_node(self, op_name, op_id, op_data):
         """Add a node operation."""
-        # if a transfer operation, keep account of it
-        if op_name == OP_UPLOAD or op_name == OP_DOWNLOAD:
-            self._transferring.add(op_id)
-
+        self.generation += 1
         elements = self._get_path_elements(op_name, op_data)
+        parent = self._get_parent(elements)
+        stats = self._add_node_to_parent(parent, elements, op_name, op_id,
+                                         op_data, time.time())
+        self._add_stats(parent, *stats)
+        return NODE_OP
 
-        # loop on all except the last one just to get the final one or create
-        # all needed in the middle
-        children = self._node_ops
-        node = None   # root parent ;)
-        for elem in elements[:-1]:
-            if elem in children:
-                node = children[elem]
-            else:
-                node = Node(elem, node, KIND_DIR)
-                children[elem] = node
+    def _add_node_to_parent(self, parent, elements, op_name, op_id, op_data,
+                            timestamp):
+        """Add a node operation, with the parent node already found.
 
-            children = node.children
+        Return how the subtree statistics changed, for the caller to adjust
+        the ones of the ancestors.
+        """
+        # if a transfer operation, keep account of it
+        if op_name == OP_UPLOAD or op_name == OP_DOWNLOAD:
+            self._transferring.add(op_id)
 
         elem = elements[-1]
-        op_data = op_data.copy()
-        op_data[DONE] = False
-        operation = (op_id, op_name, op_data)
+        path = os.path.sep.join(elements)
+        operation = Operation(op_id, op_name, op_data)
         if op_name == OP_MAKEFILE:
             this_kind = KIND_FILE
         elif op_name == OP_MAKEDIR:
@@ -198,71 +492,102 @@ class QueueContent(object):
         else:
             this_kind = KIND_UNKNOWN
 
-        if elem in children:
-            node = children[elem]
-            node.last_modified = time.time()
+        discarded = 0
+        node = self._node_index.get(path)
+        if node is not None:
+            node.last_modified = timestamp
             if node.kind is KIND_UNKNOWN and this_kind is not KIND_UNKNOWN:
                 node.kind = this_kind
 
             # if node was already done, start clean with the operations
             if node.done:
+                discarded = len(node.operations)
                 node.operations[:] = [operation]
                 node.done = False
+                self._done_nodes.pop(node, None)
             else:
+                # it may be a directory created just as a parent
                 node.operations.append(operation)
+                node.done = False
+            self._node_changed(DELTA_OPS_CHANGED, path, node)
         else:
-            node = Node(elem, node, this_kind, last_modified=time.time(),
+            children = self._node_ops if parent is None else parent.children
+            node = Node(elem, parent, this_kind, last_modified=timestamp,
                         done=False, operations=[operation])
             children[elem] = node
-        return NODE_OP
+            self._node_index[path] = node
+            self._node_changed(DELTA_CREATED, path, node)
+
+        node.pending += 1
+        node.subtree_pending += 1
+        node.subtree_done -= discarded
+        node.subtree_bytes += operation.size
+        self._pending_ops.setdefault(op_id, []).append((node, operation))
+        return 1, -discarded, operation.size
 
     def remove(self, op_name, op_id, op_data):
         """Remove an operation from the structures."""
         f = self._remove_node if op_name in NODE_OPS else self._remove_internal
-        return f(op_name, op_id, op_data)
+        result = f(op_name, op_id, op_data)
+        self._send_deltas()
+        return result
 
     def _remove_internal(self, op_name, op_id, op_data):
         """Mark as finished one internal operation."""
         op = Internal(op_name=op_name, op_id=op_id, op_data=op_data,
                       timestamp=time.time(), action=ACTION_REMOVED)
         self.internal_ops.append(op)
+        self.internal_ops_count += 1
         return INTERNAL_OP
 
     def _remove_node(self, op_name, op_id, op_data):
         """Mark as finished one operation in the structure"""
+        self.generation += 1
         # if a transfer operation, keep account of it
         if op_name == OP_UPLOAD or op_name == OP_DOWNLOAD:
             self._transferring.discard(op_id)
 
         elements = self._get_path_elements(op_name, op_data)
+        path = os.path.sep.join(elements)
+        try:
+            node = self._node_index[path]
+        except KeyError:
+            # find which element is missing, just to report it
+            children = self._node_ops
+            for pos, elem in enumerate(elements):
+                node_path = os.path.sep.join(elements[:pos + 1])
+                node = self._node_index.get(node_path)
+                if node is None:
+                    break
+                children = node.children
+            logger.warning("Element %r (from %r) not in children %s",
+                           elem, elements, children)
+            return
 
-        # loop on all except the last one just to get the final one or create
-        # all needed in the middle
-        children = self._node_ops
-        for elem in elements:
-            try:
-                node = children[elem]
-            except KeyError:
-                logger.warning("Element %r (from %r) not in children %s",
-                               elem, elements, children)
-                return
-
-            children = node.children
-
-        # search for the operation in the list
-        ops = [x for x in node.operations if x[0] == op_id if not x[2][DONE]]
+        # search for the operation in the pending ones
+        pending = self._pending_ops.get(op_id, [])
+        ops = [x for x in pending if x[0] is node]
         if len(ops) != 1:
             logger.error("Operation %s [%s] found %d times in node %s",
                          op_name, op_id, len(ops), node)
             return
+        pending.remove(ops[0])
+        if not pending:
+            del self._pending_ops[op_id]
 
         # fix the operation
-        op_dict = ops[0][2]
-        op_dict[DONE] = True
+        operation = ops[0][1]
+        operation.done = True
+        self._add_stats(node, -1, 1, -operation.size)
 
         # check if all the operations finished
-        if all(x[2][DONE] for x in node.operations):
+        node.pending -= 1
+        if not node.pending:
             node.done = True
+            self._done_nodes[node] = None
+            self._node_changed(DELTA_DONE, path, node)
+        else:
+            self._node_changed(DELTA_OPS_CHANGED, path, node)
 
         # adjust last modified time
         node.last_modified = time.time()
@@ -14,21 +14,36 @@
 
 """The backend that communicates Magicicada with the SyncDaemon."""
 
+import collections
 import logging
+import operator
 import os
+import random
 import re
+import time
 import user
 
 from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 
 from magicicada.dbusiface import (
+    CIRCUIT_CLOSED,
     DBusInterface,
     FolderOperationError,
     NOT_SYNCHED_PATH,
+    SHARES_SIDES,
+    SHARES_TO_ME,
+    SHARES_TO_OTHERS,
     ShareOperationError,
+    UnresponsiveError,
 )
 from magicicada.helpers import NO_OP
-from magicicada.queue_content import QueueContent, NODE_OP, INTERNAL_OP
+from magicicada.queue_content import (
+    INTERNAL_OP,
+    NODE_OP,
+    OP_DATA_FIELDS,
+    QueueContent,
+)
 
 # log!
 logger = logging.getLogger('magicicada.syncdaemon')
@@ -36,8 +51,42 @@ logger = logging.getLogger('magicicada.syncdaemon')
 # states for MQ and CQ handling bursts
 ASKING_IDLE, ASKING_YES, ASKING_LATER = range(3)
 
-# interval to poll for transfer progress
+# time without queue signals to notify the gathered ones, and the most
+# that a queue signal can wait to be notified
+QUEUE_SIGNALS_WINDOW = .5
+QUEUE_SIGNALS_CEILING = 2
+
+# time after patching the folders with a signal to get all of them again,
+# just in case some signal was missed
+FOLDERS_RECONCILE_DELAY = 300
+
+# least time between the starts of two refreshes of the same dataset
+REFRESH_WINDOW = 1
+
+# how many initial datasets are requested at the same time
+INITIAL_DATA_CONCURRENCY = 3
+
+# interval to poll for transfer progress, and how it adapts to it
 TRANSFER_POLL_INTERVAL = 5
+TRANSFER_POLL_MIN_INTERVAL = 1
+TRANSFER_POLL_MAX_INTERVAL = 60
+TRANSFER_POLL_BACKOFF = 2
+TRANSFER_POLL_JITTER = .1
+
+# interval to prune the done node ops, and how many at most each time
+DONE_OPS_PRUNE_INTERVAL = 10
+DONE_OPS_PRUNE_LIMIT = 200
+
+# most metadata entries kept, and seconds that each one is valid (None for
+# no limit, as they are forgotten when a queue operation touches the path)
+METADATA_CACHE_SIZE = 1000
+METADATA_CACHE_TTL = None
+
+# the metadata given when SD doesn't answer for it
+METADATA_UNAVAILABLE = "SyncDaemon is not answering, try again later"
+
+# the stat in the metadata, as "posix.stat_result(st_mode=..., ...)"
+STAT_RE = re.compile(r".*\((.*)\)")
 
 # status of the node
 CHANGED_LOCAL = u"UPLOADING"
@@ -63,13 +112,22 @@ def mandatory_callback(function_name):
     return f
 
 
+def _first_error(failure):
+    """Return the failure that made the gathered deferreds fail."""
+    while failure.check(defer.FirstError):
+        failure = failure.value.subFailure
+    return failure
+
+
 class State(object):
     """Hold the state of SD."""
 
     _attrs = {'name', 'description', 'is_error', 'is_connected',
-              'is_online', 'queues', 'connection', 'is_started', 'state'}
+              'is_online', 'queues', 'connection', 'is_started', 'state',
+              'circuit'}
     _toshow = ['name', 'is_error', 'is_connected',
-               'is_online', 'queues', 'connection', 'is_started', 'state']
+               'is_online', 'queues', 'connection', 'is_started', 'state',
+               'circuit']
 
     def __init__(self):
         # starting defaults
@@ -82,6 +140,7 @@ class State(object):
         self.connection = ''
         self.is_started = False
         self.state = STATE_STOPPED
+        self.circuit = CIRCUIT_CLOSED
 
     def __getattribute__(self, name):
         """Return the value if there."""
@@ -120,12 +179,20 @@ class Poller(object):
     def _execute(self):
         """Execute the callback and go again."""
         self._inside_call = True
-        yield self.callback()
+        result = yield self.callback()
         self._inside_call = False
+        self._adapt(result)
 
         # if wasn't stopped in the middle, keep polling
         if self._should_run:
-            self._call = reactor.callLater(self.interval, self._execute)
+            self._call = reactor.callLater(self._get_delay(), self._execute)
+
+    def _adapt(self, result):
+        """Adapt to the result of the callback; nothing to do here."""
+
+    def _get_delay(self):
+        """Return the time to wait for the next call."""
+        return self.interval
 
     def run(self, should_run):
         """Stop or start the poller."""
@@ -135,7 +202,7 @@ class Poller(object):
             # of being executing the callback
             if self._call is None or not self._call.active():
                 if not self._inside_call:
-                    self._call = reactor.callLater(self.interval,
+                    self._call = reactor.callLater(self._get_delay(),
                                                    self._execute)
         else:
             # cancel the polling call
@@ -143,6 +210,397 @@ class Poller(object):
                 self._call.cancel()
 
 
+class ListIndex(object):
+    """Index of the items in a list by a key, to patch the list in place.
+
+    The positions are found the first time the list is patched after a
+    reset, so a list that is not patched costs nothing. Removing an item
+    puts the last one in its place.
+    """
+
+    def __init__(self, get_key):
+        self.get_key = get_key
+        self._positions = None
+
+    def reset(self):
+        """Forget the positions, the list was replaced."""
+        self._positions = None
+
+    def _get_positions(self, items):
+        """Return the position of each item by its key."""
+        if self._positions is None:
+            get_key = self.get_key
+            self._positions = dict((get_key(item), pos)
+                                   for pos, item in enumerate(items))
+        return self._positions
+
+    def put(self, items, item):
+        """Put the item in the list, replacing the one with its key."""
+        positions = self._get_positions(items)
+        key = self.get_key(item)
+        pos = positions.get(key)
+        if pos is None:
+            positions[key] = len(items)
+            items.append(item)
+        else:
+            items[pos] = item
+
+    def remove(self, items, key):
+        """Remove the item with the key from the list, if there."""
+        positions = self._get_positions(items)
+        pos = positions.pop(key, None)
+        if pos is not None:
+            last = items.pop()
+            if pos < len(items):
+                items[pos] = last
+                positions[self.get_key(last)] = pos
+
+
+class VersionedIndex(ListIndex):
+    """A ListIndex that keeps a version for each item, to detect changes.
+
+    The version of an item is bumped only when it's put with different
+    data, so patching or replacing the list tells if something changed
+    without comparing the whole lists.
+    """
+
+    def __init__(self, get_key):
+        super(VersionedIndex, self).__init__(get_key)
+        self.versions = {}
+
+    def put(self, items, item):
+        """Put the item in the list, return if it changed."""
+        key = self.get_key(item)
+        pos = self._get_positions(items).get(key)
+        if pos is not None and items[pos] == item:
+            return False
+        super(VersionedIndex, self).put(items, item)
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return True
+
+    def remove(self, items, key):
+        """Remove the item with the key from the list, return if there."""
+        if key not in self._get_positions(items):
+            return False
+        super(VersionedIndex, self).remove(items, key)
+        self.versions.pop(key, None)
+        return True
+
+    def replace(self, items, new_items):
+        """Stamp the items of a list that replaces the indexed one.
+
+        Return if something changed from the old list.
+        """
+        get_key = self.get_key
+        old = dict((get_key(item), item) for item in items)
+        versions = {}
+        changed = False
+        for item in new_items:
+            key = get_key(item)
+            version = self.versions.get(key, 0)
+            if old.pop(key, None) != item:
+                version += 1
+                changed = True
+            versions[key] = version
+        self.versions = versions
+        self.reset()
+        return changed or bool(old)
+
+
+class AdaptivePoller(Poller):
+    """Poller that adapts its interval to the activity.
+
+    The callback returns if there was activity. If yes the interval is
+    divided by 'backoff', if not it's multiplied by it, always between
+    'min_interval' and 'max_interval'. Each wait is randomly moved up to
+    the 'jitter' fraction of the interval. The interval starts again from
+    'start_interval' each time the poller is started.
+    """
+
+    def __init__(self, interval, callback, min_interval, max_interval,
+                 backoff, jitter):
+        super(AdaptivePoller, self).__init__(interval, callback)
+        self.start_interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+
+    def _adapt(self, active):
+        """Shorten the interval if there was activity, back off if not."""
+        if active:
+            interval = max(self.min_interval,
+                           self.interval / float(self.backoff))
+        else:
+            interval = min(self.max_interval, self.interval * self.backoff)
+        if interval != self.interval:
+            logger.debug("Poller interval changed from %s to %s",
+                         self.interval, interval)
+            self.interval = interval
+
+    def _get_delay(self):
+        """Return the interval with some jitter."""
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def run(self, should_run):
+        """Stop or start the poller, from the start interval if stopped."""
+        if should_run and not self._should_run:
+            self.interval = self.start_interval
+        super(AdaptivePoller, self).run(should_run)
+
+
+class Coalescer(object):
+    """Object that gathers bursts of signals in one call to a callback.
+
+    The first signal is notified right away. The ones that arrive after it
+    are notified together when 'window' seconds pass without new signals,
+    but never later than 'ceiling' seconds after the first of them. With a
+    'window' of 0 all the signals are notified right away.
+    """
+
+    def __init__(self, window, ceiling, callback):
+        self.window = window
+        self.ceiling = ceiling
+        self.callback = callback
+        self._state = ASKING_IDLE
+        self._first = None
+        self._last = None
+        self._call = None
+
+    def signal(self):
+        """A signal arrived, notify it now or later."""
+        if self.window <= 0:
+            self.callback()
+        elif self._state == ASKING_IDLE:
+            self._notify()
+        else:
+            self._last = reactor.seconds()
+            if self._state == ASKING_YES:
+                self._state = ASKING_LATER
+                self._first = self._last
+
+    def _notify(self):
+        """Call the callback and wait to see if more signals arrive."""
+        self._state = ASKING_YES
+        self._call = reactor.callLater(self.window, self._check)
+        self.callback()
+
+    def _check(self):
+        """Notify the gathered signals, if it's time, or wait more."""
+        self._call = None
+        if self._state == ASKING_YES:
+            # nothing arrived meanwhile
+            self._state = ASKING_IDLE
+            return
+
+        now = reactor.seconds()
+        limit = min(self._last + self.window, self._first + self.ceiling)
+        if now >= limit:
+            self._notify()
+        else:
+            self._call = reactor.callLater(limit - now, self._check)
+
+    def stop(self):
+        """Stop waiting, dropping the gathered signals."""
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._state = ASKING_IDLE
+
+
+class Refresher(object):
+    """Object that refreshes a dataset, one refresh at a time.
+
+    Refreshes start at least 'window' seconds apart. A refresh starts right
+    away if no other is running and the window since the last start
+    passed. Otherwise all the refreshes asked meanwhile are done by only
+    one, started when the running one finishes and the window passed.
+    As refreshes never overlap, the newest data is always the last stored.
+    """
+
+    def __init__(self, window, callback):
+        self.window = window
+        self.callback = callback
+        self._running = None
+        self._pending = None
+        self._last = None
+        self._call = None
+
+    def refresh(self):
+        """Ask for a refresh, return a deferred fired when it's done."""
+        d = defer.Deferred()
+        if self._pending is not None:
+            # superseded, goes with the next one
+            self._pending.append(d)
+        elif self._running is not None:
+            self._pending = [d]
+        else:
+            wait = self._get_wait()
+            if wait > 0:
+                self._pending = [d]
+                self._call = reactor.callLater(wait, self._start_pending)
+            else:
+                self._start([d])
+        return d
+
+    def _get_running(self):
+        """Tell if a refresh is running."""
+        return self._running is not None
+
+    running = property(_get_running)
+
+    def _get_wait(self):
+        """Return how long to wait for the window since the last start."""
+        if self._last is None:
+            return 0
+        return self._last + self.window - reactor.seconds()
+
+    def _start_pending(self):
+        """Start the refresh for all that are waiting."""
+        self._call = None
+        waiting, self._pending = self._pending, None
+        self._start(waiting)
+
+    def _start(self, waiting):
+        """Start a refresh."""
+        self._last = reactor.seconds()
+        self._running = waiting
+        d = defer.maybeDeferred(self.callback)
+        d.addBoth(self._finished)
+
+    def _finished(self, result):
+        """A refresh finished, let its callers know."""
+        waiting, self._running = self._running, None
+        for d in waiting:
+            d.callback(result)
+        if self._pending is not None:
+            wait = self._get_wait()
+            if wait > 0:
+                self._call = reactor.callLater(wait, self._start_pending)
+            else:
+                self._start_pending()
+
+    def stop(self):
+        """Stop, dropping the pending refresh."""
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._pending = None
+
+
+class MetadataCache(object):
+    """Keep the metadata asked lately, by real path.
+
+    The least recently used entries are dropped when more than 'size' are
+    kept, and if 'ttl' is given each one is forgotten that many seconds
+    after stored. The metadata being asked is not stored if its path, one
+    above or one below it, is forgotten on purpose while waiting for it.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+        # the stored paths below each directory, to forget them together
+        self._below = collections.defaultdict(set)
+
+        # the paths being asked (how many times), and the ones of them
+        # that were forgotten meanwhile
+        self._asked = collections.Counter()
+        self._stale = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_hit_rate(self):
+        """The part of the lookups that found the metadata."""
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.
+
+    hit_rate = property(_get_hit_rate)
+
+    def _ancestors(self, path):
+        """Yield the directories above the path, up to the root."""
+        parent = os.path.dirname(path)
+        while parent != path:
+            yield parent
+            path, parent = parent, os.path.dirname(parent)
+
+    def _forget(self, path):
+        """Forget the stored metadata for the path, if there."""
+        if self._entries.pop(path, None) is None:
+            return
+        for parent in self._ancestors(path):
+            below = self._below[parent]
+            below.discard(path)
+            if not below:
+                del self._below[parent]
+
+    def get(self, path):
+        """Return the metadata for the path, or None if not there."""
+        entry = self._entries.get(path)
+        if entry is not None:
+            stored, metadata = entry
+            if self.ttl is None or reactor.seconds() - stored < self.ttl:
+                # the most recently used goes last
+                del self._entries[path]
+                self._entries[path] = entry
+                self.hits += 1
+                return metadata
+            self._forget(path)
+        self.misses += 1
+
+    def put(self, path, metadata):
+        """Store the metadata for the path."""
+        if path in self._entries:
+            del self._entries[path]
+        else:
+            for parent in self._ancestors(path):
+                self._below[parent].add(path)
+        self._entries[path] = (reactor.seconds(), metadata)
+        while len(self._entries) > self.size:
+            self._forget(next(iter(self._entries)))
+
+    def asking(self, path):
+        """The metadata for the path is being asked."""
+        self._asked[path] += 1
+
+    def answered(self, path):
+        """The metadata for the path was answered (or not).
+
+        Return if it can be stored, that is, the path was not forgotten
+        while being asked.
+        """
+        fresh = path not in self._stale
+        self._asked[path] -= 1
+        if not self._asked[path]:
+            del self._asked[path]
+            self._stale.discard(path)
+        return fresh
+
+    def invalidate(self, path):
+        """Forget the metadata for the path, all above and all below it."""
+        path = path.rstrip(os.path.sep) or os.path.sep
+        ancestors = list(self._ancestors(path))
+        for key in [path] + ancestors + list(self._below.get(path, ())):
+            self._forget(key)
+
+        above = set(ancestors)
+        for asked in self._asked:
+            if asked == path or asked in above or \
+                    path in self._ancestors(asked):
+                self._stale.add(asked)
+
+    def clear(self):
+        """Forget all the metadata."""
+        self._entries.clear()
+        self._below.clear()
+        self._stale.update(self._asked)
+
+
 class SyncDaemon(object):
     """Interface to Ubuntu One's SyncDaemon."""
 
@@ -172,10 +630,15 @@ class SyncDaemon(object):
         self.on_shares_to_me_changed_callback = NO_OP
         self.on_shares_to_others_changed_callback = NO_OP
         self.on_public_files_changed_callback = NO_OP
+        self.on_public_file_changed_callback = NO_OP
         self.on_metadata_ready_callback = mandatory_callback(
             'on_metadata_ready_callback')
         self.on_initial_data_ready_callback = NO_OP
         self.on_initial_online_data_ready_callback = NO_OP
+        self.on_status_ready_callback = NO_OP
+        self.on_queue_ready_callback = NO_OP
+        self.on_folders_ready_callback = NO_OP
+        self.on_shares_ready_callback = NO_OP
         self.on_share_op_error_callback = mandatory_callback(
             'on_share_op_error_callback')
         self.on_folder_op_error_callback = mandatory_callback(
@@ -185,10 +648,72 @@ class SyncDaemon(object):
         self.on_node_ops_changed_callback = NO_OP
         self.on_internal_ops_changed_callback = NO_OP
         self.on_transfers_callback = NO_OP
-
-        # poller
-        self.transfers_poller = Poller(TRANSFER_POLL_INTERVAL,
-                                       self.get_current_transfers)
+        self.on_circuit_changed_callback = NO_OP
+
+        # subscribers to the changes in the node ops
+        self._node_ops_subscribers = []
+
+        # progress of the transfers in the last poll, and the transfers
+        # that signalled their progress since then
+        self._transfers_progress = {}
+        self._signalled_transfers = set()
+
+        # calls waiting for the transfers being requested
+        self._transfers_waiting = []
+
+        # the folders by volume id and the public files by node id, to
+        # patch them, and the call to get all the folders after that
+        self._folders_index = ListIndex(operator.attrgetter('volume'))
+        self._public_files_index = ListIndex(operator.attrgetter('node'))
+        self._shares_indexes = dict(
+            (side, VersionedIndex(operator.attrgetter('volume_id', 'node_id')))
+            for side in SHARES_SIDES)
+        self._folders_reconcile_call = None
+
+        # refreshers for the datasets that are asked again as a whole
+        self._refreshers = {
+            'folders': Refresher(REFRESH_WINDOW, self._refresh_folders),
+            'public_files': Refresher(REFRESH_WINDOW,
+                                      self._refresh_public_files),
+        }
+        for side in SHARES_SIDES:
+            self._refreshers['shares_' + side] = Refresher(
+                REFRESH_WINDOW, lambda side=side: self._refresh_shares(side))
+
+        # the patches done to each dataset while it was being refreshed
+        self._refresh_patches = dict((name, []) for name in self._refreshers)
+
+        # metadata asked lately, until the queue touches its path
+        self.metadata_cache = MetadataCache(METADATA_CACHE_SIZE,
+                                            METADATA_CACHE_TTL)
+
+        # what changed in the queue since last notification
+        self._queue_changes = set()
+        self.queue_coalescer = Coalescer(QUEUE_SIGNALS_WINDOW,
+                                         QUEUE_SIGNALS_CEILING,
+                                         self._send_queue_changed)
+
+        # how many initial datasets are requested at the same time, how
+        # long each one took to be ready, and the ones SD didn't answer
+        self.initial_data_concurrency = INITIAL_DATA_CONCURRENCY
+        self.initial_data_times = {}
+        self.initial_data_unavailable = set()
+
+        # getting the initial data and asking again for the unavailable
+        # one don't overlap
+        self._initial_data_lock = defer.DeferredLock()
+
+        # retention of the done node ops, all kept by default
+        self.done_ops_max_age = None
+        self.done_ops_max_count = None
+
+        # pollers
+        self.transfers_poller = AdaptivePoller(
+            TRANSFER_POLL_INTERVAL, self.get_current_transfers,
+            TRANSFER_POLL_MIN_INTERVAL, TRANSFER_POLL_MAX_INTERVAL,
+            TRANSFER_POLL_BACKOFF, TRANSFER_POLL_JITTER)
+        self.done_ops_poller = Poller(DONE_OPS_PRUNE_INTERVAL,
+                                      self._prune_done_ops)
         self._check_started()
 
     @defer.inlineCallbacks
@@ -206,84 +731,399 @@ class SyncDaemon(object):
         """Shut down the SyncDaemon."""
         logger.info("SyncDaemon interface going down")
         self.transfers_poller.run(False)
+        self.done_ops_poller.run(False)
+        self.queue_coalescer.stop()
+        for refresher in self._refreshers.itervalues():
+            refresher.stop()
+        self._cancel_folders_reconcile()
         self.dbus.shutdown()
 
-    @defer.inlineCallbacks
     def get_current_transfers(self):
-        """Get downloads and uploads."""
-        uploads = yield self.dbus.get_current_uploads()
-        downloads = yield self.dbus.get_current_downloads()
-        self.on_transfers_callback(uploads + downloads)
+        """Get downloads and uploads.
+
+        Both are requested at the same time, and if this is called again
+        while they are being requested, all the calls share the answer.
+
+        Return if polling them was useful: the progress changed and not all
+        the transfers signalled it.
+        """
+        d = defer.Deferred()
+        self._transfers_waiting.append(d)
+        if len(self._transfers_waiting) == 1:
+            request = defer.gatherResults([self.dbus.get_current_uploads(),
+                                           self.dbus.get_current_downloads()],
+                                          consumeErrors=True)
+            request.addCallback(self._process_transfers)
+            request.addErrback(_first_error)
+            request.addErrback(self._transfers_unanswered)
+            request.addBoth(self._answer_transfers)
+        return d
 
-    @defer.inlineCallbacks
-    def _get_initial_data(self):
-        """Get the initial SD data."""
-        logger.info("Getting offline initial data")
+    def _transfers_unanswered(self, failure):
+        """SD didn't answer for the transfers, nothing was learnt."""
+        failure.trap(UnresponsiveError)
+        logger.warning("Getting the transfers failed: %s", failure.value)
+        return False
+
+    def _answer_transfers(self, result):
+        """Answer all the calls waiting for the transfers."""
+        waiting = self._transfers_waiting
+        self._transfers_waiting = []
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _process_transfers(self, results):
+        """Send the transfers to the frontend, and see if they changed."""
+        uploads, downloads = results
+        transfers = uploads + downloads
+        self.on_transfers_callback(transfers)
 
+        progress = dict((t.path, t.transfered) for t in transfers)
+        changed = progress != self._transfers_progress
+        self._transfers_progress = progress
+        signalled = self._signalled_transfers
+        self._signalled_transfers = set()
+        return changed and not signalled.issuperset(progress)
+
+    @defer.inlineCallbacks
+    def _get_initial_status(self):
+        """Get the initial status."""
         status_data = yield self.dbus.get_status()
         self._send_status_changed(*status_data)
 
-        # queue content stuff
+    @defer.inlineCallbacks
+    def _get_initial_queue_content(self):
+        """Get the initial queue content, with the shares dirs it needs."""
         shares_real_dir = yield self.dbus.get_real_shares_dir()
         shares_link_dir = yield self.dbus.get_link_shares_dir()
         self.queue_content.set_shares_dirs(shares_link_dir, shares_real_dir)
         content = yield self.dbus.get_queue_content()
         self.queue_content.set_content(content)
+        self.metadata_cache.clear()
         self.transfers_poller.run(self.queue_content.transferring)
 
-        self.folders = yield self.dbus.get_folders()
+    def _get_initial_folders(self):
+        """Get the initial folders."""
+        return self._refreshers['folders'].refresh()
+
+    def _get_initial_shares_to_me(self):
+        """Get the initial shares to me."""
+        return self._refreshers['shares_' + SHARES_TO_ME].refresh()
+
+    def _get_initial_shares_to_others(self):
+        """Get the initial shares to others."""
+        return self._refreshers['shares_' + SHARES_TO_OTHERS].refresh()
+
+    def _initial_dataset_unavailable(self, failure, name):
+        """SD didn't answer for an initial dataset, go on without it."""
+        failure.trap(UnresponsiveError)
+        logger.warning("Initial %s data unavailable: %s", name, failure.value)
+        self.initial_data_unavailable.add(name)
 
-        self.shares_to_me = yield self.dbus.get_shares_to_me()
-        self.shares_to_others = yield self.dbus.get_shares_to_others()
+    def _initial_dataset_ready(self, _, name, started):
+        """An initial dataset is ready, let the frontend know."""
+        if name in self.initial_data_unavailable:
+            return
+        elapsed = time.time() - started
+        self.initial_data_times[name] = elapsed
+        logger.info("Initial %s data ready in %.3f seconds", name, elapsed)
+        getattr(self, 'on_%s_ready_callback' % name)()
+
+    @defer.inlineCallbacks
+    def _get_initial_data(self):
+        """Get the initial SD data.
+
+        The offline datasets are requested at the same time, up to the
+        configured concurrency, and each one is processed and sent to its
+        callback when it arrives, followed by its own ready callback. A
+        dataset that SD doesn't answer has no ready callback, but doesn't
+        stop the rest; it's asked again when SD answers later.
+        """
+        yield self._initial_data_lock.acquire()
+        try:
+            logger.info("Getting offline initial data")
+            started = time.time()
+            self.initial_data_unavailable.clear()
+            yield self._get_initial_datasets(started)
+        finally:
+            self._initial_data_lock.release()
+
+    def _get_dataset_getters(self):
+        """Return the getters of each initial dataset, by name."""
+        return collections.OrderedDict((
+            ('status', [self._get_initial_status]),
+            ('queue', [self._get_initial_queue_content]),
+            ('folders', [self._get_initial_folders]),
+            ('shares', [self._get_initial_shares_to_me,
+                        self._get_initial_shares_to_others]),
+            ('public_files', [self._refreshers['public_files'].refresh]),
+        ))
+
+    @defer.inlineCallbacks
+    def _get_initial_datasets(self, started):
+        """Get the offline datasets, and then the online one."""
+        semaphore = defer.DeferredSemaphore(self.initial_data_concurrency)
+        datasets = self._get_dataset_getters()
+        online_getters = datasets.pop('public_files')
+        all_ready = []
+        for name, getters in datasets.iteritems():
+            d = defer.gatherResults(
+                [semaphore.run(f).addErrback(self._initial_dataset_unavailable,
+                                             name) for f in getters],
+                consumeErrors=True)
+            d.addCallback(self._initial_dataset_ready, name, started)
+            all_ready.append(d)
+        d = defer.gatherResults(all_ready, consumeErrors=True)
+        d.addErrback(_first_error)
+        yield d
 
         # let frontend know that we have all the initial offline data
         logger.info("All initial offline data is ready")
         self.on_initial_data_ready_callback()
 
         logger.info("Getting online initial data")
-        self.public_files = yield self.dbus.get_public_files()
+        try:
+            yield online_getters[0]()
+        except UnresponsiveError, e:
+            logger.warning("Initial online data unavailable: %s", e)
+            self.initial_data_unavailable.add('public_files')
+            return
 
         # let frontend know that we have all the initial online data
         logger.info("All initial online data is ready")
         self.on_initial_online_data_ready_callback()
 
-    @defer.inlineCallbacks
     def on_sd_public_files_changed(self, pf=None, is_public=False):
-        """Update the Public Files list."""
+        """Update the Public Files list.
+
+        If the changed file is known and there's a list to patch, only
+        that file is changed and sent to the frontend. Otherwise the
+        whole list is asked again.
+        """
+        if pf is not None and self.public_files is not None:
+            logger.info("Public File changed: %r is_public=%s",
+                        pf.path, is_public)
+            self._patch_public_files(pf, is_public)
+            self._keep_patch('public_files', (pf, is_public))
+            self.on_public_file_changed_callback(pf, is_public)
+            return defer.succeed(None)
+
+        return self._refreshers['public_files'].refresh()
+
+    def _patch_public_files(self, pf, is_public):
+        """Put or take out a public file from the list."""
+        if is_public:
+            self._public_files_index.put(self.public_files, pf)
+        else:
+            self._public_files_index.remove(self.public_files, pf.node)
+
+    def _keep_patch(self, name, patch):
+        """Keep a patch done while the dataset is being refreshed.
+
+        The refresh may have been answered before the patch happened, so
+        it's done again on the new data.
+        """
+        if self._refreshers[name].running:
+            self._refresh_patches[name].append(patch)
+
+    def _take_patches(self, name):
+        """Return the patches done since the refresh started."""
+        patches = self._refresh_patches[name]
+        self._refresh_patches[name] = []
+        return patches
+
+    @defer.inlineCallbacks
+    def _refresh_public_files(self):
+        """Get all the public files, and let the frontend know."""
+        self._take_patches('public_files')
         data = yield self.dbus.get_public_files()
         logger.info("Got new Public Files list (%d items)", len(data))
         self.public_files = data
+        self._public_files_index.reset()
+        for patch in self._take_patches('public_files'):
+            self._patch_public_files(*patch)
         self.on_public_files_changed_callback(self.public_files)
 
-    @defer.inlineCallbacks
+    def _set_shares(self, side, shares):
+        """Store the shares of a side, return if they changed."""
+        attr = 'shares_' + side
+        old = getattr(self, attr)
+        changed = self._shares_indexes[side].replace(old or [], shares)
+        setattr(self, attr, shares)
+        return changed or old is None
+
+    def _shares_changed(self, side):
+        """Send the shares of a side to the frontend."""
+        callback = getattr(self, 'on_shares_%s_changed_callback' % side)
+        callback(getattr(self, 'shares_' + side))
+
+    def on_sd_share_changed(self, share, side, deleted=False):
+        """A share was created, changed or deleted in one side."""
+        shares = getattr(self, 'shares_' + side)
+        if shares is None:
+            # nothing to patch yet
+            self.on_sd_shares_changed()
+            return
+
+        changed = self._patch_shares(side, share, deleted)
+        self._keep_patch('shares_' + side, (share, deleted))
+        logger.info("SD Share %s changed: %r deleted=%s changed=%s",
+                    side, share.path, deleted, changed)
+        if changed:
+            self._shares_changed(side)
+
+    def _patch_shares(self, side, share, deleted):
+        """Put or take out a share from a side, return if it changed."""
+        shares = getattr(self, 'shares_' + side)
+        index = self._shares_indexes[side]
+        if deleted:
+            return index.remove(shares, index.get_key(share))
+        else:
+            return index.put(shares, share)
+
     def on_sd_shares_changed(self):
         """Shares changed, ask for new information."""
         logger.info("SD Shares changed")
-
-        # to me
-        new_to_me = yield self.dbus.get_shares_to_me()
-        if new_to_me != self.shares_to_me:
-            self.shares_to_me = new_to_me
-            self.on_shares_to_me_changed_callback(new_to_me)
-
-        # to others
-        new_to_others = yield self.dbus.get_shares_to_others()
-        if new_to_others != self.shares_to_others:
-            self.shares_to_others = new_to_others
-            self.on_shares_to_others_changed_callback(new_to_others)
+        d = defer.gatherResults([self._refreshers['shares_' + side].refresh()
+                                 for side in SHARES_SIDES],
+                                consumeErrors=True)
+        d.addErrback(_first_error)
+        return d
 
     @defer.inlineCallbacks
+    def _refresh_shares(self, side):
+        """Get all the shares of a side, and let the frontend know."""
+        name = 'shares_' + side
+        self._take_patches(name)
+        if side == SHARES_TO_ME:
+            shares = yield self.dbus.get_shares_to_me()
+        else:
+            shares = yield self.dbus.get_shares_to_others()
+        changed = self._set_shares(side, shares)
+        for share, deleted in self._take_patches(name):
+            changed = self._patch_shares(side, share, deleted) or changed
+        if changed:
+            self._shares_changed(side)
+
     def on_sd_folders_changed(self):
         """Folders changed, ask for new information."""
         logger.info("SD Folders changed")
-        self.folders = yield self.dbus.get_folders()
+        self._cancel_folders_reconcile()
+        return self._refreshers['folders'].refresh()
+
+    @defer.inlineCallbacks
+    def _refresh_folders(self):
+        """Get all the folders."""
+        self._take_patches('folders')
+        folders = yield self.dbus.get_folders()
+        self._set_folders(folders)
+
+    def _set_folders(self, folders):
+        """Set all the folders, and let the frontend know."""
+        self.folders = folders
+        self._folders_index.reset()
+        for folder, deleted in self._take_patches('folders'):
+            self._patch_folders(folder, deleted)
         self.on_folders_changed_callback(self.folders)
 
+    def _patch_folders(self, folder, deleted):
+        """Put or take out a folder from the list."""
+        if deleted:
+            self._folders_index.remove(self.folders, folder.volume)
+        else:
+            self._folders_index.put(self.folders, folder)
+
+    def on_sd_folder_changed(self, folder):
+        """A folder was created or (un)subscribed, patch the folders."""
+        logger.info("SD Folder changed: %r", folder.volume)
+        if self.folders is None:
+            # still don't have the folders, get all of them to not lose it
+            self.on_sd_folders_changed()
+            return
+
+        self._patch_folders(folder, False)
+        self._keep_patch('folders', (folder, False))
+        self._folders_patched()
+
+    def on_sd_folder_deleted(self, folder):
+        """A folder was deleted, patch the folders."""
+        logger.info("SD Folder deleted: %r", folder.volume)
+        if self.folders is None:
+            # still don't have the folders, get all of them to not lose it
+            self.on_sd_folders_changed()
+            return
+
+        self._patch_folders(folder, True)
+        self._keep_patch('folders', (folder, True))
+        self._folders_patched()
+
+    def _folders_patched(self):
+        """Let the frontend know, and get all the folders later."""
+        self.on_folders_changed_callback(self.folders)
+        if self._folders_reconcile_call is None:
+            self._folders_reconcile_call = reactor.callLater(
+                FOLDERS_RECONCILE_DELAY, self.on_sd_folders_changed)
+
+    def _cancel_folders_reconcile(self):
+        """Cancel the pending call to get all the folders, if any."""
+        call = self._folders_reconcile_call
+        self._folders_reconcile_call = None
+        if call is not None and call.active():
+            call.cancel()
+
+    def on_sd_circuit_changed(self, circuit):
+        """The circuit to SD opened or closed."""
+        logger.info("SD circuit changed to %s", circuit)
+        self.current_state.set(circuit=circuit)
+        self.on_circuit_changed_callback(circuit)
+        if circuit == CIRCUIT_CLOSED:
+            self._get_unavailable_data()
+
+    @defer.inlineCallbacks
+    def _get_unavailable_data(self):
+        """Ask again for the initial datasets that SD didn't answer.
+
+        Each one that is got now is sent to its ready callback; the ones
+        still unanswered are kept for the next time.
+        """
+        if self._initial_data_lock.locked or \
+                not self.initial_data_unavailable:
+            return
+        yield self._initial_data_lock.acquire()
+        try:
+            datasets = self._get_dataset_getters()
+            for name in datasets:
+                if name not in self.initial_data_unavailable:
+                    continue
+                logger.info("Asking again for the initial %s data", name)
+                d = defer.gatherResults([f() for f in datasets[name]],
+                                        consumeErrors=True)
+                d.addErrback(_first_error)
+                try:
+                    yield d
+                except UnresponsiveError, e:
+                    logger.warning("Initial %s data still unavailable: %s",
+                                   name, e)
+                    continue
+                self.initial_data_unavailable.discard(name)
+                if name == 'public_files':
+                    self.on_initial_online_data_ready_callback()
+                else:
+                    getattr(self, 'on_%s_ready_callback' % name)()
+        finally:
+            self._initial_data_lock.release()
+
     def on_sd_status_changed(self, *status_data):
         """The Status of SD changed.."""
         logger.info("SD Status changed")
         self._send_status_changed(*status_data)
 
+        # SD is answering, get what it didn't answer before
+        self._get_unavailable_data()
+
     def _send_status_changed(self, name, description, is_error, is_connected,
                              is_online, queues, connection):
         """Send status changed signal."""
@@ -342,54 +1182,148 @@ class SyncDaemon(object):
         """A command was added to the Request Queue."""
         logger.info("Queue content: added %r [%s] %s", op_name, op_id, op_data)
         r = self.queue_content.add(op_name, op_id, op_data)
-        if r == NODE_OP:
-            self.on_node_ops_changed_callback(self.queue_content.node_ops)
-        elif r == INTERNAL_OP:
-            self.on_internal_ops_changed_callback(
-                self.queue_content.internal_ops)
-        self.transfers_poller.run(self.queue_content.transferring)
+        self._queue_changes.add(r)
+        self.queue_coalescer.signal()
+        self._invalidate_metadata(op_data)
 
     def on_sd_queue_removed(self, op_name, op_id, op_data):
         """A command was removed from the Request Queue."""
         logger.info("Queue content: removed %r [%s] %s",
                     op_name, op_id, op_data)
         r = self.queue_content.remove(op_name, op_id, op_data)
-        if r == NODE_OP:
+        self._queue_changes.add(r)
+        self.queue_coalescer.signal()
+        self._invalidate_metadata(op_data)
+
+    def _invalidate_metadata(self, op_data):
+        """Forget the metadata of the paths touched by an operation."""
+        for field in OP_DATA_FIELDS:
+            path = op_data.get(field)
+            if path:
+                self.metadata_cache.invalidate(path)
+
+    def _send_queue_changed(self):
+        """Let the frontend know what changed in the queue."""
+        changes = self._queue_changes
+        self._queue_changes = set()
+        if NODE_OP in changes:
             self.on_node_ops_changed_callback(self.queue_content.node_ops)
-        elif r == INTERNAL_OP:
+        if INTERNAL_OP in changes:
             self.on_internal_ops_changed_callback(
                 self.queue_content.internal_ops)
         self.transfers_poller.run(self.queue_content.transferring)
 
+    def subscribe_node_ops(self, callback):
+        """Subscribe to the changes in the node ops.
+
+        After each change the callback is called with the list of Delta
+        records, each one with the kind of change, the path of the node
+        (relative to the home root) and the node itself.
+        """
+        self._node_ops_subscribers.append(callback)
+        self.queue_content.on_deltas_callback = self._on_node_ops_deltas
+
+    def unsubscribe_node_ops(self, callback):
+        """Unsubscribe to the changes in the node ops."""
+        self._node_ops_subscribers.remove(callback)
+        if not self._node_ops_subscribers:
+            self.queue_content.on_deltas_callback = None
+
+    def _on_node_ops_deltas(self, deltas):
+        """Send the changes in the node ops to the subscribers."""
+        for callback in list(self._node_ops_subscribers):
+            callback(deltas)
+
+    def set_done_ops_retention(self, max_age=None, max_count=None):
+        """Set the retention policy for the done node ops.
+
+        The nodes that finished more than 'max_age' seconds ago, and the
+        oldest ones when there are more than 'max_count' done, are pruned
+        periodically. With both in None all are kept until cleared.
+        """
+        self.done_ops_max_age = max_age
+        self.done_ops_max_count = max_count
+        self.done_ops_poller.run(max_age is not None or max_count is not None)
+
+    def _prune_done_ops(self):
+        """Prune some of the done node ops, according to the policy."""
+        cleared = self.queue_content.prune(max_age=self.done_ops_max_age,
+                                           max_done=self.done_ops_max_count,
+                                           limit=DONE_OPS_PRUNE_LIMIT)
+        if cleared:
+            logger.debug("Pruned %d done nodes from the queue", cleared)
+            self.on_node_ops_changed_callback(self.queue_content.node_ops,
+                                              clear=True)
+
+    def _action_unanswered(self, failure, action):
+        """SD didn't answer an action; the status signals will tell."""
+        failure.trap(UnresponsiveError)
+        logger.warning("%s u1.SD unanswered: %s", action, failure.value)
+
     def start(self):
         """Start the SyncDaemon."""
         logger.info("Starting u1.SD")
         d = self.dbus.start()
+        d.addErrback(self._action_unanswered, "Starting")
         self._get_initial_data()
         return d
 
     def quit(self):
         """Stop the SyncDaemon and makes it quit."""
         logger.info("Stopping u1.SD")
-        return self.dbus.quit()
+        d = self.dbus.quit()
+        d.addErrback(self._action_unanswered, "Stopping")
+        return d
 
     def connect(self):
         """Tell the SyncDaemon that the user wants it to connect."""
         logger.info("Telling u1.SD to connect")
-        return self.dbus.connect()
+        d = self.dbus.connect()
+        d.addErrback(self._action_unanswered, "Connecting")
+        return d
 
     def disconnect(self):
         """Tell the SyncDaemon that the user wants it to disconnect."""
         logger.info("Telling u1.SD to disconnect")
-        return self.dbus.disconnect()
+        d = self.dbus.disconnect()
+        d.addErrback(self._action_unanswered, "Disconnecting")
+        return d
 
     @defer.inlineCallbacks
     def get_metadata(self, path):
-        """Get the metadata for given path."""
-        resp = yield self.dbus.get_metadata(os.path.realpath(path))
+        """Get the metadata for given path.
+
+        It's kept by real path, until some operation in the queue touches
+        the path, any of its parents, or anything below it. If SD doesn't
+        answer, METADATA_UNAVAILABLE is given (and not kept).
+        """
+        real_path = os.path.realpath(path)
+        cache = self.metadata_cache
+        result = cache.get(real_path)
+        if result is None:
+            cache.asking(real_path)
+            try:
+                resp = yield self.dbus.get_metadata(real_path)
+            except UnresponsiveError, e:
+                logger.warning("Getting metadata for %r failed: %s", path, e)
+                self.on_metadata_ready_callback(path, METADATA_UNAVAILABLE)
+                return
+            finally:
+                fresh = cache.answered(real_path)
+            result = self._process_metadata(resp)
+            if fresh:
+                cache.put(real_path, result)
+            found = "miss"
+        else:
+            found = "hit"
+        logger.debug("Metadata cache %s for %r (hit rate %.2f)",
+                     found, real_path, cache.hit_rate)
+        self.on_metadata_ready_callback(path, result)
+
+    def _process_metadata(self, resp):
+        """Process the raw metadata from SD."""
         if resp == NOT_SYNCHED_PATH:
-            self.on_metadata_ready_callback(path, resp)
-            return
+            return resp
 
         # have data! store it in raw, and process some
         result = dict(raw_result=resp)
@@ -398,7 +1332,7 @@ class SyncDaemon(object):
         if resp['stat'] == u'None':
             stat = None
         else:
-            items = re.match(".*\((.*)\)", resp['stat']).groups()[0]
+            items = STAT_RE.match(resp['stat']).groups()[0]
             items = [x.split("=") for x in items.split(", ")]
             stat = dict((a, int(b[:-1] if b[-1] == 'L' else b))
                         for a, b in items)
@@ -424,8 +1358,7 @@ class SyncDaemon(object):
         if processed_path.startswith(user.home):
             processed_path = "~" + processed_path[len(user.home):]
         result['path'] = processed_path
-
-        self.on_metadata_ready_callback(path, result)
+        return result
 
     @defer.inlineCallbacks
     def get_free_space(self, volume_id):
@@ -442,6 +1375,11 @@ class SyncDaemon(object):
                 logger.info("%s share %s finished with error: %s",
                             action_name, share_id, error)
                 self.on_share_op_error_callback(share_id, error)
+            elif failure.check(UnresponsiveError):
+                error = failure.value
+                logger.info("%s share %s unanswered: %s",
+                            action_name, share_id, error)
+                self.on_share_op_error_callback(share_id, error)
             else:
                 logger.error("Unexpected error when %s share %s: %s %s",
                              action_name.lower(), share_id,
@@ -483,6 +1421,11 @@ class SyncDaemon(object):
                             "(path=%r mail_address=%s share_name=%r "
                             "access_level=%s)", error, path, mail_address,
                             sh_name, access_level)
+            elif failure.check(UnresponsiveError):
+                logger.info("Sending share invitation unanswered: %s "
+                            "(path=%r mail_address=%s share_name=%r "
+                            "access_level=%s)", failure.value, path,
+                            mail_address, sh_name, access_level)
             else:
                 logger.error("Unexpected error when sending share invitation "
                              "%s %s (path=%r mail_address=%s share_name=%r "
@@ -508,7 +1451,7 @@ class SyncDaemon(object):
         """Generic folder operation."""
         try:
             result = yield operation(value)
-        except FolderOperationError, e:
+        except (FolderOperationError, UnresponsiveError), e:
             logger.info("%s folder (on %r) finished with error: %s",
                         op_name, value, e)
             self.on_folder_op_error_callback(e)
@@ -516,7 +1459,7 @@ class SyncDaemon(object):
             vol = result.volume
             path = result.path
             logger.info("%s folder ok: volume=%s path=%r", op_name, vol, path)
-            self.folders = yield self.dbus.get_folders()
+            yield self._refreshers['folders'].refresh()
 
     def create_folder(self, path):
         """Create a folder."""
@@ -542,7 +1485,7 @@ class SyncDaemon(object):
         """Set a file public or not."""
         try:
             result = yield self.dbus.change_public_access(path, is_public)
-        except StandardError, e:
+        except (StandardError, UnresponsiveError), e:
             logger.info("Change public access (on %r) finished with error: "
                         "%s (%s)", path, e.__class__.__name__, e)
             self.on_public_op_error_callback(e)
@@ -553,8 +1496,10 @@ class SyncDaemon(object):
 
     def on_sd_upload_progress(self, transfer):
         """Tell the GUI that an upload is progressing."""
+        self._signalled_transfers.add(transfer.path)
         self.on_transfers_callback([transfer])
 
     def on_sd_download_progress(self, transfer):
         """Tell the GUI that a download is progressing."""
+        self._signalled_transfers.add(transfer.path)
         self.on_transfers_callback([transfer])
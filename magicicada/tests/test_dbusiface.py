@@ -17,11 +17,12 @@
 
 """Tests for the DBus interce towards real syncdaemon."""
 
+import collections
 import logging
 
 import dbus
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial.unittest import TestCase as TwistedTestCase
 from ubuntuone.devtools.handlers import MementoHandler
 
@@ -121,6 +122,8 @@ class SafeTestCase(TwistedTestCase):
 
         self.patch(dbusiface, 'SessionBus', FakeSessionBus)
         self.patch(dbusiface, 'SyncDaemonTool', FakeSDTool)
+        self.clock = task.Clock()
+        self.patch(dbusiface, 'reactor', self.clock)
 
         self.fsd = FakeSyncDaemon()
         self.dbus = dbusiface.DBusInterface(self.fsd)
@@ -399,6 +402,9 @@ class QueueChangedTestCase(SafeTestCase):
 class DataProcessingFoldersTestCase(SafeTestCase):
     """Process Folders data before sending it to SyncDaemon."""
 
+    folder_info = dict(node_id='nid', path=u'pth', subscribed='True',
+                       suggested_path=u'sgp', type='UDF', volume_id='vid')
+
     @defer.inlineCallbacks
     def test_nodata(self):
         """Test get folders with no data."""
@@ -464,6 +470,39 @@ class DataProcessingFoldersTestCase(SafeTestCase):
         self.dbus._on_folder_unsubscribed(None)
         self.get_msd_called("on_sd_folders_changed")
 
+    def _check_folder_sent(self, name):
+        """Check the folder from the signal was sent to SD."""
+        (folder,) = self.get_msd_called(name)
+        expected = dbusiface.FolderData(node='nid', path=u'pth',
+                                        suggested_path=u'sgp',
+                                        subscribed=True, volume='vid')
+        self.assertEqual(folder, expected)
+
+    def test_folder_changed_from_created(self):
+        """The created folder is sent."""
+        self.dbus._on_folder_created(self.folder_info)
+        self._check_folder_sent("on_sd_folder_changed")
+
+    def test_folder_changed_from_subscribed(self):
+        """The subscribed folder is sent."""
+        self.dbus._on_folder_subscribed(self.folder_info)
+        self._check_folder_sent("on_sd_folder_changed")
+
+    def test_folder_changed_from_unsubscribed(self):
+        """The unsubscribed folder is sent."""
+        self.dbus._on_folder_unsubscribed(self.folder_info)
+        self._check_folder_sent("on_sd_folder_changed")
+
+    def test_folder_deleted(self):
+        """The deleted folder is sent."""
+        self.dbus._on_folder_deleted(self.folder_info)
+        self._check_folder_sent("on_sd_folder_deleted")
+
+    def test_folder_bad_data(self):
+        """Ask for all the folders if the signal data is not complete."""
+        self.dbus._on_folder_created(dict(path=u'pth'))
+        self.get_msd_called("on_sd_folders_changed")
+
 
 class DataProcessingMetadataTestCase(SafeTestCase):
     """Process Metadata data before sending it to SyncDaemon."""
@@ -598,6 +637,56 @@ class DataProcessingSharesTestCase(SafeTestCase):
         self.dbus._on_share_changed(None)
         self.get_msd_called("on_sd_shares_changed")
 
+    share_info = dict(accepted=u'True', access_level=u'View',
+                      free_bytes=u'123', name=u'foobar', node_id=u'node',
+                      other_username=u'johndoe', other_visible_name=u'John',
+                      path=u'path', volume_id=u'vol', type=u'Share',
+                      subscribed=u'')
+
+    def _check_share_sent(self, share, side):
+        """Check the share was sent with its side."""
+        self.assertEqual(share.volume_id, 'vol')
+        self.assertEqual(share.node_id, 'node')
+        self.assertEqual(share.free_bytes, 123)
+        self.assertEqual(share.subscribed, False)
+        self.assertEqual(side, dbusiface.SHARES_TO_ME)
+
+    def test_share_changed_sends_share(self):
+        """A changed share is sent with its side."""
+        self.dbus._on_share_changed(self.share_info)
+        share, side, deleted = self.get_msd_called("on_sd_share_changed")
+        self._check_share_sent(share, side)
+        self.assertFalse(deleted)
+
+    def test_share_created_sends_share(self):
+        """A created share is sent with its side."""
+        info = dict(self.share_info, type=u'Shared')
+        self.dbus._on_share_created(info)
+        share, side, deleted = self.get_msd_called("on_sd_share_changed")
+        self.assertEqual(share.name, 'foobar')
+        self.assertEqual(side, dbusiface.SHARES_TO_OTHERS)
+        self.assertFalse(deleted)
+
+    def test_share_deleted_sends_share(self):
+        """A deleted share is sent with its side, as deleted."""
+        self.dbus._on_share_deleted(self.share_info)
+        share, side, deleted = self.get_msd_called("on_sd_share_changed")
+        self._check_share_sent(share, side)
+        self.assertTrue(deleted)
+
+    def test_share_changed_unknown_type(self):
+        """A share which side is not known makes all of them be asked."""
+        self.dbus._on_share_changed(dict(self.share_info, type=u'UDF'))
+        self.get_msd_called("on_sd_shares_changed")
+
+    def test_share_changed_bad_data(self):
+        """A share with missing data makes all of them be asked."""
+        info = dict(self.share_info)
+        del info['free_bytes']
+        self.dbus._on_share_changed(info)
+        self.get_msd_called("on_sd_shares_changed")
+        self.assertTrue(self.handler.check_warning("Bad share data"))
+
     @defer.inlineCallbacks
     def test_with_no_free_bytes(self):
         """Test get shares to me with no free bytes."""
@@ -1009,6 +1098,15 @@ class LogsTestCase(SafeTestCase):
 class RetryDecoratorTestCase(TwistedTestCase):
     """Test the retry decorator."""
 
+    def setUp(self):
+        """Set up."""
+        self.clock = task.Clock()
+        self.patch(dbusiface, 'reactor', self.clock)
+        self.patch(dbusiface, 'retry_budget', dbusiface.RetryBudget(100, 1))
+        self.patch(dbusiface, 'retry_stats',
+                   collections.defaultdict(collections.Counter))
+        self.delays = []
+
     class Helper(object):
         """Fail some times, finally succeed."""
 
@@ -1048,16 +1146,26 @@ class RetryDecoratorTestCase(TwistedTestCase):
             name='org.freedesktop.DBus.Error.NoReply')
         self.assertTrue(dbusiface._is_retry_exception(err))
 
-    def get_decorated_func(self, func):
+    def get_decorated_func(self, func, policy=None):
         """Execute the test calling the received function."""
 
-        @dbusiface.retryable
+        @dbusiface.retryable(policy=policy)
         def f():
             """Test func."""
             d = func()
             return d
 
-        return f
+        def call():
+            """Call, letting the time pass for all the retries."""
+            d = f()
+            while self.clock.getDelayedCalls():
+                (delayed,) = self.clock.getDelayedCalls()
+                delay = delayed.getTime() - self.clock.seconds()
+                self.delays.append(delay)
+                self.clock.advance(delay)
+            return d
+
+        return call
 
     def test_all_ok(self):
         """All ok."""
@@ -1113,6 +1221,613 @@ class RetryDecoratorTestCase(TwistedTestCase):
                        lambda _: deferred.callback(True))
         return deferred
 
+    def test_backoff(self):
+        """The retries wait more and more, up to the limit."""
+        policy = dbusiface.RetryPolicy(attempts=6, delay=1, max_delay=5,
+                                       backoff=2, jitter=0)
+        d = self.get_decorated_func(self.Helper(6), policy)()
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(self.delays, [1, 2, 4, 5, 5])
+
+    def test_jitter(self):
+        """The waits are moved randomly, inside the jitter."""
+        policy = dbusiface.RetryPolicy(attempts=30, delay=1, max_delay=1,
+                                       jitter=.5)
+        d = self.get_decorated_func(self.Helper(30), policy)()
+        self.successResultOf(d)
+        self.assertTrue(all(.5 <= x <= 1.5 for x in self.delays))
+        self.assertTrue(len(set(self.delays)) > 1)
+
+    def test_attempts(self):
+        """The policy limits how many times the call is done."""
+        policy = dbusiface.RetryPolicy(attempts=3)
+        helper = self.Helper(5)
+        d = self.get_decorated_func(helper, policy)()
+        self.failureResultOf(d, dbus.exceptions.DBusException)
+        self.assertEqual(helper.cant, 3)
+
+    def test_budget(self):
+        """The retries of all the calls are limited by the budget."""
+        self.patch(dbusiface, 'retry_budget', dbusiface.RetryBudget(3, .5))
+        policy = dbusiface.RetryPolicy(delay=0, jitter=0)
+        helper = self.Helper(10)
+        d = self.get_decorated_func(helper, policy)()
+        self.failureResultOf(d, dbus.exceptions.DBusException)
+        self.assertEqual(helper.cant, 4)
+
+        # the budget is recovered with time
+        self.clock.advance(2)
+        helper = self.Helper(2)
+        d = self.get_decorated_func(helper, policy)()
+        self.assertTrue(self.successResultOf(d))
+
+    def test_budget_refill_limit(self):
+        """The budget doesn't grow past its size."""
+        budget = dbusiface.RetryBudget(2, 1)
+        self.clock.advance(100)
+        self.assertTrue(budget.spend())
+        self.clock.advance(100)
+        self.assertEqual([budget.spend() for _ in range(3)],
+                         [True, True, False])
+
+    def test_stats(self):
+        """The retries are counted by method."""
+        self.get_decorated_func(self.Helper(3))()
+        policy = dbusiface.RetryPolicy(attempts=2)
+        d = self.get_decorated_func(self.Helper(5), policy)()
+        self.failureResultOf(d)
+        self.assertEqual(dbusiface.retry_stats['f'],
+                         dict(retried=3, exhausted=1))
+
+    def test_stats_denied(self):
+        """The retries denied by the budget are counted."""
+        self.patch(dbusiface, 'retry_budget', dbusiface.RetryBudget(0, 0))
+        d = self.get_decorated_func(self.Helper(2))()
+        self.failureResultOf(d)
+        self.assertEqual(dbusiface.retry_stats['f'], dict(denied=1))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_keeps_name(self):
+        """The decorated function keeps its name and doc."""
+        self.assertEqual(dbusiface.DBusInterface.get_status.__name__,
+                         'get_status')
+        self.assertEqual(dbusiface.DBusInterface.get_status.__doc__,
+                         "Get SD status.")
+
+    def test_policy_default(self):
+        """Without policy, the default one is used."""
+        policy = dbusiface.RetryPolicy(attempts=2)
+        self.patch(dbusiface, 'DEFAULT_RETRY_POLICY', policy)
+        helper = self.Helper(5)
+        self.failureResultOf(self.get_decorated_func(helper)())
+        self.assertEqual(helper.cant, 2)
+
+
+class SingleFlightTestCase(SafeTestCase):
+    """Test the sharing of the calls already running."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        """Set up."""
+        yield super(SingleFlightTestCase, self).setUp()
+        self.patch(dbusiface, 'single_flight_stats',
+                   collections.defaultdict(collections.Counter))
+        self.asked = []
+        self.dbus.sync_daemon_tool = self
+
+    def waiting(self):
+        """Fake SDT call, answered by the test."""
+        d = defer.Deferred()
+        self.asked.append(d)
+        return d
+
+    get_public_files = waiting
+
+    def test_concurrent_shared(self):
+        """The calls done while one is running share its result."""
+        ds = [self.dbus.get_queue_content() for _ in range(3)]
+        self.assertEqual(len(self.asked), 1)
+        self.asked.pop().callback(['content'])
+        for d in ds:
+            self.assertEqual(self.successResultOf(d), ['content'])
+
+    def test_own_deferreds(self):
+        """Each caller has its own deferred."""
+        d1 = self.dbus.get_queue_content()
+        d1.addCallback(lambda _: 'changed')
+        d2 = self.dbus.get_queue_content()
+        self.asked.pop().callback(['content'])
+        self.assertEqual(self.successResultOf(d1), 'changed')
+        self.assertEqual(self.successResultOf(d2), ['content'])
+
+    def test_sequential_not_shared(self):
+        """A call done after the previous one finished asks again."""
+        d1 = self.dbus.get_queue_content()
+        self.asked.pop().callback(['old'])
+        d2 = self.dbus.get_queue_content()
+        self.asked.pop().callback(['new'])
+        self.assertEqual(self.successResultOf(d1), ['old'])
+        self.assertEqual(self.successResultOf(d2), ['new'])
+
+    def test_error_shared(self):
+        """The error is given to all the callers."""
+        ds = [self.dbus.get_queue_content() for _ in range(2)]
+        self.asked.pop().errback(ValueError('foo'))
+        for d in ds:
+            self.failureResultOf(d, ValueError)
+        self.assertEqual(self.dbus._in_flight, {})
+
+    def test_synchronous_result(self):
+        """A call that finishes right away is not kept running."""
+        self.dbus.sync_daemon_tool = FakeSDTool(None)
+        self.fake_sdt_response('waiting', ['content'])
+        d = self.dbus.get_queue_content()
+        self.assertEqual(self.successResultOf(d), ['content'])
+        self.assertEqual(self.dbus._in_flight, {})
+
+    def test_by_arguments(self):
+        """Calls with different arguments are not shared."""
+
+        class Helper(object):
+            """Something with a decorated method."""
+            _in_flight = {}
+
+            @dbusiface.single_flight
+            def method(inner, arg):
+                """Decorated."""
+                return self.waiting()
+
+        helper = Helper()
+        helper.method(1)
+        helper.method(2)
+        helper.method(1)
+        self.assertEqual(len(self.asked), 2)
+
+    def test_stats(self):
+        """The shared and not shared calls are counted by method."""
+        for _ in range(3):
+            self.dbus.get_queue_content()
+        self.asked.pop().callback([])
+        self.dbus.get_queue_content()
+        self.assertEqual(dbusiface.single_flight_stats['get_queue_content'],
+                         dict(hit=2, miss=2))
+
+    def test_read_calls(self):
+        """The read calls are shared."""
+        for name in ('get_status', 'get_queue_content', 'get_folders',
+                     'get_shares_to_me', 'get_shares_to_others'):
+            self.dbus.sync_daemon_tool = FakeSDTool(None)
+            getattr(self.dbus, name)()
+            getattr(self.dbus, name)()
+            stats = dbusiface.single_flight_stats[name]
+            self.assertEqual(stats, dict(hit=1, miss=1), name)
+
+    def test_public_files(self):
+        """The public files asked while already asking are shared."""
+        d1 = self.dbus.get_public_files()
+        d2 = self.dbus.get_public_files()
+        self.assertEqual(len(self.asked), 1)
+        self.asked.pop().callback([])
+        self.assertEqual(self.successResultOf(d1), [])
+        self.assertEqual(self.successResultOf(d2), [])
+
+
+class DeadlineTestCase(SafeTestCase):
+    """Test the deadlines of the calls."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        """Set up."""
+        yield super(DeadlineTestCase, self).setUp()
+        self.patch(dbusiface, 'timeout_stats', collections.Counter())
+
+    def test_timeout(self):
+        """A call not finished in time fails with a timeout error."""
+        d = self.dbus.get_folders()
+        self.clock.advance(dbusiface.DEFAULT_CALL_TIMEOUT - 1)
+        self.assertFalse(d.called)
+        self.clock.advance(1)
+        failure = self.failureResultOf(d, dbusiface.CallTimeoutError)
+        self.assertEqual(failure.value.method, 'get_folders')
+        self.assertEqual(failure.value.timeout,
+                         dbusiface.DEFAULT_CALL_TIMEOUT)
+        self.assertTrue(self.handler.check_warning(
+            "Call to get_folders timed out"))
+
+    def test_in_time(self):
+        """A call finished in time is not affected."""
+        self.fake_sdt_response('waiting', ['content'])
+        d = self.dbus.get_queue_content()
+        self.assertEqual(self.successResultOf(d), ['content'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_finished_later_in_time(self):
+        """The deadline is forgotten when the call finishes."""
+        self.dbus.sync_daemon_tool = self
+        self.asked = defer.Deferred()
+        self.waiting = lambda: self.asked
+        d = self.dbus.get_queue_content()
+        self.clock.advance(1)
+        self.asked.callback(['content'])
+        self.assertEqual(self.successResultOf(d), ['content'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_late_answer_ignored(self):
+        """An answer after the deadline is ignored."""
+        self.dbus.sync_daemon_tool = self
+        self.asked = defer.Deferred()
+        self.waiting = lambda: self.asked
+        d = self.dbus.get_queue_content()
+        self.clock.advance(dbusiface.DEFAULT_CALL_TIMEOUT)
+        self.asked.callback(['content'])
+        self.failureResultOf(d, dbusiface.CallTimeoutError)
+
+    def test_timeout_by_method(self):
+        """Each method has its own time."""
+        self.assertEqual(self.dbus.call_timeouts['get_status'], 10)
+        self.dbus.call_timeouts['get_folders'] = 3
+        d = self.dbus.get_folders()
+        self.clock.advance(3)
+        self.failureResultOf(d, dbusiface.CallTimeoutError)
+
+    def test_no_timeout(self):
+        """A method without time waits forever."""
+        self.dbus.call_timeouts['get_folders'] = None
+        d = self.dbus.get_folders()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertFalse(d.called)
+
+    def test_shared_call(self):
+        """All the callers of a shared call get the timeout."""
+        ds = [self.dbus.get_folders() for _ in range(3)]
+        self.clock.advance(dbusiface.DEFAULT_CALL_TIMEOUT)
+        for d in ds:
+            self.failureResultOf(d, dbusiface.CallTimeoutError)
+        self.assertEqual(dbusiface.timeout_stats, dict(get_folders=1))
+
+    def test_stats(self):
+        """The timeouts are counted by method."""
+        ds = [self.dbus.get_folders()]
+        self.clock.advance(dbusiface.DEFAULT_CALL_TIMEOUT)
+        ds.extend([self.dbus.get_folders(), self.dbus.connect()])
+        self.clock.advance(dbusiface.DEFAULT_CALL_TIMEOUT)
+        for d in ds:
+            self.failureResultOf(d, dbusiface.CallTimeoutError)
+        self.assertEqual(dbusiface.timeout_stats,
+                         dict(get_folders=2, connect=1))
+
+    def test_operations(self):
+        """The user operations have a deadline too."""
+        d = self.dbus.accept_share('share_id')
+        self.clock.advance(dbusiface.DEFAULT_CALL_TIMEOUT)
+        self.failureResultOf(d, dbusiface.CallTimeoutError)
+        self.assertEqual(dbusiface.timeout_stats, dict(accept_share=1))
+
+
+class CallSchedulerTestCase(TwistedTestCase):
+    """Test the scheduler of the calls."""
+
+    def setUp(self):
+        """Set up."""
+        self.clock = task.Clock()
+        self.patch(dbusiface, 'reactor', self.clock)
+        self.scheduler = dbusiface.CallScheduler(2)
+        self.started = []
+
+    def _call(self, name, priority=dbusiface.PRIORITY_NORMAL):
+        """Schedule a fake call that finishes when told so."""
+        asked = defer.Deferred()
+
+        def func(*args):
+            """Fake call."""
+            self.started.append((name,) + args)
+            return asked
+
+        d = self.scheduler.run(priority, name, func, len(self.started))
+        return d, asked
+
+    def test_right_away(self):
+        """The calls start right away if there's room."""
+        d, asked = self._call('foo')
+        self.assertEqual(self.started, [('foo', 0)])
+        asked.callback('result')
+        self.assertEqual(self.successResultOf(d), 'result')
+        self.assertEqual(self.scheduler.in_flight, 0)
+
+    def test_failure(self):
+        """The failures get to the caller, and make room too."""
+        d, asked = self._call('foo')
+        asked.errback(ValueError('foo'))
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(self.scheduler.in_flight, 0)
+
+    def test_cap(self):
+        """Only some calls run at the same time."""
+        _, asked = self._call('foo')
+        self._call('bar')
+        self._call('baz')
+        self.assertEqual([c[0] for c in self.started], ['foo', 'bar'])
+        asked.callback(None)
+        self.assertEqual(self.scheduler.in_flight, 1)
+        self.clock.advance(0)
+        self.assertEqual([c[0] for c in self.started], ['foo', 'bar', 'baz'])
+        self.assertEqual(self.scheduler.in_flight, 2)
+
+    def test_priority(self):
+        """The calls of higher priority go first."""
+        _, asked = self._call('foo')
+        self._call('bar')
+        self._call('back', dbusiface.PRIORITY_BACKGROUND)
+        self._call('norm')
+        self._call('inter', dbusiface.PRIORITY_INTERACTIVE)
+        asked.callback(None)
+        self.clock.advance(0)
+        self.assertEqual(self.started[-1][0], 'inter')
+
+    def test_reserved(self):
+        """Some slots are only for the interactive calls."""
+        self.scheduler = dbusiface.CallScheduler(3, 1)
+        self._call('foo')
+        self._call('bar', dbusiface.PRIORITY_BACKGROUND)
+        self._call('baz')
+        self.assertEqual([c[0] for c in self.started], ['foo', 'bar'])
+        self._call('inter', dbusiface.PRIORITY_INTERACTIVE)
+        self.assertEqual([c[0] for c in self.started],
+                         ['foo', 'bar', 'inter'])
+
+    def test_reserved_not_only(self):
+        """The interactive calls can use all the slots."""
+        self.scheduler = dbusiface.CallScheduler(2, 1)
+        self._call('foo', dbusiface.PRIORITY_INTERACTIVE)
+        self._call('bar', dbusiface.PRIORITY_INTERACTIVE)
+        self.assertEqual(self.scheduler.in_flight, 2)
+
+    def test_fair(self):
+        """Inside a priority class, the methods take turns."""
+        _, asked = self._call('first')
+        self._call('second')
+        queued = [self._call(name) for name in ('foo', 'foo', 'foo', 'bar')]
+        asked.callback(None)
+        for _, asked in queued:
+            asked.callback(None)
+        self.clock.advance(0)
+        started = [c[0] for c in self.started[2:]]
+        self.assertEqual(started, ['foo', 'bar', 'foo', 'foo'])
+
+    def test_cancel_queued(self):
+        """A cancelled call is taken out of its queue."""
+        _, asked = self._call('foo')
+        self._call('bar')
+        d, _ = self._call('baz')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        asked.callback(None)
+        self.assertEqual([c[0] for c in self.started], ['foo', 'bar'])
+        self.assertEqual(self.scheduler.in_flight, 1)
+
+    def test_cancel_running(self):
+        """A cancelled running call is cancelled, and makes room."""
+        d, asked = self._call('foo')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertTrue(asked.called)
+        self.assertEqual(self.scheduler.in_flight, 0)
+
+
+class SchedulingTestCase(SafeTestCase):
+    """Test that the calls go through the scheduler."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        """Set up."""
+        yield super(SchedulingTestCase, self).setUp()
+        self.dbus.scheduler = dbusiface.CallScheduler(1)
+        self.dbus.sync_daemon_tool = self
+        self.started = []
+        self.asked = defer.Deferred()
+
+    def waiting(self):
+        """Fake queue content."""
+        self.started.append('waiting')
+        return self.asked
+
+    def get_folders(self):
+        """Fake folders."""
+        self.started.append('get_folders')
+        return defer.Deferred()
+
+    def get_metadata(self, path):
+        """Fake metadata."""
+        self.started.append('get_metadata')
+        return defer.Deferred()
+
+    def test_priorities(self):
+        """The interactive calls go before the rest."""
+        self.assertEqual(self.dbus.call_priorities['get_metadata'],
+                         dbusiface.PRIORITY_INTERACTIVE)
+        self.assertEqual(self.dbus.call_priorities['get_current_uploads'],
+                         dbusiface.PRIORITY_BACKGROUND)
+        self.assertNotIn('get_folders', self.dbus.call_priorities)
+
+    def test_interactive_first(self):
+        """An interactive call jumps ahead of the waiting ones."""
+        self.dbus.get_queue_content()
+        self.dbus.get_folders()
+        self.dbus.get_metadata('path')
+        self.assertEqual(self.started, ['waiting'])
+        self.asked.callback([])
+        self.clock.advance(0)
+        self.assertEqual(self.started, ['waiting', 'get_metadata'])
+
+    def test_deadline_while_waiting(self):
+        """The time waiting for the turn counts for the deadline."""
+        self.dbus.call_timeouts['get_folders'] = 5
+        self.dbus.get_queue_content()
+        d = self.dbus.get_folders()
+        self.clock.advance(5)
+        self.failureResultOf(d, dbusiface.CallTimeoutError)
+        self.assertEqual(self.started, ['waiting'])
+
+    def test_expired_not_sent(self):
+        """A call that expires when a slot is freed is not sent."""
+        self.dbus.call_timeouts['get_queue_content'] = 5
+        self.dbus.call_timeouts['get_folders'] = 5
+        running = self.dbus.get_queue_content()
+        d = self.dbus.get_folders()
+        self.clock.advance(5)
+        self.failureResultOf(running, dbusiface.CallTimeoutError)
+        self.failureResultOf(d, dbusiface.CallTimeoutError)
+        self.assertEqual(self.started, ['waiting'])
+        self.assertEqual(self.dbus.scheduler.in_flight, 0)
+
+    def test_retry_frees_the_slot(self):
+        """A call waiting to retry doesn't hold a slot meanwhile."""
+        self.patch(dbusiface, 'retry_budget', dbusiface.RetryBudget(20, 1))
+        error = dbus.exceptions.DBusException(
+            name='org.freedesktop.DBus.Error.NoReply')
+
+        def get_folders():
+            """Fake folders, without answer."""
+            self.started.append('get_folders')
+            return defer.fail(error)
+
+        self.patch(self, 'get_folders', get_folders)
+        self.dbus.get_folders()
+        self.dbus.get_metadata('path')
+        self.assertEqual(self.started, ['get_folders', 'get_metadata'])
+
+        # the retry waits for its turn again
+        self.clock.advance(dbusiface.DEFAULT_RETRY_POLICY.max_delay)
+        self.assertEqual(self.started, ['get_folders', 'get_metadata'])
+
+
+class CircuitBreakerTestCase(SafeTestCase):
+    """Test the circuit breaker around the calls."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        """Set up."""
+        yield super(CircuitBreakerTestCase, self).setUp()
+        self.patch(dbusiface, 'timeout_stats', collections.Counter())
+        self.dbus.sync_daemon_tool = self
+        self.asked = []
+        self.status = defer.Deferred()
+
+    def waiting(self):
+        """Fake call that never finishes, unless told so."""
+        d = defer.Deferred()
+        self.asked.append(d)
+        return d
+
+    def get_status(self):
+        """Fake status, for the probe."""
+        return self.status
+
+    def _fail_calls(self, quantity):
+        """Make some calls that time out."""
+        for _ in range(quantity):
+            d = self.dbus.get_queue_content()
+            self.clock.advance(dbusiface.DEFAULT_CALL_TIMEOUT)
+            self.failureResultOf(d, dbusiface.CallTimeoutError)
+
+    def _open(self):
+        """Open the circuit."""
+        self._fail_calls(dbusiface.CIRCUIT_MAX_FAILURES)
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_OPEN)
+
+    def test_closed(self):
+        """The circuit starts closed."""
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_CLOSED)
+
+    def test_opens(self):
+        """The circuit opens after the failures in a row, and tells."""
+        self._fail_calls(dbusiface.CIRCUIT_MAX_FAILURES - 1)
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_CLOSED)
+        self._fail_calls(1)
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_OPEN)
+        args = self.get_msd_called('on_sd_circuit_changed')
+        self.assertEqual(args, (dbusiface.CIRCUIT_OPEN,))
+        self.assertTrue(self.handler.check_warning("Circuit to syncdaemon",
+                                                   dbusiface.CIRCUIT_OPEN))
+
+    def test_no_reply_counts(self):
+        """Calls without reply also count as failures."""
+        self.patch(dbusiface, 'retry_budget', dbusiface.RetryBudget(0, 0))
+        error = dbus.exceptions.DBusException(
+            name='org.freedesktop.DBus.Error.NoReply')
+        self.waiting = lambda: defer.fail(error)
+        for _ in range(dbusiface.CIRCUIT_MAX_FAILURES):
+            d = self.dbus.get_queue_content()
+            self.failureResultOf(d, dbus.exceptions.DBusException)
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_OPEN)
+
+    def test_answers_reset(self):
+        """Any answer, even an error, resets the failures."""
+        self._fail_calls(dbusiface.CIRCUIT_MAX_FAILURES - 1)
+        self.waiting = lambda: defer.fail(ValueError('foo'))
+        self.failureResultOf(self.dbus.get_queue_content(), ValueError)
+        del self.waiting
+        self._fail_calls(dbusiface.CIRCUIT_MAX_FAILURES - 1)
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_CLOSED)
+
+    def test_open_short_circuits(self):
+        """While open, the calls fail without going to syncdaemon."""
+        self._open()
+        self.asked = []
+        d = self.dbus.get_queue_content()
+        failure = self.failureResultOf(d, dbusiface.CircuitOpenError)
+        self.assertEqual(failure.value.method, 'get_queue_content')
+        self.assertTrue(isinstance(failure.value,
+                                   dbusiface.UnresponsiveError))
+        self.assertEqual(self.asked, [])
+
+    def test_start_not_guarded(self):
+        """Starting and quitting syncdaemon are always tried."""
+        self._open()
+        self.dbus.sync_daemon_tool = FakeSDTool(None)
+        self.dbus.start()
+        self.check_sdt_called('start')
+        self.dbus.quit()
+        self.check_sdt_called('quit')
+
+    def test_probe_closes(self):
+        """After a while the status is asked, and if answered it closes."""
+        self._open()
+        self.clock.advance(dbusiface.CIRCUIT_RESET_TIMEOUT)
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_HALF_OPEN)
+
+        # only the probe goes to syncdaemon while half open
+        self.asked = []
+        d = self.dbus.get_queue_content()
+        self.failureResultOf(d, dbusiface.CircuitOpenError)
+        self.assertEqual(self.asked, [])
+
+        self.status.callback({'name': 'READY'})
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_CLOSED)
+        args = self.get_msd_called('on_sd_circuit_changed')
+        self.assertEqual(args, (dbusiface.CIRCUIT_CLOSED,))
+        self.dbus.get_queue_content()
+        self.assertEqual(len(self.asked), 1)
+
+    def test_probe_fails(self):
+        """If the probe is not answered, it opens again for a while."""
+        self._open()
+        self.clock.advance(dbusiface.CIRCUIT_RESET_TIMEOUT)
+        self.clock.advance(self.dbus.call_timeouts['_probe_status'])
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_OPEN)
+
+        # next probe is answered
+        self.status = defer.succeed({'name': 'READY'})
+        self.clock.advance(dbusiface.CIRCUIT_RESET_TIMEOUT)
+        self.assertEqual(self.dbus.circuit.state, dbusiface.CIRCUIT_CLOSED)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_shutdown(self):
+        """Shutting down forgets the pending probe."""
+        self._open()
+        self.dbus.shutdown()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
 
 class HandlingSharesTestCase(SafeTestCase):
     """Handle shares."""
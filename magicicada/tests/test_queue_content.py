@@ -14,12 +14,20 @@
 
 """Tests for the QueueContent structure."""
 
+import gc
 import logging
+import sys
+import time
 import unittest
 
 from ubuntuone.devtools.handlers import MementoHandler
 
 from magicicada.queue_content import (
+    DELTA_CREATED,
+    DELTA_DONE,
+    DELTA_OPS_CHANGED,
+    DELTA_REMOVED,
+    DONE,
     KIND_DIR,
     KIND_FILE,
     KIND_UNKNOWN,
@@ -28,6 +36,9 @@ from magicicada.queue_content import (
     ACTION_REMOVED,
     NODE_OP,
     INTERNAL_OP,
+    INTERNAL_OPS_CAPACITY,
+    Node,
+    Operation,
     QueueContent,
 )
 
@@ -97,14 +108,85 @@ class TwoStructuresTestCase(unittest.TestCase):
         self.assertTrue(self.qc._node_ops)
         self.assertTrue(self.qc.internal_ops)
 
+    def _dump(self, children):
+        """Return the tree structure, without the timestamps."""
+        return dict((name, (node.kind, node.done, node.pending,
+                            list(node.operations), self._dump(node.children)))
+                    for name, node in children.items())
+
     def test_set_is_several_adds(self):
-        """Check that one set are several adds."""
-        called = []
-        self.qc.add = lambda *a: called.append(a)
-        self.qc.set_content([('MakeFile', '123', {'path': 'foo'}),
-                             ('ListShares', '456', {})])
-        self.assertTrue(called[0], ('MakeFile', '123', {'path': 'foo'}))
-        self.assertTrue(called[1], ('ListShares', '456', {}))
+        """Check that one set is the same than several adds."""
+        data = [('MakeFile', '1', {'path': '/a/b/c/foo'}),
+                ('Upload', '2', {'path': '/a/b/c/foo'}),
+                ('ListShares', '3', {}),
+                ('MakeFile', '4', {'path': '/a/b/c/bar'}),
+                ('Unlink', '5', {'path': '/a/b/x'}),
+                ('MakeFile', '6', {'path': '/a/b/x/y'}),
+                ('MakeDir', '7', {'path': '/a/b/z'}),
+                ('Move', '8', {'path_from': '/a/b/c', 'path_to': '/a/b/d'}),
+                ('Download', '9', {'path': '/a/b/c/bar'}),
+                ('GetDelta', '10', {})]
+        other = QueueContent(home='/a/b')
+        for op_info in data:
+            other.add(*op_info)
+        self.qc.set_content(data)
+
+        self.assertEqual(self._dump(self.qc._node_ops),
+                         self._dump(other._node_ops))
+        self.assertEqual(sorted(self.qc._node_index),
+                         sorted(other._node_index))
+        self.assertEqual(sorted(self.qc._pending_ops),
+                         sorted(other._pending_ops))
+        self.assertEqual(self.qc._transferring, other._transferring)
+        self.assertEqual([op.op_id for op in self.qc.internal_ops],
+                         [op.op_id for op in other.internal_ops])
+
+    def test_set_skips_pending(self):
+        """The operations already added are not added again when set."""
+        op_info = ('Upload', '1', {'path': '/a/b/foo'})
+        self.qc.add(*op_info)
+        self.qc.set_content([op_info, ('MakeFile', '2', {'path': '/a/b/foo'})])
+        node = self.qc._node_index['/foo']
+        self.assertEqual(node.pending, 2)
+        self.assertEqual(len(node.operations), 2)
+
+        self.qc.remove(*op_info)
+        self.qc.remove('MakeFile', '2', {'path': '/a/b/foo'})
+        self.assertTrue(node.done)
+        self.assertEqual(node.pending, 0)
+        self.assertEqual(self.qc._pending_ops, {})
+
+    def test_set_one_timestamp(self):
+        """All the ops in one set share the same timestamp."""
+        self.qc.set_content([('MakeFile', '1', {'path': '/a/b/c/foo'}),
+                             ('MakeFile', '2', {'path': '/a/b/d/bar'}),
+                             ('ListShares', '3', {})])
+        node_c = self.qc._node_index['/c']
+        node_d = self.qc._node_index['/d']
+        timestamp = node_c.children['foo'].last_modified
+        self.assertTrue(isinstance(timestamp, float))
+        self.assertEqual(node_d.children['bar'].last_modified, timestamp)
+        self.assertEqual(self.qc.internal_ops[0].timestamp, timestamp)
+
+    def test_set_restores_gc(self):
+        """The garbage collector is enabled again after setting."""
+        self.qc.set_content([('MakeFile', '1', {'path': '/a/b/foo'})])
+        self.assertTrue(gc.isenabled())
+
+    def test_set_restores_gc_on_error(self):
+        """The garbage collector is enabled again even on errors."""
+        self.assertRaises(KeyError, self.qc.set_content,
+                          [('MakeFile', '1', {'nopath': '/a/b/foo'})])
+        self.assertTrue(gc.isenabled())
+
+    def test_set_after_remove(self):
+        """Setting over done nodes restarts them, as adding."""
+        self.qc.add('MakeFile', '1', {'path': '/a/b/foo'})
+        self.qc.remove('MakeFile', '1', {'path': '/a/b/foo'})
+        self.qc.set_content([('Upload', '2', {'path': '/a/b/foo'})])
+        node = self.qc._node_index['/foo']
+        self.assertEqual(node.done, False)
+        self.assertEqual([op[0] for op in node.operations], ['2'])
 
     def test_add_one_node(self):
         """Add one node op."""
@@ -401,8 +483,7 @@ class NodeStructureTestCase(unittest.TestCase):
         # create a node and break it on purpose
         self.qc.add('MakeDir', '12', {'path': '/a'})
         self.assertEqual(len(self.qc._node_ops), 1)
-        node = self.qc._node_ops[''].children['a']
-        node.operations = []
+        self.qc._pending_ops.clear()
 
         # remove the operation and check
         r = self.qc.remove('MakeDir', '12', {'path': '/a'})
@@ -415,8 +496,7 @@ class NodeStructureTestCase(unittest.TestCase):
         # create a node and break it on purpose
         self.qc.add('MakeDir', '12', {'path': '/a'})
         self.assertEqual(len(self.qc._node_ops), 1)
-        node = self.qc._node_ops[''].children['a']
-        node.operations = node.operations * 2
+        self.qc._pending_ops['12'] *= 2
 
         # remove the operation and check
         r = self.qc.remove('MakeDir', '12', {'path': '/a'})
@@ -614,6 +694,221 @@ class NodeStructureTestCase(unittest.TestCase):
         self.assertTrue(node.done)
 
 
+class NodeIndexTestCase(unittest.TestCase):
+    """Tests for the flat index of nodes by path."""
+
+    def setUp(self):
+        """Set up the test."""
+        self.qc = QueueContent(home='/')
+
+    def test_empty(self):
+        """Nothing indexed at start."""
+        self.assertEqual(self.qc._node_index, {})
+
+    def test_add_indexes_all_nodes(self):
+        """All the nodes, including the ones in the middle, are indexed."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b/foo'})
+        root = self.qc._node_ops['']
+        node_a = root.children['a']
+        node_b = node_a.children['b']
+        node_foo = node_b.children['foo']
+        self.assertEqual(self.qc._node_index, {'': root, '/a': node_a,
+                                               '/a/b': node_b,
+                                               '/a/b/foo': node_foo})
+
+    def test_add_reuses_intermediate(self):
+        """A node added below an existing one hangs from it."""
+        self.qc.add('MakeDir', '12', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/a/b/c/d'})
+        node_b = self.qc._node_index['/a/b']
+        self.assertIs(self.qc._node_index['/a/b/c'].parent, node_b)
+        self.assertIs(node_b.children['c'], self.qc._node_index['/a/b/c'])
+        self.assertEqual(len(self.qc._node_index), 5)
+
+    def test_add_same_path(self):
+        """Adding to the same path uses the same node."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.qc.add('Upload', '34', {'path': '/a'})
+        node = self.qc._node_index['/a']
+        self.assertEqual(len(node.operations), 2)
+        self.assertEqual(len(self.qc._node_index), 2)
+
+    def test_remove_uses_index(self):
+        """The finished node is found through the index."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.remove('MakeFile', '12', {'path': '/a/b'})
+        self.assertTrue(self.qc._node_index['/a/b'].done)
+
+    def test_remove_missing_in_the_middle(self):
+        """Report the first element that is not there."""
+        handler = MementoHandler()
+        handler.setLevel(logging.DEBUG)
+        logger = logging.getLogger('magicicada.queue_content')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        r = self.qc.remove('MakeFile', '12', {'path': '/a/c/d'})
+        self.assertEqual(r, None)
+        self.assertTrue(handler.check_warning(
+                        "Element 'c'", "['', 'a', 'c', 'd']",
+                        'not in children'))
+
+    def test_clear_removes_from_index(self):
+        """Cleared nodes are not indexed anymore."""
+        self.qc.add('MakeDir', '12', {'path': '/a'})
+        self.qc.add('MakeFile', '23', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/c/d'})
+        self.qc.remove('MakeDir', '12', {'path': '/a'})
+        self.qc.remove('MakeFile', '34', {'path': '/c/d'})
+        self.qc.clear()
+        self.assertEqual(sorted(self.qc._node_index), ['', '/a', '/a/b'])
+
+    def test_clear_all(self):
+        """Index is empty after clearing everything."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.remove('MakeFile', '12', {'path': '/a/b'})
+        self.qc.clear()
+        self.assertEqual(self.qc._node_index, {})
+
+    def test_add_after_clear(self):
+        """Nodes are created again after being cleared."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.remove('MakeFile', '12', {'path': '/a/b'})
+        self.qc.clear()
+        self.qc.add('MakeFile', '34', {'path': '/a/b'})
+        node = self.qc._node_ops[''].children['a'].children['b']
+        self.assertIs(self.qc._node_index['/a/b'], node)
+
+
+class PendingOperationsTestCase(unittest.TestCase):
+    """Tests for the pending operations index and counters."""
+
+    def setUp(self):
+        """Set up the test."""
+        self.qc = QueueContent(home='/')
+
+    def test_add_counts_pending(self):
+        """Each added op is pending in its node."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.qc.add('Upload', '34', {'path': '/a'})
+        node = self.qc._node_index['/a']
+        self.assertEqual(node.pending, 2)
+        self.assertEqual(self.qc._node_index[''].pending, 0)
+        self.assertEqual(sorted(self.qc._pending_ops), ['12', '34'])
+
+    def test_remove_discounts_pending(self):
+        """Finished ops are not pending anymore."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.qc.add('Upload', '34', {'path': '/a'})
+        self.qc.remove('MakeFile', '12', {'path': '/a'})
+        node = self.qc._node_index['/a']
+        self.assertEqual(node.pending, 1)
+        self.assertFalse(node.done)
+        self.assertEqual(list(self.qc._pending_ops), ['34'])
+
+        self.qc.remove('Upload', '34', {'path': '/a'})
+        self.assertEqual(node.pending, 0)
+        self.assertTrue(node.done)
+        self.assertEqual(self.qc._pending_ops, {})
+
+    def test_restart_after_done(self):
+        """A node that was done starts counting again."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.qc.remove('MakeFile', '12', {'path': '/a'})
+        self.qc.add('Upload', '34', {'path': '/a'})
+        node = self.qc._node_index['/a']
+        self.assertEqual(node.pending, 1)
+        self.assertFalse(node.done)
+
+    def test_same_id_other_node(self):
+        """The op is only finished in the node of the given path."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        r = self.qc.remove('MakeFile', '12', {'path': '/b'})
+        self.assertEqual(r, None)
+        self.assertEqual(self.qc._node_index['/a'].pending, 1)
+        self.assertIn('12', self.qc._pending_ops)
+
+    def test_many_ops_one_node(self):
+        """Lots of ops in the same node."""
+        for i in range(100):
+            self.qc.add('Upload', str(i), {'path': '/a'})
+        for i in range(99):
+            self.qc.remove('Upload', str(i), {'path': '/a'})
+        node = self.qc._node_index['/a']
+        self.assertEqual(node.pending, 1)
+        self.assertFalse(node.done)
+        self.qc.remove('Upload', '99', {'path': '/a'})
+        self.assertTrue(node.done)
+
+
+class OperationTestCase(unittest.TestCase):
+    """Tests for the operation record."""
+
+    def test_as_tuple(self):
+        """It's accessed as the old tuple."""
+        op = Operation('12', 'Upload', {'path': '/a'})
+        self.assertEqual(op[0], '12')
+        self.assertEqual(op[1], 'Upload')
+        self.assertEqual(op[2], {'path': '/a', DONE: False})
+        self.assertEqual(op[2]['path'], '/a')
+        self.assertEqual(len(op), 3)
+        self.assertEqual(op, ('12', 'Upload', {'path': '/a', DONE: False}))
+
+    def test_done(self):
+        """The done flag is part of the data."""
+        op = Operation('12', 'Upload', {'path': '/a'})
+        op.done = True
+        self.assertTrue(op[2][DONE])
+        self.assertEqual(op, ('12', 'Upload', {'path': '/a', DONE: True}))
+
+    def test_data_built_once(self):
+        """The data is built when asked, and kept until done changes."""
+        op = Operation('12', 'Upload', {'path': '/a'})
+        self.assertEqual(op[1], 'Upload')
+        self.assertIs(op._op_data, None)
+        op_data = op[2]
+        self.assertIs(op[2], op_data)
+        self.assertIs(op.op_data, op_data)
+        op.done = True
+        self.assertIsNot(op[2], op_data)
+        self.assertTrue(op[2][DONE])
+        self.assertEqual(op[-1], op[2])
+
+    def test_only_some_data_kept(self):
+        """Only the path fields are kept from the data."""
+        op = Operation('12', 'Move', {'path_from': '/a', 'path_to': '/b',
+                                      'share_id': 's', 'node_id': 'n'})
+        self.assertEqual(op[2], {'path_from': '/a', 'path_to': '/b',
+                                 DONE: False})
+
+    def test_data_not_shared(self):
+        """Changing the received data does not affect the operation."""
+        op_data = {'path': '/a'}
+        op = Operation('12', 'Upload', op_data)
+        op_data['path'] = '/b'
+        self.assertEqual(op[2]['path'], '/a')
+
+    def test_name_interned(self):
+        """The operation names are interned."""
+        op1 = Operation('12', ''.join(['Up', 'load']), {})
+        op2 = Operation('34', ''.join(['Up', 'load']), {})
+        self.assertIs(op1.op_name, op2.op_name)
+
+    def test_compare_other(self):
+        """It's not equal to other things."""
+        op = Operation('12', 'Upload', {})
+        self.assertNotEqual(op, None)
+        self.assertNotEqual(op, ('12', 'Upload', {DONE: True}))
+
+    def test_node_without_dict(self):
+        """Nodes and operations are slotted."""
+        node = Node('a', None, KIND_FILE)
+        self.assertFalse(hasattr(node, '__dict__'))
+        op = Operation('12', 'Upload', {})
+        self.assertFalse(hasattr(op, '__dict__'))
+
+
 class GetPathTestCase(unittest.TestCase):
     """Test how we get the path from the operation."""
 
@@ -748,6 +1043,502 @@ class ClearNodesTestCase(unittest.TestCase):
 
         self.assertNotIn('b', node_a.children)
 
+    def test_registry_on_done(self):
+        """Done nodes are registered."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/a/c'})
+        self.assertEqual(list(self.qc._done_nodes), [])
+        self.qc.remove('MakeFile', '12', {'path': '/a/b'})
+        self.assertEqual(list(self.qc._done_nodes),
+                         [self.qc._node_index['/a/b']])
+
+    def test_registry_on_restart(self):
+        """Nodes that start again are not done anymore."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.qc.remove('MakeFile', '12', {'path': '/a'})
+        self.qc.add('Upload', '34', {'path': '/a'})
+        self.assertEqual(list(self.qc._done_nodes), [])
+        self.qc.clear()
+        self.assertIn('a', self.qc._node_ops[''].children)
+
+    def test_registry_emptied(self):
+        """The registry is empty after clearing."""
+        self.qc.add('MakeDir', '12', {'path': '/a'})
+        self.qc.add('MakeFile', '23', {'path': '/a/b'})
+        self.qc.remove('MakeDir', '12', {'path': '/a'})
+        self.qc.clear()
+        self.assertEqual(list(self.qc._done_nodes), [])
+
+    def test_only_done_nodes_visited(self):
+        """The nodes that are not done are not visited at all."""
+        for i in range(50):
+            self.qc.add('MakeFile', str(i), {'path': '/a/f%d' % i})
+        self.qc.remove('MakeFile', '7', {'path': '/a/f7'})
+        visited = []
+        original = self.qc._get_node_path
+        self.qc._get_node_path = lambda n: visited.append(n) or original(n)
+        self.qc.clear()
+        self.assertEqual([n.name for n in visited], ['f7'])
+        self.assertEqual(len(self.qc._node_index['/a'].children), 49)
+
+    def test_done_parent_and_children(self):
+        """A done parent with all its children done is removed."""
+        self.qc.add('MakeDir', '12', {'path': '/a/b'})
+        self.qc.add('MakeFile', '23', {'path': '/a/b/c'})
+        self.qc.add('MakeFile', '34', {'path': '/a/b/d'})
+        self.qc.add('MakeFile', '45', {'path': '/x'})
+        self.qc.remove('MakeFile', '23', {'path': '/a/b/c'})
+        self.qc.remove('MakeDir', '12', {'path': '/a/b'})
+        self.qc.remove('MakeFile', '34', {'path': '/a/b/d'})
+        self.qc.clear()
+        self.assertEqual(list(self.qc._node_ops[''].children), ['x'])
+        self.assertEqual(sorted(self.qc._node_index), ['', '/x'])
+
+    def test_very_deep(self):
+        """Trees deeper than the recursion limit can be cleared."""
+        depth = sys.getrecursionlimit() + 100
+        path = '/d' * depth
+        self.qc.add('MakeDir', '12', {'path': path})
+        self.qc.remove('MakeDir', '12', {'path': path})
+        self.qc.clear()
+        self.assertFalse(self.qc._node_ops)
+        self.assertEqual(self.qc._node_index, {})
+
+
+class PruneNodesTestCase(unittest.TestCase):
+    """Prune the oldest done nodes."""
+
+    def setUp(self):
+        """Set up the test."""
+        self.qc = QueueContent(home='/')
+
+    def _done(self, name, timestamp):
+        """Add and finish a file, setting when it finished."""
+        path = '/' + name
+        self.qc.add('MakeFile', name, {'path': path})
+        self.qc.remove('MakeFile', name, {'path': path})
+        self.qc._node_index[path].last_modified = timestamp
+
+    def _names(self):
+        """Return the names of the nodes under the home."""
+        if not self.qc._node_ops:
+            return []
+        return sorted(self.qc._node_ops[''].children)
+
+    def test_no_policy(self):
+        """Nothing is pruned without limits."""
+        self._done('a', 0)
+        cleared = self.qc.prune()
+        self.assertEqual(cleared, 0)
+        self.assertEqual(self._names(), ['a'])
+
+    def test_by_age(self):
+        """The nodes that finished long ago are pruned."""
+        now = time.time()
+        self._done('a', now - 100)
+        self._done('b', now - 50)
+        self._done('c', now)
+        cleared = self.qc.prune(max_age=60)
+        self.assertEqual(cleared, 1)
+        self.assertEqual(self._names(), ['b', 'c'])
+
+    def test_by_count(self):
+        """The oldest nodes over the maximum are pruned."""
+        for name in 'abcd':
+            self._done(name, time.time())
+        cleared = self.qc.prune(max_done=1)
+        self.assertEqual(cleared, 3)
+        self.assertEqual(self._names(), ['d'])
+
+    def test_count_zero(self):
+        """No done nodes are kept with a maximum of zero."""
+        self._done('a', time.time())
+        self.qc.prune(max_done=0)
+        self.assertFalse(self.qc._node_ops)
+        self.assertEqual(list(self.qc._done_nodes), [])
+
+    def test_bounded(self):
+        """No more than the limit are pruned each time."""
+        for name in 'abcde':
+            self._done(name, 0)
+        cleared = self.qc.prune(max_age=60, limit=2)
+        self.assertEqual(cleared, 2)
+        self.assertEqual(self._names(), ['c', 'd', 'e'])
+        cleared = self.qc.prune(max_age=60, limit=2)
+        self.assertEqual(cleared, 2)
+        self.assertEqual(self._names(), ['e'])
+
+    def test_pending_not_pruned(self):
+        """The nodes not done are left alone."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self._done('b', 0)
+        self.qc.prune(max_age=60, max_done=0)
+        self.assertEqual(self._names(), ['a'])
+
+    def test_restarted_order(self):
+        """A node that finishes again is the newest one."""
+        self._done('a', time.time())
+        self._done('b', time.time())
+        self._done('a', time.time())
+        self.qc.prune(max_done=1)
+        self.assertEqual(self._names(), ['a'])
+
+    def test_done_with_children(self):
+        """A done node with children is just cleaned."""
+        self.qc.add('MakeDir', '12', {'path': '/a'})
+        self.qc.add('MakeFile', '34', {'path': '/a/b'})
+        self.qc.remove('MakeDir', '12', {'path': '/a'})
+        self.qc.prune(max_done=0)
+        node = self.qc._node_index['/a']
+        self.assertEqual(node.done, None)
+        self.assertEqual(node.operations, [])
+        self.assertIn('b', node.children)
+
+    def test_empty_parents_removed(self):
+        """The parents left empty are removed too."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b/c'})
+        self.qc.remove('MakeFile', '12', {'path': '/a/b/c'})
+        self.qc.prune(max_done=0)
+        self.assertFalse(self.qc._node_ops)
+        self.assertEqual(self.qc._node_index, {})
+
+    def test_parent_with_pending_op_kept(self):
+        """A parent with an operation of its own is not removed."""
+        self.qc.add('Upload', '12', {'path': '/dir/file'})
+        self.qc.add('Move', '34', {'path_from': '/dir', 'path_to': '/other'})
+        self.qc.remove('Upload', '12', {'path': '/dir/file'})
+        self.qc.prune(max_done=0)
+        node = self.qc._node_index['/dir']
+        self.assertFalse(node.done)
+        self.assertEqual(node.pending, 1)
+        self.assertEqual(node.children, {})
+        self.assertEqual(list(self.qc._pending_ops), ['34'])
+
+        # and it goes away as usual when its op finishes
+        self.qc.remove('Move', '34', {'path_from': '/dir',
+                                      'path_to': '/other'})
+        self.qc.prune(max_done=0)
+        self.assertEqual(self.qc._node_index, {})
+        self.assertEqual(self.qc._pending_ops, {})
+
+    def test_deltas(self):
+        """The removals are sent as changes."""
+        self._done('a', 0)
+        called = []
+        self.qc.on_deltas_callback = called.append
+        self.qc.prune(max_age=60)
+        kinds = [(d.kind, d.path) for d in called[0]]
+        self.assertIn((DELTA_REMOVED, '/a'), kinds)
+
+
+class SubtreeStatsTestCase(unittest.TestCase):
+    """The statistics of each subtree are kept up to date."""
+
+    def setUp(self):
+        """Set up the test."""
+        self.qc = QueueContent(home='/')
+
+    def _stats(self, path):
+        """Return the statistics of a node."""
+        node = self.qc._node_index[path]
+        return (node.subtree_pending, node.subtree_done, node.subtree_bytes)
+
+    def _walked_stats(self, node):
+        """Calculate the statistics walking the tree."""
+        pending = done = size = 0
+        for op in node.operations:
+            if op.done:
+                done += 1
+            else:
+                pending += 1
+                size += op.size
+        for child in node.children.values():
+            c_pending, c_done, c_size = self._walked_stats(child)
+            pending += c_pending
+            done += c_done
+            size += c_size
+        return pending, done, size
+
+    def _check_all(self):
+        """All the nodes have the same stats than walking the tree."""
+        for node in self.qc._node_index.values():
+            self.assertEqual(
+                (node.subtree_pending, node.subtree_done, node.subtree_bytes),
+                self._walked_stats(node))
+
+    def test_empty_node(self):
+        """A new node has no stats."""
+        node = Node('a', None, 'Dir')
+        self.assertEqual(node.subtree_pending, 0)
+        self.assertEqual(node.subtree_done, 0)
+        self.assertEqual(node.subtree_bytes, 0)
+
+    def test_operation_size(self):
+        """The size is taken from the operation data, if known."""
+        self.assertEqual(Operation('1', 'Upload',
+                                   {'deflated_size': '123'}).size, 123)
+        self.assertEqual(Operation('1', 'Upload', {}).size, 0)
+        self.assertEqual(Operation('1', 'Upload',
+                                   {'deflated_size': 'None'}).size, 0)
+
+    def test_add(self):
+        """Adding operations count them in all the ancestors."""
+        self.qc.add('Upload', '12', {'path': '/a/b/c', 'deflated_size': '10'})
+        self.qc.add('Upload', '34', {'path': '/a/d', 'deflated_size': '5'})
+        self.qc.add('MakeFile', '56', {'path': '/a/b/c'})
+        self.assertEqual(self._stats(''), (3, 0, 15))
+        self.assertEqual(self._stats('/a'), (3, 0, 15))
+        self.assertEqual(self._stats('/a/b'), (2, 0, 10))
+        self.assertEqual(self._stats('/a/b/c'), (2, 0, 10))
+        self.assertEqual(self._stats('/a/d'), (1, 0, 5))
+
+    def test_remove(self):
+        """Finished operations are counted as done, without bytes."""
+        self.qc.add('Upload', '12', {'path': '/a/b', 'deflated_size': '10'})
+        self.qc.add('Upload', '34', {'path': '/a/c', 'deflated_size': '5'})
+        self.qc.remove('Upload', '12', {'path': '/a/b'})
+        self.assertEqual(self._stats('/a'), (1, 1, 5))
+        self.assertEqual(self._stats('/a/b'), (0, 1, 0))
+        self._check_all()
+
+    def test_restart(self):
+        """The done operations are dropped when the node starts again."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.remove('MakeFile', '12', {'path': '/a/b'})
+        self.qc.add('Upload', '34', {'path': '/a/b', 'deflated_size': '7'})
+        self.assertEqual(self._stats('/a'), (1, 0, 7))
+        self._check_all()
+
+    def test_clear(self):
+        """Clearing discounts the removed nodes from the ancestors."""
+        self.qc.add('MakeDir', '12', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/a/b/c'})
+        self.qc.add('MakeFile', '56', {'path': '/a/d'})
+        self.qc.add('MakeFile', '78', {'path': '/a/e'})
+        self.qc.remove('MakeDir', '12', {'path': '/a/b'})
+        self.qc.remove('MakeFile', '56', {'path': '/a/d'})
+        self.assertEqual(self._stats('/a'), (2, 2, 0))
+        self.qc.clear()
+        self.assertEqual(self._stats('/a'), (2, 0, 0))
+        self._check_all()
+
+    def test_prune(self):
+        """Pruning discounts the removed nodes from the ancestors."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b/c'})
+        self.qc.add('MakeFile', '34', {'path': '/a/d'})
+        self.qc.remove('MakeFile', '12', {'path': '/a/b/c'})
+        self.qc.remove('MakeFile', '34', {'path': '/a/d'})
+        self.qc.prune(max_done=1)
+        self.assertEqual(self._stats(''), (0, 1, 0))
+        self.assertNotIn('/a/b', self.qc._node_index)
+        self._check_all()
+
+    def test_set_content(self):
+        """The bulk load keeps the stats too."""
+        self.qc.set_content([
+            ('Upload', '1', {'path': '/a/b', 'deflated_size': '3'}),
+            ('MakeDir', '2', {'path': '/a'}),
+            ('Download', '3', {'path': '/a/c/d', 'deflated_size': '4'}),
+            ('Download', '4', {'path': '/x', 'deflated_size': '5'}),
+        ])
+        self.assertEqual(self._stats(''), (4, 0, 12))
+        self.assertEqual(self._stats('/a'), (3, 0, 7))
+        self._check_all()
+
+    def test_exposed_in_node_ops(self):
+        """The stats are available from the node ops."""
+        self.qc.add('Upload', '12', {'path': '/a/b', 'deflated_size': '10'})
+        ((_, nodes),) = self.qc.node_ops
+        self.assertEqual(nodes['a'].subtree_pending, 1)
+        self.assertEqual(nodes['a'].subtree_bytes, 10)
+
+
+class DeltasTestCase(unittest.TestCase):
+    """Tests for the changes sent from the node structure."""
+
+    def setUp(self):
+        """Set up the test."""
+        self.qc = QueueContent(home='/')
+        self.deltas = []
+        self.qc.on_deltas_callback = self.deltas.append
+
+    def get_changes(self):
+        """Return the kind and path of the sent deltas, and reset them."""
+        changes = [[(d.kind, d.path) for d in deltas]
+                   for deltas in self.deltas]
+        self.deltas[:] = []
+        return changes
+
+    def test_not_stored_without_callback(self):
+        """Nothing is stored if nobody wants the deltas."""
+        self.qc.on_deltas_callback = None
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.assertEqual(self.qc._deltas, [])
+
+    def test_add_creates(self):
+        """All the created nodes are informed, in one call."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.assertEqual(self.get_changes(),
+                         [[(DELTA_CREATED, ''), (DELTA_CREATED, '/a'),
+                           (DELTA_CREATED, '/a/b')]])
+
+    def test_add_existing(self):
+        """Adding to an existing node changes its operations."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.get_changes()
+        self.qc.add('Upload', '34', {'path': '/a'})
+        self.assertEqual(self.get_changes(), [[(DELTA_OPS_CHANGED, '/a')]])
+
+    def test_delta_has_node(self):
+        """The node itself is in the delta."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        delta = self.deltas[0][-1]
+        self.assertIs(delta.node, self.qc._node_index['/a'])
+
+    def test_remove_not_done(self):
+        """Finishing one of several operations."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.qc.add('Upload', '34', {'path': '/a'})
+        self.get_changes()
+        self.qc.remove('MakeFile', '12', {'path': '/a'})
+        self.assertEqual(self.get_changes(), [[(DELTA_OPS_CHANGED, '/a')]])
+
+    def test_remove_done(self):
+        """Finishing the last operation of the node."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.get_changes()
+        self.qc.remove('MakeFile', '12', {'path': '/a'})
+        self.assertEqual(self.get_changes(), [[(DELTA_DONE, '/a')]])
+
+    def test_remove_missing(self):
+        """Nothing is informed if nothing changed."""
+        self.qc.remove('MakeFile', '12', {'path': '/a'})
+        self.assertEqual(self.get_changes(), [])
+
+    def test_internal(self):
+        """Internal operations don't change the node structure."""
+        self.qc.add('ListShares', '12', {})
+        self.qc.remove('ListShares', '12', {})
+        self.assertEqual(self.get_changes(), [])
+
+    def test_clear(self):
+        """Clearing removes or changes nodes."""
+        self.qc.add('MakeDir', '12', {'path': '/a'})
+        self.qc.add('MakeFile', '23', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/c/d'})
+        self.qc.remove('MakeDir', '12', {'path': '/a'})
+        self.qc.remove('MakeFile', '34', {'path': '/c/d'})
+        self.get_changes()
+        self.qc.clear()
+        changes = self.get_changes()
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(sorted(changes[0]),
+                         [(DELTA_OPS_CHANGED, '/a'), (DELTA_REMOVED, '/c'),
+                          (DELTA_REMOVED, '/c/d')])
+
+    def test_clear_nothing(self):
+        """Nothing is informed if nothing cleared."""
+        self.qc.add('MakeFile', '12', {'path': '/a'})
+        self.get_changes()
+        self.qc.clear()
+        self.assertEqual(self.get_changes(), [])
+
+    def test_set_content(self):
+        """All the changes of setting the content are sent together."""
+        self.qc.set_content([('MakeFile', '12', {'path': '/a'}),
+                             ('Upload', '34', {'path': '/a'}),
+                             ('MakeFile', '56', {'path': '/b'})])
+        self.assertEqual(self.get_changes(),
+                         [[(DELTA_CREATED, ''), (DELTA_CREATED, '/a'),
+                           (DELTA_OPS_CHANGED, '/a'),
+                           (DELTA_CREATED, '/b')]])
+
+
+class GenerationsTestCase(unittest.TestCase):
+    """Tests for the dirty subtree tracking."""
+
+    def setUp(self):
+        """Set up the test."""
+        self.qc = QueueContent(home='/')
+
+    def changed(self, since):
+        """Return the paths of the changed nodes."""
+        return sorted(path for path, _ in self.qc.get_changed_nodes(since))
+
+    def test_init(self):
+        """Nothing changed at start."""
+        self.assertEqual(self.qc.generation, 0)
+        self.assertEqual(self.qc.get_changed_nodes(0), [])
+
+    def test_add_marks_ancestors(self):
+        """Adding a node marks it and its ancestors."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        gen = self.qc.generation
+        self.assertEqual(self.qc._node_index['/a/b'].generation, gen)
+        self.assertEqual(self.qc._node_index['/a'].generation, gen)
+        self.assertEqual(self.qc._node_index[''].generation, gen)
+
+    def test_changed_branch_only(self):
+        """Only the changed branch is returned."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/c/d'})
+        gen = self.qc.generation
+        self.qc.add('Upload', '56', {'path': '/a/b'})
+        self.assertEqual(self.changed(gen), ['', '/a', '/a/b'])
+
+    def test_untouched_not_walked(self):
+        """The untouched subtrees are not even visited."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/c/d'})
+        gen = self.qc.generation
+        self.qc.add('Upload', '56', {'path': '/a/b'})
+
+        class NoChildren(dict):
+            """Explode if visited."""
+            def items(self):
+                """Boom."""
+                raise AssertionError("Visited!")
+
+        self.qc._node_index['/c'].children = NoChildren(
+            self.qc._node_index['/c'].children)
+        self.assertEqual(self.changed(gen), ['', '/a', '/a/b'])
+
+    def test_parents_first(self):
+        """Parents come before their children."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b/c'})
+        paths = [path for path, _ in self.qc.get_changed_nodes(0)]
+        self.assertEqual(paths, ['', '/a', '/a/b', '/a/b/c'])
+
+    def test_remove(self):
+        """Finishing an operation changes the node."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/c/d'})
+        gen = self.qc.generation
+        self.qc.remove('MakeFile', '34', {'path': '/c/d'})
+        self.assertEqual(self.changed(gen), ['', '/c', '/c/d'])
+
+    def test_clear(self):
+        """Clearing changes the parents of the removed nodes."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.qc.add('MakeFile', '34', {'path': '/c/d'})
+        self.qc.add('MakeFile', '56', {'path': '/c/e'})
+        self.qc.remove('MakeFile', '34', {'path': '/c/d'})
+        gen = self.qc.generation
+        self.qc.clear()
+        self.assertEqual(self.changed(gen), ['', '/c'])
+
+    def test_nothing_since_current(self):
+        """Nothing changed since the current generation."""
+        self.qc.add('MakeFile', '12', {'path': '/a/b'})
+        self.assertEqual(self.qc.get_changed_nodes(self.qc.generation), [])
+
+    def test_set_content(self):
+        """Setting the content is one generation."""
+        self.qc.set_content([('MakeFile', '12', {'path': '/a/b'}),
+                             ('MakeFile', '34', {'path': '/c/d'})])
+        self.assertEqual(self.qc.generation, 1)
+        self.assertEqual(self.changed(0), ['', '/a', '/a/b', '/c', '/c/d'])
+
 
 class DeliverNodeDataTestCase(unittest.TestCase):
     """Send the node data without the home."""
@@ -925,6 +1716,64 @@ class InternalStructureTestCase(unittest.TestCase):
         self.assertEqual(data.action, ACTION_REMOVED)
 
 
+class InternalOpsBufferTestCase(unittest.TestCase):
+    """Tests for the bounded storage of internal operations."""
+
+    def setUp(self):
+        """Set up the test."""
+        self.qc = QueueContent(home='/a/b', internal_ops_capacity=3)
+
+    def test_default_capacity(self):
+        """By default keep a reasonable quantity."""
+        qc = QueueContent(home='/a/b')
+        self.assertEqual(qc.internal_ops.maxlen, INTERNAL_OPS_CAPACITY)
+
+    def test_init(self):
+        """Nothing stored or evicted at start."""
+        self.assertEqual(self.qc.internal_ops_count, 0)
+        self.assertEqual(self.qc.internal_ops_evicted, 0)
+        self.assertEqual(self.qc.get_internal_ops(), [])
+
+    def test_below_capacity(self):
+        """All ops are kept while there's room."""
+        self.qc.add('ListShares', '1', {})
+        self.qc.remove('ListShares', '1', {})
+        self.assertEqual(len(self.qc.internal_ops), 2)
+        self.assertEqual(self.qc.internal_ops_count, 2)
+        self.assertEqual(self.qc.internal_ops_evicted, 0)
+
+    def test_evict_oldest(self):
+        """The oldest ops are dropped when full."""
+        for i in range(5):
+            self.qc.add('ListShares', str(i), {})
+        self.assertEqual([op.op_id for op in self.qc.internal_ops],
+                         ['2', '3', '4'])
+        self.assertEqual(self.qc.internal_ops_count, 5)
+        self.assertEqual(self.qc.internal_ops_evicted, 2)
+
+    def test_get_since(self):
+        """Get only the ops after a sequence number."""
+        self.qc.add('ListShares', '0', {})
+        seq = self.qc.internal_ops_count
+        self.qc.add('ListShares', '1', {})
+        self.qc.add('ListShares', '2', {})
+        ops = self.qc.get_internal_ops(since=seq)
+        self.assertEqual([op.op_id for op in ops], ['1', '2'])
+
+    def test_get_since_nothing_new(self):
+        """Nothing new since the last time."""
+        self.qc.add('ListShares', '0', {})
+        ops = self.qc.get_internal_ops(since=self.qc.internal_ops_count)
+        self.assertEqual(ops, [])
+
+    def test_get_since_evicted(self):
+        """Only the ops still kept are returned."""
+        for i in range(5):
+            self.qc.add('ListShares', str(i), {})
+        ops = self.qc.get_internal_ops(since=1)
+        self.assertEqual([op.op_id for op in ops], ['2', '3', '4'])
+
+
 class TransferringFlagTestCase(unittest.TestCase):
     """Tests that check the transferring flag."""
 
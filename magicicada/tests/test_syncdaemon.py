@@ -19,24 +19,47 @@ import os
 import unittest
 import user
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.trial.unittest import TestCase as TwistedTestCase
 from ubuntuone.devtools.handlers import MementoHandler
 
+from magicicada import syncdaemon
 from magicicada.dbusiface import (
+    CIRCUIT_CLOSED,
+    CIRCUIT_OPEN,
+    CallTimeoutError,
+    CircuitOpenError,
     FolderData,
     FolderOperationError,
     NOT_SYNCHED_PATH,
     PublicFilesData,
+    SHARES_TO_ME,
+    SHARES_TO_OTHERS,
+    ShareData,
     ShareOperationError,
+    Transfer,
+)
+from magicicada.helpers import NO_OP
+from magicicada.queue_content import (
+    DELTA_CREATED,
+    DELTA_DONE,
+    DELTA_REMOVED,
 )
 from magicicada.syncdaemon import (
+    AdaptivePoller,
     CHANGED_LOCAL,
     CHANGED_NONE,
     CHANGED_SERVER,
+    Coalescer,
+    DONE_OPS_PRUNE_INTERVAL,
+    DONE_OPS_PRUNE_LIMIT,
     INTERNAL_OP,
+    METADATA_UNAVAILABLE,
+    MetadataCache,
     NODE_OP,
     Poller,
+    REFRESH_WINDOW,
+    Refresher,
     STATE_CONNECTING,
     STATE_DISCONNECTED,
     STATE_IDLE,
@@ -45,7 +68,11 @@ from magicicada.syncdaemon import (
     STATE_WORKING,
     State,
     SyncDaemon,
+    TRANSFER_POLL_BACKOFF,
     TRANSFER_POLL_INTERVAL,
+    TRANSFER_POLL_JITTER,
+    TRANSFER_POLL_MAX_INTERVAL,
+    TRANSFER_POLL_MIN_INTERVAL,
     mandatory_callback,
 )
 
@@ -60,6 +87,7 @@ from magicicada.syncdaemon import (
 class FakeQueueContent(object):
     """Fake queue content."""
     transferring = False
+    node_ops = None
     set_content = set_shares_dirs = add = remove = lambda *a: None
 
 
@@ -69,6 +97,10 @@ class FakeDBusInterface(object):
     fake_sd_started = False
     fake_pf_data = PublicFilesData(volume='v', node='n',
                                    path='p', public_url='u')
+    fake_share_data = ShareData(
+        accepted=True, access_level='View', free_bytes=None, name='s',
+        node_id='n', other_username='u', other_visible_name='U',
+        path='p', volume_id='v', subscribed=True)
     fake_share_response = None
     fake_folder_response = None
     fake_change_public_access = None
@@ -89,7 +121,12 @@ class FakeDBusInterface(object):
         return defer.succeed('fakedata')
 
     start = quit = connect = disconnect = get_folders
-    get_shares_to_me = get_shares_to_others = get_folders
+
+    def get_shares_to_me(self):
+        """Fake shares."""
+        return defer.succeed([self.fake_share_data])
+
+    get_shares_to_others = get_shares_to_me
 
     def get_queue_content(self):
         """Fake queue content."""
@@ -127,11 +164,20 @@ class FakeDBusInterface(object):
         return self.fake_change_public_access
 
 
+def set_refresh_window(sd, window):
+    """Set the time between the refreshes of all the SD datasets."""
+    for refresher in sd._refreshers.itervalues():
+        refresher.window = window
+
+
 class BaseTestCase(TwistedTestCase):
     """Base test with a SD."""
 
     timeout = 1
 
+    # no waiting between refreshes, unless the test is about that
+    refresh_window = 0
+
     def setUp(self):
         """Set up."""
         self.hdlr = MementoHandler()
@@ -143,6 +189,7 @@ class BaseTestCase(TwistedTestCase):
 
         self.sd = SyncDaemon(FakeDBusInterface)
         self.addCleanup(self.sd.shutdown)
+        set_refresh_window(self.sd, self.refresh_window)
 
 
 class MandatoryCallbackTestCase(BaseTestCase):
@@ -170,6 +217,7 @@ class InitialDataTestCase(unittest.TestCase):
     def setUp(self):
         """Set up the test."""
         self.sd = SyncDaemon(FakeDBusInterface)
+        set_refresh_window(self.sd, 0)
 
         self.offline_called = False
         self.sd.on_initial_data_ready_callback = \
@@ -212,17 +260,15 @@ class InitialDataTestCase(unittest.TestCase):
     def test_calls_callbacks(self):
         """Check that initial data calls the callbacks for new data."""
         called = []
-        sd = SyncDaemon(FakeDBusInterface)
-        sd.status_changed_callback = lambda *a, **kw: called.append(True)
-        sd._get_initial_data()
+        self.sd.status_changed_callback = lambda *a, **kw: called.append(True)
+        self.sd._get_initial_data()
         self.assertTrue(called)
 
     def test_public_files_info(self):
         """Check we get the public files info at start."""
-        sd = SyncDaemon(FakeDBusInterface)
         fake_data = FakeDBusInterface.fake_pf_data
-        sd._get_initial_data()
-        self.assertEqual(sd.public_files, [fake_data])
+        self.sd._get_initial_data()
+        self.assertEqual(self.sd.public_files, [fake_data])
 
     def test_all_ready(self):
         """All data is ready."""
@@ -294,6 +340,124 @@ class InitialDataTestCase(unittest.TestCase):
         self.assertFalse(self.offline_called)
         self.assertFalse(self.online_called)
 
+    def _hold_calls(self):
+        """Make the offline dbus calls wait, return the waiting ones."""
+        waiting = []
+        for name in ('get_status', 'get_real_shares_dir', 'get_folders',
+                     'get_shares_to_me', 'get_shares_to_others'):
+            d = defer.Deferred()
+            setattr(self.sd.dbus, name,
+                    lambda name=name, d=d: waiting.append((name, d)) or d)
+        return waiting
+
+    def test_concurrent(self):
+        """The datasets are requested without waiting the previous ones."""
+        waiting = self._hold_calls()
+        self.sd.initial_data_concurrency = 10
+        self.sd._get_initial_data()
+        self.assertEqual([name for name, _ in waiting],
+                         ['get_status', 'get_real_shares_dir', 'get_folders',
+                          'get_shares_to_me', 'get_shares_to_others'])
+
+    def test_concurrency_limit(self):
+        """No more than the limit of datasets are requested at once."""
+        waiting = self._hold_calls()
+        self.sd.initial_data_concurrency = 2
+        self.sd._get_initial_data()
+        self.assertEqual([name for name, _ in waiting],
+                         ['get_status', 'get_real_shares_dir'])
+
+        # when one finishes, the next one is requested
+        waiting[0][1].callback(('name', 'descrip', False, True, False,
+                                'queues', 'connection'))
+        self.assertEqual(waiting[2][0], 'get_folders')
+        self.assertEqual(len(waiting), 3)
+
+    def test_dataset_callback_on_arrival(self):
+        """Each dataset goes to its callback when it arrives."""
+        waiting = self._hold_calls()
+        called = []
+        self.sd.on_folders_changed_callback = lambda d: called.append(d)
+        self.sd._get_initial_data()
+        dict(waiting)['get_folders'].callback(['folders'])
+        self.assertEqual(called, [['folders']])
+        self.assertEqual(self.sd.folders, ['folders'])
+        self.assertFalse(self.offline_called)
+
+    def test_all_datasets_callbacks(self):
+        """All the datasets are sent to their callbacks."""
+        called = []
+        self.sd.on_folders_changed_callback = \
+            lambda d: called.append('folders')
+        self.sd.on_shares_to_me_changed_callback = \
+            lambda d: called.append('shares_to_me')
+        self.sd.on_shares_to_others_changed_callback = \
+            lambda d: called.append('shares_to_others')
+        self.sd._get_initial_data()
+        self.assertEqual(sorted(called), ['folders', 'shares_to_me',
+                                          'shares_to_others'])
+        self.assertTrue(self.offline_called)
+
+    def _hook_ready_callbacks(self):
+        """Record which datasets are ready."""
+        ready = []
+        for name in ('status', 'queue', 'folders', 'shares'):
+            setattr(self.sd, 'on_%s_ready_callback' % name,
+                    lambda name=name: ready.append(name))
+        return ready
+
+    def test_ready_callbacks(self):
+        """Each dataset has its ready callback, before all are ready."""
+        ready = self._hook_ready_callbacks()
+        self.sd.on_initial_data_ready_callback = \
+            lambda: ready.append('all')
+        self.sd._get_initial_data()
+        self.assertEqual(ready, ['status', 'queue', 'folders', 'shares',
+                                 'all'])
+
+    def test_ready_progressively(self):
+        """A dataset is ready without waiting for the others."""
+        waiting = self._hold_calls()
+        ready = self._hook_ready_callbacks()
+        self.sd.initial_data_concurrency = 10
+        self.sd._get_initial_data()
+        dict(waiting)['get_folders'].callback(['folders'])
+        self.assertEqual(ready, ['folders'])
+        self.assertIn('folders', self.sd.initial_data_times)
+        self.assertFalse(self.offline_called)
+
+    def test_shares_ready_needs_both(self):
+        """The shares are ready when both kinds arrived."""
+        waiting = self._hold_calls()
+        ready = self._hook_ready_callbacks()
+        self.sd.initial_data_concurrency = 10
+        self.sd._get_initial_data()
+        dict(waiting)['get_shares_to_me'].callback([])
+        self.assertEqual(ready, [])
+        dict(waiting)['get_shares_to_others'].callback([])
+        self.assertEqual(ready, ['shares'])
+
+    def test_queue_ready(self):
+        """The queue is ready when its content is loaded."""
+        called = []
+        self.sd.on_queue_ready_callback = \
+            lambda: called.append(self.sd.queue_content.node_ops)
+        self.sd.dbus.get_queue_content = lambda: defer.succeed(
+            [('MakeFile', '12', {'path': user.home + '/a'})])
+        self.sd._get_initial_data()
+        ((_, nodes),) = called[0]
+        self.assertIn('a', nodes)
+
+    def test_dataset_error(self):
+        """The error of a dataset is reported, and nothing is ready."""
+        self.sd.dbus.get_folders = lambda: defer.fail(ValueError('foo'))
+        d = self.sd._get_initial_data()
+        errors = []
+        d.addErrback(errors.append)
+        self.assertTrue(errors[0].check(ValueError))
+        self.assertFalse(self.offline_called)
+        self.assertFalse(self.online_called)
+
 
 class StatusChangedTestCase(BaseTestCase):
     """Simple signals checking."""
@@ -708,6 +872,71 @@ class QueueChangedTestCase(BaseTestCase):
         self.assertEqual(called, [('name', 'id', {})])
 
 
+class NodeOpsDeltasTestCase(BaseTestCase):
+    """Check the subscription to the node ops changes."""
+
+    def test_no_subscribers(self):
+        """Without subscribers the changes are not even stored."""
+        self.sd.on_sd_queue_added('MakeFile', '12', {'path': '/a'})
+        self.assertEqual(self.sd.queue_content.on_deltas_callback, None)
+        self.assertEqual(self.sd.queue_content._deltas, [])
+
+    def test_subscribe(self):
+        """Subscribers receive the changes."""
+        called = []
+        self.sd.subscribe_node_ops(called.append)
+        self.sd.on_sd_queue_added('MakeFile', '12',
+                                  {'path': user.home + '/foo'})
+        self.assertEqual(len(called), 1)
+        self.assertEqual([(d.kind, d.path) for d in called[0]],
+                         [(DELTA_CREATED, ''), (DELTA_CREATED, '/foo')])
+
+    def test_several_subscribers(self):
+        """All the subscribers receive the changes."""
+        called1 = []
+        called2 = []
+        self.sd.subscribe_node_ops(called1.append)
+        self.sd.subscribe_node_ops(called2.append)
+        self.sd.on_sd_queue_added('MakeFile', '12',
+                                  {'path': user.home + '/foo'})
+        self.sd.on_sd_queue_removed('MakeFile', '12',
+                                    {'path': user.home + '/foo'})
+        self.assertEqual(len(called1), 2)
+        self.assertEqual(called1, called2)
+        self.assertEqual([(d.kind, d.path) for d in called1[1]],
+                         [(DELTA_DONE, '/foo')])
+
+    def test_unsubscribe(self):
+        """Unsubscribed callbacks don't receive the changes."""
+        called1 = []
+        called2 = []
+        self.sd.subscribe_node_ops(called1.append)
+        self.sd.subscribe_node_ops(called2.append)
+        self.sd.unsubscribe_node_ops(called1.append)
+        self.sd.on_sd_queue_added('MakeFile', '12',
+                                  {'path': user.home + '/foo'})
+        self.assertEqual(called1, [])
+        self.assertEqual(len(called2), 1)
+
+    def test_unsubscribe_all(self):
+        """Without subscribers the changes are not stored anymore."""
+        self.sd.subscribe_node_ops(NO_OP)
+        self.sd.unsubscribe_node_ops(NO_OP)
+        self.assertEqual(self.sd.queue_content.on_deltas_callback, None)
+
+    def test_clear_from_gui(self):
+        """The changes of clearing the structure are also received."""
+        called = []
+        self.sd.on_sd_queue_added('MakeFile', '12',
+                                  {'path': user.home + '/foo'})
+        self.sd.on_sd_queue_removed('MakeFile', '12',
+                                    {'path': user.home + '/foo'})
+        self.sd.subscribe_node_ops(called.append)
+        self.sd.queue_content.clear()
+        self.assertEqual([(d.kind, d.path) for d in called[0]],
+                         [(DELTA_REMOVED, '/foo'), (DELTA_REMOVED, '')])
+
+
 class StateTestCase(unittest.TestCase):
     """Test State class."""
 
@@ -764,28 +993,28 @@ class APITestCase(TwistedTestCase):
 
     def test_start(self):
         """Test start calls SD."""
-        deferred = object()
+        deferred = defer.Deferred()
         self.patch(self.sd.dbus, 'start', lambda: deferred)
         res = self.sd.start()
         self.assertIdentical(res, deferred)
 
     def test_quit(self):
         """Test quit calls SD."""
-        deferred = object()
+        deferred = defer.Deferred()
         self.patch(self.sd.dbus, 'quit', lambda: deferred)
         res = self.sd.quit()
         self.assertIdentical(res, deferred)
 
     def test_connect(self):
         """Test connect calls SD."""
-        deferred = object()
+        deferred = defer.Deferred()
         self.patch(self.sd.dbus, 'connect', lambda: deferred)
         res = self.sd.connect()
         self.assertIdentical(res, deferred)
 
     def test_disconnect(self):
         """Test disconnect calls SD."""
-        deferred = object()
+        deferred = defer.Deferred()
         self.patch(self.sd.dbus, 'disconnect', lambda: deferred)
         res = self.sd.disconnect()
         self.assertIdentical(res, deferred)
@@ -843,6 +1072,7 @@ class LogsTestCase(unittest.TestCase):
         logger.setLevel(logging.DEBUG)
         self.addCleanup(logger.removeHandler, self.hdlr)
         self.sd = SyncDaemon(FakeDBusInterface)
+        set_refresh_window(self.sd, 0)
 
     def tearDown(self):
         """Shut down!"""
@@ -971,6 +1201,89 @@ class MetadataTestCase(BaseTestCase):
         self.sd.get_metadata('/a/symlink/path')
         self.assertEqual(called, ['/a/realpath'])
 
+    def _fake_metadata(self):
+        """Answer the metadata asked, keeping the asked paths."""
+        asked = []
+        d = dict(stat=u'None', info_is_partial=u'False', path='path',
+                 local_hash=u'', server_hash=u'')
+        self.patch(os.path, 'realpath', lambda p: p)
+        self.sd.dbus.get_metadata = lambda p: asked.append(p) or \
+            defer.succeed(d)
+        self.sd.on_metadata_ready_callback = NO_OP
+        return asked
+
+    def test_get_metadata_cached(self):
+        """The metadata asked again comes from the cache."""
+        asked = self._fake_metadata()
+        called = []
+        self.sd.on_metadata_ready_callback = lambda *a: called.append(a)
+        self.sd.get_metadata('/a/path')
+        self.sd.get_metadata('/a/path')
+        self.assertEqual(asked, ['/a/path'])
+        self.assertEqual(len(called), 2)
+        self.assertEqual(called[0], called[1])
+        self.assertTrue(self.hdlr.check_debug("Metadata cache hit",
+                                              "hit rate 0.50"))
+
+    def test_get_metadata_cached_not_synched(self):
+        """The paths not synched are cached too."""
+        asked = []
+        self.sd.dbus.get_metadata = lambda p: asked.append(p) or \
+            defer.succeed(NOT_SYNCHED_PATH)
+        called = []
+        self.sd.on_metadata_ready_callback = lambda *a: called.append(a)
+        self.sd.get_metadata('dontcare')
+        self.sd.get_metadata('dontcare')
+        self.assertEqual(len(asked), 1)
+        self.assertEqual(called[1][1], NOT_SYNCHED_PATH)
+
+    def test_get_metadata_invalidated_by_queue(self):
+        """An operation in the queue for a parent forgets the metadata."""
+        asked = self._fake_metadata()
+        self.sd.queue_content.add = lambda *a: NODE_OP
+        self.sd.queue_content.remove = lambda *a: NODE_OP
+        self.sd.get_metadata('/a/path')
+        self.sd.on_sd_queue_added('Upload', 'id', {'path': '/a'})
+        self.sd.get_metadata('/a/path')
+        self.sd.on_sd_queue_removed('Move', 'id', {'path_from': '/b',
+                                                   'path_to': '/a/path'})
+        self.sd.get_metadata('/a/path')
+        self.sd.on_sd_queue_added('Upload', 'id', {'path': '/a/pathfoo'})
+        self.sd.get_metadata('/a/path')
+        self.assertEqual(asked, ['/a/path'] * 3)
+
+    def test_get_metadata_invalidated_while_asked(self):
+        """The metadata asked before an operation in the queue is not kept."""
+        self.patch(os.path, 'realpath', lambda p: p)
+        answer = defer.Deferred()
+        self.sd.dbus.get_metadata = lambda p: answer
+        self.sd.on_metadata_ready_callback = NO_OP
+        self.sd.queue_content.add = lambda *a: NODE_OP
+        self.sd.get_metadata('/a/path')
+        self.sd.on_sd_queue_added('Upload', 'id', {'path': '/a/path'})
+        answer.callback(NOT_SYNCHED_PATH)
+        self.assertEqual(len(self.sd.metadata_cache), 0)
+
+    def test_get_metadata_other_invalidated_while_asked(self):
+        """The metadata asked is kept if other paths are touched meanwhile."""
+        self.patch(os.path, 'realpath', lambda p: p)
+        answer = defer.Deferred()
+        self.sd.dbus.get_metadata = lambda p: answer
+        self.sd.on_metadata_ready_callback = NO_OP
+        self.sd.queue_content.add = lambda *a: NODE_OP
+        self.sd.get_metadata('/a/path')
+        self.sd.on_sd_queue_added('Upload', 'id', {'path': '/a/other'})
+        answer.callback(NOT_SYNCHED_PATH)
+        self.assertEqual(len(self.sd.metadata_cache), 1)
+
+    @defer.inlineCallbacks
+    def test_get_metadata_cache_cleared_with_queue(self):
+        """The cache is cleared when the whole queue is asked again."""
+        self._fake_metadata()
+        self.sd.get_metadata('/a/path')
+        yield self.sd._get_initial_queue_content()
+        self.assertEqual(len(self.sd.metadata_cache), 0)
+
     def test_processing_nodata(self):
         """No stat in the info received."""
         self.sd.dbus.get_metadata = lambda p: defer.succeed(NOT_SYNCHED_PATH)
@@ -1102,6 +1415,107 @@ class MetadataTestCase(BaseTestCase):
 class FoldersTestCase(BaseTestCase):
     """Folders checking."""
 
+    def _folder(self, volume, subscribed=False):
+        """Return a folder for the volume."""
+        return FolderData(node='n' + volume, path=u'p' + volume,
+                          suggested_path=u's' + volume,
+                          subscribed=subscribed, volume=volume)
+
+    def _set_folders(self, *volumes):
+        """Set the folders, as got from SD."""
+        self.sd._set_folders([self._folder(v) for v in volumes])
+
+    def test_folder_changed_new(self):
+        """A new folder is added."""
+        self._set_folders('a', 'b')
+        self.sd.on_sd_folder_changed(self._folder('c'))
+        self.assertEqual([f.volume for f in self.sd.folders], ['a', 'b', 'c'])
+
+    def test_folder_changed_existing(self):
+        """An existing folder is replaced in its place."""
+        self._set_folders('a', 'b', 'c')
+        folders = self.sd.folders
+        self.sd.on_sd_folder_changed(self._folder('b', subscribed=True))
+        self.assertTrue(self.sd.folders is folders)
+        self.assertEqual([f.volume for f in self.sd.folders], ['a', 'b', 'c'])
+        self.assertTrue(self.sd.folders[1].subscribed)
+
+    def test_folder_deleted(self):
+        """A deleted folder is removed."""
+        self._set_folders('a', 'b', 'c')
+        self.sd.on_sd_folder_deleted(self._folder('a'))
+        self.assertEqual(sorted(f.volume for f in self.sd.folders),
+                         ['b', 'c'])
+        self.sd.on_sd_folder_deleted(self._folder('c'))
+        self.sd.on_sd_folder_changed(self._folder('b', subscribed=True))
+        self.assertEqual(self.sd.folders, [self._folder('b', True)])
+
+    def test_folder_deleted_unknown(self):
+        """An unknown deleted folder is ignored."""
+        self._set_folders('a')
+        self.sd.on_sd_folder_deleted(self._folder('x'))
+        self.assertEqual(self.sd.folders, [self._folder('a')])
+
+    def test_folder_patched_callback(self):
+        """The GUI is told about the patched folders."""
+        self._set_folders('a')
+        called = []
+        self.sd.on_folders_changed_callback = called.append
+        self.sd.on_sd_folder_changed(self._folder('b'))
+        self.sd.on_sd_folder_deleted(self._folder('a'))
+        self.assertEqual(called, [self.sd.folders, self.sd.folders])
+
+    def test_folder_patched_without_folders(self):
+        """All the folders are asked if they were never got."""
+        called = []
+        self.sd.dbus.get_folders = lambda: called.append(True)
+        self.sd.on_sd_folder_changed(self._folder('a'))
+        self.sd.on_sd_folder_deleted(self._folder('a'))
+        self.assertEqual(called, [True, True])
+
+    def test_folders_set_resets_index(self):
+        """Getting all the folders again forgets the previous index."""
+        self._set_folders('a', 'b')
+        self.sd.on_sd_folder_changed(self._folder('c'))
+        self._set_folders('x')
+        self.sd.on_sd_folder_changed(self._folder('a'))
+        self.assertEqual([f.volume for f in self.sd.folders], ['x', 'a'])
+
+    def test_reconcile_scheduled_once(self):
+        """After patching, all the folders are got again later."""
+        clock = task.Clock()
+        self.patch(syncdaemon, 'reactor', clock)
+        self._set_folders('a')
+        self.sd.on_sd_folder_changed(self._folder('b'))
+        self.sd.on_sd_folder_changed(self._folder('c'))
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        called = []
+        self.sd.dbus.get_folders = lambda: called.append(True) or \
+            defer.succeed([self._folder('z')])
+        clock.advance(syncdaemon.FOLDERS_RECONCILE_DELAY)
+        self.assertEqual(called, [True])
+        self.assertEqual(self.sd.folders, [self._folder('z')])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_reconcile_cancelled_by_full_refresh(self):
+        """Getting all the folders cancels the pending reconcile."""
+        clock = task.Clock()
+        self.patch(syncdaemon, 'reactor', clock)
+        self._set_folders('a')
+        self.sd.on_sd_folder_changed(self._folder('b'))
+        self.sd.on_sd_folders_changed()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_reconcile_cancelled_on_shutdown(self):
+        """The pending reconcile is cancelled on shutdown."""
+        clock = task.Clock()
+        self.patch(syncdaemon, 'reactor', clock)
+        self._set_folders('a')
+        self.sd.on_sd_folder_changed(self._folder('b'))
+        self.sd.shutdown()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
     def test_foldercreated_callback(self):
         """Get the new data after the folders changed."""
         # set the callback
@@ -1271,8 +1685,14 @@ class SharesTestCase(BaseTestCase):
         """Get the new data after the shares changed."""
         # set the callback
         called = []
-        self.sd.dbus.get_shares_to_me = lambda: called.append(True)
-        self.sd.dbus.get_shares_to_others = lambda: called.append(True)
+
+        def fake_get_shares():
+            """Register the call."""
+            called.append(True)
+            return defer.succeed([])
+
+        self.sd.dbus.get_shares_to_me = fake_get_shares
+        self.sd.dbus.get_shares_to_others = fake_get_shares
 
         # they changed!
         self.sd.on_sd_shares_changed()
@@ -1284,8 +1704,14 @@ class SharesTestCase(BaseTestCase):
     def test_initial_value(self):
         """Fill the folder info initially."""
         called = []
-        self.sd.dbus.get_shares_to_me = lambda: called.append(True)
-        self.sd.dbus.get_shares_to_others = lambda: called.append(True)
+
+        def fake_get_shares():
+            """Register the call."""
+            called.append(True)
+            return defer.succeed([])
+
+        self.sd.dbus.get_shares_to_me = fake_get_shares
+        self.sd.dbus.get_shares_to_others = fake_get_shares
         yield self.sd._get_initial_data()
         self.assertEqual(len(called), 2)
 
@@ -1297,8 +1723,8 @@ class SharesTestCase(BaseTestCase):
         self.sd.on_shares_to_others_changed_callback = lambda *a: cal.append(2)
 
         # they changed!
-        self.sd.shares_to_me = 'foo'
-        self.sd.shares_to_others = 'fakedata'  # what fake dbus will return
+        self.sd.shares_to_me = []
+        self.sd.shares_to_others = [self.sd.dbus.fake_share_data]
         self.sd.on_sd_shares_changed()
 
         # test
@@ -1312,13 +1738,125 @@ class SharesTestCase(BaseTestCase):
         self.sd.on_shares_to_others_changed_callback = lambda *a: cal.append(2)
 
         # they changed!
-        self.sd.shares_to_others = 'foo'
-        self.sd.shares_to_me = 'fakedata'  # what fake dbus will return
+        self.sd.shares_to_others = []
+        self.sd.shares_to_me = [self.sd.dbus.fake_share_data]
         self.sd.on_sd_shares_changed()
 
         # test
         self.assertEqual(cal, [2])
 
+    def _share(self, volume_id, node_id='node', **kwargs):
+        """Build a share."""
+        return self.sd.dbus.fake_share_data._replace(
+            volume_id=volume_id, node_id=node_id, **kwargs)
+
+    def _hook_shares_callbacks(self):
+        """Collect the shares sent to the frontend, failing on refresh."""
+        cal = []
+        self.sd.on_shares_to_me_changed_callback = (
+            lambda s: cal.append((SHARES_TO_ME, list(s))))
+        self.sd.on_shares_to_others_changed_callback = (
+            lambda s: cal.append((SHARES_TO_OTHERS, list(s))))
+
+        def fail():
+            """Patching must not ask for the shares."""
+            self.fail("Asked all the shares")
+
+        self.sd.dbus.get_shares_to_me = fail
+        self.sd.dbus.get_shares_to_others = fail
+        return cal
+
+    def test_share_changed_added(self):
+        """A new share is added to its side only."""
+        s1, s2 = self._share('v1'), self._share('v2')
+        self.sd.shares_to_me = [s1]
+        self.sd.shares_to_others = []
+        cal = self._hook_shares_callbacks()
+        self.sd.on_sd_share_changed(s2, SHARES_TO_ME)
+        self.assertEqual(cal, [(SHARES_TO_ME, [s1, s2])])
+        self.assertEqual(self.sd.shares_to_others, [])
+
+    def test_share_changed_updated(self):
+        """A changed share replaces the one with its volume and node."""
+        s1, s2 = self._share('v1'), self._share('v2')
+        self.sd.shares_to_others = [s1, s2]
+        cal = self._hook_shares_callbacks()
+        new_s1 = self._share('v1', accepted=False)
+        self.sd.on_sd_share_changed(new_s1, SHARES_TO_OTHERS)
+        self.assertEqual(cal, [(SHARES_TO_OTHERS, [new_s1, s2])])
+
+    def test_share_changed_same_data(self):
+        """A share that didn't really change is not sent again."""
+        s1 = self._share('v1')
+        self.sd.shares_to_me = [s1]
+        cal = self._hook_shares_callbacks()
+        self.sd.on_sd_share_changed(self._share('v1'), SHARES_TO_ME)
+        self.assertEqual(cal, [])
+
+    def test_share_changed_deleted(self):
+        """A deleted share is removed from the list."""
+        s1, s2, s3 = self._share('v1'), self._share('v2'), self._share('v3')
+        self.sd.shares_to_me = [s1, s2, s3]
+        cal = self._hook_shares_callbacks()
+        self.sd.on_sd_share_changed(s1, SHARES_TO_ME, deleted=True)
+        self.assertEqual(cal, [(SHARES_TO_ME, [s3, s2])])
+
+    def test_share_changed_deleted_unknown(self):
+        """A deleted share that is not in the list changes nothing."""
+        s1 = self._share('v1')
+        self.sd.shares_to_me = [s1]
+        cal = self._hook_shares_callbacks()
+        self.sd.on_sd_share_changed(self._share('v2'), SHARES_TO_ME,
+                                    deleted=True)
+        self.assertEqual(cal, [])
+        self.assertEqual(self.sd.shares_to_me, [s1])
+
+    def test_share_changed_without_list(self):
+        """If there is no list to patch yet, all the shares are asked."""
+        called = []
+        self.sd.shares_to_me = None
+        self.sd.on_sd_shares_changed = lambda: called.append(True)
+        self.sd.on_sd_share_changed(self._share('v1'), SHARES_TO_ME)
+        self.assertEqual(called, [True])
+
+    def test_share_versions(self):
+        """Each share has a version, bumped only when it changes."""
+        s1, s2 = self._share('v1'), self._share('v2')
+        index = self.sd._shares_indexes[SHARES_TO_ME]
+        self.sd._set_shares(SHARES_TO_ME, [s1, s2])
+        self.assertEqual(index.versions, {('v1', 'node'): 1,
+                                          ('v2', 'node'): 1})
+
+        new_s2 = self._share('v2', name='other')
+        self.sd._set_shares(SHARES_TO_ME, [s1, new_s2])
+        self.assertEqual(index.versions, {('v1', 'node'): 1,
+                                          ('v2', 'node'): 2})
+
+        self.sd.on_sd_share_changed(s1._replace(name='foo'), SHARES_TO_ME)
+        self.assertEqual(index.versions, {('v1', 'node'): 2,
+                                          ('v2', 'node'): 2})
+
+    def test_shares_changed_same_data(self):
+        """Asking all the shares again with no change sends nothing."""
+        cal = []
+        self.sd.on_shares_to_me_changed_callback = lambda *a: cal.append(1)
+        self.sd.on_shares_to_others_changed_callback = lambda *a: cal.append(2)
+        self.sd._set_shares(SHARES_TO_ME, [self.sd.dbus.fake_share_data])
+        self.sd._set_shares(SHARES_TO_OTHERS, [self.sd.dbus.fake_share_data])
+        self.sd.on_sd_shares_changed()
+        self.assertEqual(cal, [])
+
+    def test_shares_changed_removed(self):
+        """Asking all the shares again finds the removed ones."""
+        cal = []
+        self.sd.on_shares_to_me_changed_callback = lambda *a: cal.append(1)
+        self.sd.on_shares_to_others_changed_callback = lambda *a: cal.append(2)
+        fake = self.sd.dbus.fake_share_data
+        self.sd._set_shares(SHARES_TO_ME, [fake, self._share('v2')])
+        self.sd._set_shares(SHARES_TO_OTHERS, [fake])
+        self.sd.on_sd_shares_changed()
+        self.assertEqual(cal, [1])
+
 
 class PublicFilesTestCase(BaseTestCase):
     """PublicFiles checking."""
@@ -1327,14 +1865,21 @@ class PublicFilesTestCase(BaseTestCase):
     def test_initial_value(self):
         """Fill the public_files info initially."""
         called = []
-        self.sd.dbus.get_public_files = lambda: called.append(True)
+
+        def fake_get_public_files():
+            """Register the call."""
+            called.append(True)
+            return defer.succeed([])
+
+        self.sd.dbus.get_public_files = fake_get_public_files
         yield self.sd._get_initial_data()
         self.assertTrue(called)
 
     @defer.inlineCallbacks
     def test_initial_value_is_stored(self):
         """Fill the public_files info initially."""
-        data = object()
+        data = [PublicFilesData(volume='v', node='n2', path='p2',
+                                public_url='u2')]
         self.sd.dbus.get_public_files = lambda: defer.succeed(data)
         yield self.sd._get_initial_data()
         self.assertEqual(self.sd.public_files, data)
@@ -1367,6 +1912,82 @@ class PublicFilesTestCase(BaseTestCase):
 
         self.assertEqual(called, [[pf]])
 
+    def _pf(self, node, url='url'):
+        """Build a public file for the node."""
+        return PublicFilesData(volume='volume', node=node,
+                               path='path-' + node, public_url=url)
+
+    def _patch(self, pf, is_public):
+        """Patch the list with the change, which must not ask for it."""
+        self.sd.dbus.get_public_files = lambda: self.fail("Asked the list")
+        return self.sd.on_sd_public_files_changed(pf, is_public)
+
+    @defer.inlineCallbacks
+    def test_changed_file_published(self):
+        """A file published is added to the list."""
+        pf1, pf2 = self._pf('n1'), self._pf('n2')
+        self.sd.public_files = [pf1]
+        yield self._patch(pf2, True)
+        self.assertEqual(self.sd.public_files, [pf1, pf2])
+
+    @defer.inlineCallbacks
+    def test_changed_file_republished(self):
+        """A file published again replaces the one in the list."""
+        pf1, pf2 = self._pf('n1'), self._pf('n2')
+        self.sd.public_files = [pf1, pf2]
+        new_pf1 = self._pf('n1', url='other url')
+        yield self._patch(new_pf1, True)
+        self.assertEqual(self.sd.public_files, [new_pf1, pf2])
+
+    @defer.inlineCallbacks
+    def test_changed_file_unpublished(self):
+        """A file unpublished is removed from the list."""
+        pf1, pf2, pf3 = self._pf('n1'), self._pf('n2'), self._pf('n3')
+        self.sd.public_files = [pf1, pf2, pf3]
+        yield self._patch(pf1, False)
+        self.assertEqual(self.sd.public_files, [pf3, pf2])
+        yield self._patch(pf2, True)
+        self.assertEqual(self.sd.public_files, [pf3, pf2])
+
+    @defer.inlineCallbacks
+    def test_changed_file_unpublished_unknown(self):
+        """A file unpublished that is not in the list is ignored."""
+        pf1 = self._pf('n1')
+        self.sd.public_files = [pf1]
+        yield self._patch(self._pf('n2'), False)
+        self.assertEqual(self.sd.public_files, [pf1])
+
+    @defer.inlineCallbacks
+    def test_changed_file_calls_callback_with_change(self):
+        """Only the change is sent to the frontend."""
+        called = []
+        self.sd.on_public_file_changed_callback = lambda *a: called.append(a)
+        self.sd.on_public_files_changed_callback = lambda _: self.fail("All")
+        self.sd.public_files = []
+        pf = self._pf('n1')
+        yield self._patch(pf, True)
+        self.assertEqual(called, [(pf, True)])
+
+    @defer.inlineCallbacks
+    def test_changed_file_without_list(self):
+        """If there is no list to patch yet, all of it is asked."""
+        pf1, pf2 = self._pf('n1'), self._pf('n2')
+        self.sd.public_files = None
+        self.sd.dbus.get_public_files = lambda: defer.succeed([pf1, pf2])
+        yield self.sd.on_sd_public_files_changed(pf2, True)
+        self.assertEqual(self.sd.public_files, [pf1, pf2])
+
+    @defer.inlineCallbacks
+    def test_changed_file_after_list_replaced(self):
+        """The list asked again is patched by its new positions."""
+        pf1, pf2 = self._pf('n1'), self._pf('n2')
+        self.sd.public_files = [pf1, pf2]
+        yield self._patch(pf1, False)
+        self.sd.dbus.get_public_files = lambda: defer.succeed([pf1, pf2])
+        yield self.sd.on_sd_public_files_changed()
+        yield self._patch(pf1, False)
+        self.assertEqual(self.sd.public_files, [pf2])
+
     @defer.inlineCallbacks
     def test_change_public_access_ok(self):
         """Change public access ok."""
@@ -1609,20 +2230,122 @@ class TransferTestCase(BaseTestCase):
 
     def test_poller_instantiaton(self):
         """Get a poller at init time with correct config."""
-        self.assertEqual(self.sd.transfers_poller.interval,
-                         TRANSFER_POLL_INTERVAL)
-        self.assertEqual(self.sd.transfers_poller.callback,
-                         self.sd.get_current_transfers)
+        poller = self.sd.transfers_poller
+        self.assertEqual(poller.interval, TRANSFER_POLL_INTERVAL)
+        self.assertEqual(poller.callback, self.sd.get_current_transfers)
+        self.assertEqual(poller.min_interval, TRANSFER_POLL_MIN_INTERVAL)
+        self.assertEqual(poller.max_interval, TRANSFER_POLL_MAX_INTERVAL)
+        self.assertEqual(poller.backoff, TRANSFER_POLL_BACKOFF)
+        self.assertEqual(poller.jitter, TRANSFER_POLL_JITTER)
 
     @defer.inlineCallbacks
     def test_get_current_transfers(self):
         """Get current transfers from SD."""
         called = []
         self.sd.on_transfers_callback = lambda *a: called.extend(a)
-        self.sd.dbus.get_current_uploads = lambda: defer.succeed(list("up"))
-        self.sd.dbus.get_current_downloads = lambda: defer.succeed(list("dn"))
+        up = [Transfer('u', 1, 2), Transfer('p', 1, 2)]
+        dn = [Transfer('d', 1, 2), Transfer('n', 1, 2)]
+        self.sd.dbus.get_current_uploads = lambda: defer.succeed(up)
+        self.sd.dbus.get_current_downloads = lambda: defer.succeed(dn)
         yield self.sd.get_current_transfers()
-        self.assertEqual(called[0], ["u", "p", "d", "n"])
+        self.assertEqual(called[0], up + dn)
+
+    def _set_transfers(self, *transfers):
+        """Set the transfers that SD returns, all as uploads."""
+        self.sd.dbus.get_current_uploads = lambda: defer.succeed(
+            list(transfers))
+        self.sd.dbus.get_current_downloads = lambda: defer.succeed([])
+
+    @defer.inlineCallbacks
+    def test_get_current_transfers_progress(self):
+        """Polling is useful if the progress changed."""
+        self._set_transfers(Transfer('a', 1, 10))
+        active = yield self.sd.get_current_transfers()
+        self.assertTrue(active)
+        self._set_transfers(Transfer('a', 5, 10))
+        active = yield self.sd.get_current_transfers()
+        self.assertTrue(active)
+
+    @defer.inlineCallbacks
+    def test_get_current_transfers_no_progress(self):
+        """Polling is not useful if the progress didn't change."""
+        self._set_transfers(Transfer('a', 1, 10))
+        yield self.sd.get_current_transfers()
+        active = yield self.sd.get_current_transfers()
+        self.assertFalse(active)
+
+    @defer.inlineCallbacks
+    def test_get_current_transfers_all_signalled(self):
+        """Polling is not useful if all the transfers signalled."""
+        self._set_transfers(Transfer('a', 1, 10), Transfer('b', 1, 10))
+        yield self.sd.get_current_transfers()
+        self._set_transfers(Transfer('a', 5, 10), Transfer('b', 5, 10))
+        self.sd.on_sd_upload_progress(Transfer('a', 5, 10))
+        self.sd.on_sd_download_progress(Transfer('b', 5, 10))
+        active = yield self.sd.get_current_transfers()
+        self.assertFalse(active)
+
+    @defer.inlineCallbacks
+    def test_get_current_transfers_some_signalled(self):
+        """Polling is useful if some transfers didn't signal."""
+        self._set_transfers(Transfer('a', 1, 10), Transfer('b', 1, 10))
+        yield self.sd.get_current_transfers()
+        self._set_transfers(Transfer('a', 5, 10), Transfer('b', 5, 10))
+        self.sd.on_sd_upload_progress(Transfer('a', 5, 10))
+        active = yield self.sd.get_current_transfers()
+        self.assertTrue(active)
+
+    def test_get_current_transfers_concurrent(self):
+        """Uploads and downloads are requested at the same time."""
+        called = []
+        self.sd.dbus.get_current_uploads = \
+            lambda: called.append('up') or defer.Deferred()
+        self.sd.dbus.get_current_downloads = \
+            lambda: called.append('down') or defer.Deferred()
+        self.sd.get_current_transfers()
+        self.assertEqual(called, ['up', 'down'])
+
+    def test_get_current_transfers_single_flight(self):
+        """Calls while requesting share the same request and answer."""
+        requests = []
+        uploads = defer.Deferred()
+        self.sd.dbus.get_current_uploads = \
+            lambda: requests.append('up') or uploads
+        self.sd.dbus.get_current_downloads = lambda: defer.succeed([])
+        transfers = []
+        self.sd.on_transfers_callback = transfers.append
+        answers = []
+        for _ in range(3):
+            self.sd.get_current_transfers().addCallback(answers.append)
+        self.assertEqual(requests, ['up'])
+
+        uploads.callback([Transfer('a', 1, 10)])
+        self.assertEqual(answers, [True, True, True])
+        self.assertEqual(transfers, [[Transfer('a', 1, 10)]])
+
+    @defer.inlineCallbacks
+    def test_get_current_transfers_again_after_answer(self):
+        """After the answer, a new call requests again."""
+        requests = []
+        self.sd.dbus.get_current_uploads = \
+            lambda: requests.append('up') or defer.succeed([])
+        self.sd.dbus.get_current_downloads = lambda: defer.succeed([])
+        yield self.sd.get_current_transfers()
+        yield self.sd.get_current_transfers()
+        self.assertEqual(requests, ['up', 'up'])
+
+    def test_get_current_transfers_error(self):
+        """An error is given to all the waiting calls."""
+        uploads = defer.Deferred()
+        self.sd.dbus.get_current_uploads = lambda: uploads
+        self.sd.dbus.get_current_downloads = lambda: defer.succeed([])
+        errors = []
+        for _ in range(2):
+            self.sd.get_current_transfers().addErrback(errors.append)
+        uploads.errback(ValueError('foo'))
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(all(e.check(ValueError) for e in errors))
+        self.assertEqual(self.sd._transfers_waiting, [])
 
     @defer.inlineCallbacks
     def test_initial_data_set_poller(self):
@@ -1655,6 +2378,71 @@ class TransferTestCase(BaseTestCase):
         self.assertEqual(called, ['foo'])
 
 
+class DoneOpsRetentionTestCase(BaseTestCase):
+    """Tests for the retention of the done node ops."""
+
+    def test_poller_instantiaton(self):
+        """Get a poller at init time with correct config."""
+        self.assertEqual(self.sd.done_ops_poller.interval,
+                         DONE_OPS_PRUNE_INTERVAL)
+        self.assertEqual(self.sd.done_ops_poller.callback,
+                         self.sd._prune_done_ops)
+
+    def test_keep_all_by_default(self):
+        """No retention policy by default."""
+        self.assertEqual(self.sd.done_ops_max_age, None)
+        self.assertEqual(self.sd.done_ops_max_count, None)
+        self.assertFalse(self.sd.done_ops_poller._should_run)
+
+    def test_set_policy_runs_poller(self):
+        """Setting a policy starts the poller."""
+        called = []
+        self.sd.done_ops_poller.run = lambda v: called.append(v)
+        self.sd.set_done_ops_retention(max_age=60)
+        self.sd.set_done_ops_retention(max_count=10)
+        self.sd.set_done_ops_retention()
+        self.assertEqual(called, [True, True, False])
+        self.assertEqual(self.sd.done_ops_max_age, None)
+        self.assertEqual(self.sd.done_ops_max_count, None)
+
+    def test_prune_uses_policy(self):
+        """The queue content is pruned with the policy, bounded."""
+        called = []
+        self.sd.queue_content.prune = lambda **k: called.append(k) or 0
+        self.sd.set_done_ops_retention(max_age=60, max_count=10)
+        self.sd._prune_done_ops()
+        self.assertEqual(called, [dict(max_age=60, max_done=10,
+                                       limit=DONE_OPS_PRUNE_LIMIT)])
+
+    def test_prune_notifies(self):
+        """The GUI is told when something was pruned."""
+        self.sd.on_sd_queue_added('MakeFile', '12', {'path': '/a'})
+        self.sd.on_sd_queue_removed('MakeFile', '12', {'path': '/a'})
+        called = []
+        self.sd.on_node_ops_changed_callback = lambda *a, **k: called.append(
+            (a, k))
+        self.sd.set_done_ops_retention(max_count=0)
+        self.sd._prune_done_ops()
+        self.assertEqual(called, [((self.sd.queue_content.node_ops,),
+                                   dict(clear=True))])
+        self.assertTrue(self.hdlr.check_debug("Pruned 1 done nodes"))
+
+    def test_nothing_pruned_no_notification(self):
+        """The GUI is not bothered if nothing was pruned."""
+        called = []
+        self.sd.on_node_ops_changed_callback = lambda *a, **k: called.append(
+            (a, k))
+        self.sd.set_done_ops_retention(max_count=0)
+        self.sd._prune_done_ops()
+        self.assertEqual(called, [])
+
+    def test_shutdown_stops_poller(self):
+        """The poller is stopped on shutdown."""
+        self.sd.set_done_ops_retention(max_age=60)
+        self.sd.shutdown()
+        self.assertFalse(self.sd.done_ops_poller._should_run)
+
+
 class PollerTestCase(TwistedTestCase):
     """Tests for the Poller behaviour."""
 
@@ -1762,6 +2550,832 @@ class PollerTestCase(TwistedTestCase):
         return d
 
 
+class AdaptivePollerTestCase(TwistedTestCase):
+    """Tests for the AdaptivePoller behaviour."""
+
+    def setUp(self):
+        """Set up."""
+        self.active = True
+        self.poller = AdaptivePoller(4, lambda: defer.succeed(self.active),
+                                     1, 16, 2, .1)
+        self.addCleanup(self.poller.run, False)
+
+    @defer.inlineCallbacks
+    def test_shorten_on_activity(self):
+        """The interval is shortened while there's activity."""
+        yield self.poller._execute()
+        self.assertEqual(self.poller.interval, 2)
+        yield self.poller._execute()
+        yield self.poller._execute()
+        self.assertEqual(self.poller.interval, 1)
+
+    @defer.inlineCallbacks
+    def test_back_off_without_activity(self):
+        """The interval grows exponentially without activity."""
+        self.active = False
+        yield self.poller._execute()
+        self.assertEqual(self.poller.interval, 8)
+        yield self.poller._execute()
+        yield self.poller._execute()
+        self.assertEqual(self.poller.interval, 16)
+
+    def test_jitter(self):
+        """The delay is the interval with some jitter."""
+        delays = set(self.poller._get_delay() for _ in range(20))
+        self.assertTrue(len(delays) > 1)
+        self.assertTrue(all(3.6 <= d <= 4.4 for d in delays))
+
+    @defer.inlineCallbacks
+    def test_call_later_with_jitter(self):
+        """The next call is scheduled with the delay."""
+        self.poller._should_run = True
+        self.poller._get_delay = lambda: 42
+        yield self.poller._execute()
+        self.assertAlmostEqual(self.poller._call.getTime() - reactor.seconds(),
+                               42, places=1)
+
+    def test_restart_from_start_interval(self):
+        """Starting the poller again resets the interval."""
+        self.poller.run(True)
+        self.poller.interval = 16
+        self.poller.run(True)
+        self.assertEqual(self.poller.interval, 16)
+        self.poller.run(False)
+        self.poller.run(True)
+        self.assertEqual(self.poller.interval, 4)
+
+
+class CoalescerTestCase(TwistedTestCase):
+    """Tests for the Coalescer behaviour."""
+
+    def setUp(self):
+        """Set up."""
+        self.clock = task.Clock()
+        self.patch(syncdaemon, 'reactor', self.clock)
+        self.called = []
+        self.coalescer = Coalescer(1, 5, lambda: self.called.append(
+            self.clock.seconds()))
+
+    def test_first_right_away(self):
+        """The first signal is notified right away."""
+        self.coalescer.signal()
+        self.assertEqual(self.called, [0])
+
+    def test_burst_together(self):
+        """The signals after the first are notified together."""
+        self.coalescer.signal()
+        for _ in range(10):
+            self.clock.advance(.1)
+            self.coalescer.signal()
+        self.assertEqual(len(self.called), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.called, [0, 2])
+
+    def test_quiet_goes_idle(self):
+        """Without more signals, the next one is notified right away."""
+        self.coalescer.signal()
+        self.clock.advance(1)
+        self.assertEqual(self.coalescer._state, syncdaemon.ASKING_IDLE)
+        self.clock.advance(3)
+        self.coalescer.signal()
+        self.assertEqual(self.called, [0, 4])
+
+    def test_ceiling(self):
+        """A continuous burst is notified at least every ceiling."""
+        self.coalescer.signal()
+        for _ in range(70):
+            self.clock.advance(.1)
+            self.coalescer.signal()
+        # the first at 0, then the ones from 0.1 are held up to 5.1
+        self.assertEqual(len(self.called), 2)
+        self.assertTrue(5.1 <= round(self.called[1], 3) <= 5.2)
+
+    def test_window_zero(self):
+        """All the signals are notified right away without window."""
+        self.coalescer.window = 0
+        for _ in range(3):
+            self.coalescer.signal()
+        self.assertEqual(self.called, [0, 0, 0])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_stop(self):
+        """Stopping drops what was gathered."""
+        self.coalescer.signal()
+        self.coalescer.signal()
+        self.coalescer.stop()
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.coalescer.signal()
+        self.assertEqual(self.called, [0, 0])
+
+
+class TimeoutsTestCase(BaseTestCase):
+    """Tests for going on when the calls to syncdaemon time out."""
+
+    def _time_out(self, method_name):
+        """Make the dbus method time out."""
+        error = CallTimeoutError(method_name, 10)
+        setattr(self.sd.dbus, method_name, lambda *a: defer.fail(error))
+
+    def test_actions(self):
+        """The actions don't fail, so the user can go on."""
+        for action in ('start', 'quit', 'connect', 'disconnect'):
+            self._time_out(action)
+            d = getattr(self.sd, action)()
+            self.assertEqual(self.successResultOf(d), None)
+        self.assertTrue(self.hdlr.check_warning("Connecting u1.SD unanswered"))
+
+    def test_actions_other_errors(self):
+        """The actions still fail with other errors."""
+        self.patch(self.sd.dbus, 'connect',
+                   lambda: defer.fail(ValueError('foo')))
+        self.failureResultOf(self.sd.connect(), ValueError)
+
+    @defer.inlineCallbacks
+    def test_initial_dataset(self):
+        """An initial dataset that times out doesn't stop the rest."""
+        called = []
+        for name in ('status', 'queue', 'folders', 'shares',
+                     'initial_data', 'initial_online_data'):
+            setattr(self.sd, 'on_%s_ready_callback' % name,
+                    lambda name=name: called.append(name))
+        self._time_out('get_status')
+        yield self.sd._get_initial_data()
+        self.assertEqual(called, ['queue', 'folders', 'shares',
+                                  'initial_data', 'initial_online_data'])
+        self.assertEqual(self.sd.initial_data_unavailable, set(['status']))
+        self.assertTrue(self.hdlr.check_warning("Initial status data",
+                                                "unavailable"))
+
+    @defer.inlineCallbacks
+    def test_initial_dataset_part(self):
+        """A dataset is not ready if any of its parts timed out."""
+        called = []
+        self.sd.on_shares_ready_callback = lambda: called.append(True)
+        self._time_out('get_shares_to_others')
+        yield self.sd._get_initial_data()
+        self.assertEqual(called, [])
+        self.assertEqual(self.sd.initial_data_unavailable, set(['shares']))
+
+    @defer.inlineCallbacks
+    def test_initial_online_data(self):
+        """The online data is not ready if it timed out."""
+        called = []
+        self.sd.on_initial_online_data_ready_callback = (
+            lambda: called.append(True))
+        self._time_out('get_public_files')
+        yield self.sd._get_initial_data()
+        self.assertEqual(called, [])
+        self.assertEqual(self.sd.initial_data_unavailable,
+                         set(['public_files']))
+
+    @defer.inlineCallbacks
+    def test_initial_data_unavailable_reset(self):
+        """The datasets that timed out are forgotten when asked again."""
+        self.sd.initial_data_unavailable.add('status')
+        yield self.sd._get_initial_data()
+        self.assertEqual(self.sd.initial_data_unavailable, set())
+
+    @defer.inlineCallbacks
+    def test_metadata(self):
+        """The metadata that timed out is unavailable for the user."""
+        called = []
+        self.sd.on_metadata_ready_callback = lambda *a: called.append(a)
+        self._time_out('get_metadata')
+        yield self.sd.get_metadata('path')
+        self.assertEqual(called, [('path', METADATA_UNAVAILABLE)])
+        self.assertEqual(len(self.sd.metadata_cache), 0)
+        self.assertTrue(self.hdlr.check_warning("Getting metadata for",
+                                                "didn't finish"))
+
+    @defer.inlineCallbacks
+    def test_folder_operation(self):
+        """A folder operation that timed out is an error for the user."""
+        called = []
+        self.sd.on_folder_op_error_callback = called.append
+        self._time_out('create_folder')
+        yield self.sd.create_folder('path')
+        self.assertEqual(len(called), 1)
+        self.assertTrue(isinstance(called[0], CallTimeoutError))
+
+    def test_share_operation(self):
+        """A share operation that timed out is an error for the user."""
+        called = []
+        self.sd.on_share_op_error_callback = lambda *a: called.append(a)
+        self._time_out('accept_share')
+        self.sd.accept_share('share_id')
+        self.assertEqual(len(called), 1)
+        share_id, error = called[0]
+        self.assertEqual(share_id, 'share_id')
+        self.assertTrue(isinstance(error, CallTimeoutError))
+        self.assertFalse(self.hdlr.check_error("Unexpected error"))
+
+    def test_share_invitation(self):
+        """A share invitation that timed out is not unexpected."""
+        self._time_out('send_share_invitation')
+        self.sd.send_share_invitation('path', 'mail', 'name', 'View')
+        self.assertTrue(self.hdlr.check_info(
+            "Sending share invitation unanswered", "didn't finish"))
+        self.assertFalse(self.hdlr.check_error("Unexpected error"))
+
+    @defer.inlineCallbacks
+    def test_change_public_access(self):
+        """Changing the public access that timed out is an error too."""
+        called = []
+        self.sd.on_public_op_error_callback = called.append
+        self._time_out('change_public_access')
+        yield self.sd.change_public_access('path', True)
+        self.assertEqual(len(called), 1)
+        self.assertTrue(isinstance(called[0], CallTimeoutError))
+
+
+class CircuitTestCase(BaseTestCase):
+    """Tests for going on while the circuit to syncdaemon is open."""
+
+    def _open(self, method_name):
+        """Make the dbus method fail as the circuit is open."""
+        error = CircuitOpenError(method_name)
+        setattr(self.sd.dbus, method_name, lambda *a: defer.fail(error))
+
+    def test_state_default(self):
+        """The circuit is closed at first."""
+        self.assertEqual(self.sd.current_state.circuit, CIRCUIT_CLOSED)
+
+    def test_circuit_changed(self):
+        """The circuit state is stored, and the frontend is told."""
+        called = []
+        self.sd.on_circuit_changed_callback = called.append
+        self.sd.on_sd_circuit_changed(CIRCUIT_OPEN)
+        self.assertEqual(self.sd.current_state.circuit, CIRCUIT_OPEN)
+        self.assertEqual(called, [CIRCUIT_OPEN])
+        self.assertTrue(self.hdlr.check_info("SD circuit changed to",
+                                             CIRCUIT_OPEN))
+
+    def test_actions(self):
+        """The actions don't fail, so the user can go on."""
+        self._open('connect')
+        self.assertEqual(self.successResultOf(self.sd.connect()), None)
+        self.assertTrue(self.hdlr.check_warning("Connecting u1.SD unanswered",
+                                                "not answering"))
+
+    @defer.inlineCallbacks
+    def test_metadata(self):
+        """The metadata not asked is unavailable for the user."""
+        called = []
+        self.sd.on_metadata_ready_callback = lambda *a: called.append(a)
+        self._open('get_metadata')
+        yield self.sd.get_metadata('path')
+        self.assertEqual(called, [('path', METADATA_UNAVAILABLE)])
+        self.assertTrue(self.hdlr.check_warning("Getting metadata for",
+                                                "not answering"))
+
+    def test_transfers(self):
+        """The transfers not asked are not activity, the poller goes on."""
+        called = []
+        self.sd.on_transfers_callback = called.append
+        self._open('get_current_uploads')
+        self.sd.dbus.get_current_downloads = lambda: defer.succeed([])
+        d = self.sd.get_current_transfers()
+        self.assertEqual(self.successResultOf(d), False)
+        self.assertEqual(called, [])
+        self.assertTrue(self.hdlr.check_warning("Getting the transfers"))
+
+    @defer.inlineCallbacks
+    def test_initial_dataset(self):
+        """An initial dataset not asked doesn't stop the rest."""
+        called = []
+        self.sd.on_initial_data_ready_callback = lambda: called.append(True)
+        self._open('get_folders')
+        yield self.sd._get_initial_data()
+        self.assertEqual(called, [True])
+        self.assertEqual(self.sd.initial_data_unavailable, set(['folders']))
+
+
+class UnavailableDataTestCase(BaseTestCase):
+    """Tests for asking again for the data that SD didn't answer."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        """Set up."""
+        super(UnavailableDataTestCase, self).setUp()
+        self.ready = []
+        for name in ('status', 'queue', 'folders', 'shares',
+                     'initial_online_data'):
+            setattr(self.sd, 'on_%s_ready_callback' % name,
+                    lambda name=name: self.ready.append(name))
+        error = CallTimeoutError('get_folders', 10)
+        self.sd.dbus.get_folders = lambda: defer.fail(error)
+        self.sd.dbus.get_public_files = lambda: defer.fail(error)
+        yield self.sd._get_initial_data()
+        self.assertEqual(self.sd.initial_data_unavailable,
+                         set(['folders', 'public_files']))
+        self.ready = []
+
+    def _answer(self):
+        """Make SD answer again."""
+        del self.sd.dbus.get_folders
+        del self.sd.dbus.get_public_files
+
+    def test_circuit_closed(self):
+        """The data is asked again when the circuit closes."""
+        self._answer()
+        self.sd.on_sd_circuit_changed(CIRCUIT_CLOSED)
+        self.assertEqual(self.ready, ['folders', 'initial_online_data'])
+        self.assertEqual(self.sd.initial_data_unavailable, set())
+        self.assertEqual(self.sd.folders, 'fakedata')
+        self.assertTrue(self.hdlr.check_info("Asking again for the initial "
+                                             "folders data"))
+
+    def test_circuit_opened(self):
+        """Nothing is asked when the circuit opens."""
+        self._answer()
+        self.sd.on_sd_circuit_changed(CIRCUIT_OPEN)
+        self.assertEqual(self.ready, [])
+
+    def test_status_changed(self):
+        """The data is asked again when SD sends its status."""
+        self._answer()
+        self.sd.on_sd_status_changed('name', 'description', False, True,
+                                     False, 'queues', 'connection')
+        self.assertEqual(self.ready, ['folders', 'initial_online_data'])
+
+    def test_still_unavailable(self):
+        """The data not answered again is kept for the next time."""
+        del self.sd.dbus.get_public_files
+        self.sd.on_sd_circuit_changed(CIRCUIT_CLOSED)
+        self.assertEqual(self.ready, ['initial_online_data'])
+        self.assertEqual(self.sd.initial_data_unavailable, set(['folders']))
+        self.assertTrue(self.hdlr.check_warning("Initial folders data still "
+                                                "unavailable"))
+
+    def test_not_while_getting_initial_data(self):
+        """Nothing is asked again while getting the initial data."""
+        self._answer()
+        self.sd._initial_data_lock.acquire()
+        self.sd.on_sd_circuit_changed(CIRCUIT_CLOSED)
+        self.assertEqual(self.ready, [])
+
+    def test_initial_data_waits(self):
+        """The initial data is got after the asking again finishes."""
+        folders = defer.Deferred()
+        self.sd.dbus.get_folders = lambda: folders
+        self.sd.on_sd_circuit_changed(CIRCUIT_CLOSED)
+        d = self.sd._get_initial_data()
+        self.assertNoResult(d)
+        self.assertEqual(self.ready, [])
+
+        del self.sd.dbus.get_folders
+        del self.sd.dbus.get_public_files
+        folders.callback('fakedata')
+        self.successResultOf(d)
+        self.assertEqual(self.ready[:2], ['folders', 'initial_online_data'])
+        self.assertIn('status', self.ready[2:])
+        self.assertEqual(self.sd.initial_data_unavailable, set())
+
+    def test_queue_asked_again(self):
+        """The ops signaled meanwhile are not duplicated by the queue."""
+        self.sd.initial_data_unavailable.add('queue')
+        op_info = ('Upload', '1', {'path': os.path.join(user.home, 'foo')})
+        self.sd.on_sd_queue_added(*op_info)
+        self.sd.dbus.get_queue_content = lambda: defer.succeed([op_info])
+        self.sd.on_sd_circuit_changed(CIRCUIT_CLOSED)
+        self.assertIn('queue', self.ready)
+
+        self.sd.on_sd_queue_removed(*op_info)
+        node = self.sd.queue_content._node_index['/foo']
+        self.assertTrue(node.done)
+
+
+class MetadataCacheTestCase(TwistedTestCase):
+    """Tests for the MetadataCache behaviour."""
+
+    def setUp(self):
+        """Set up."""
+        self.clock = task.Clock()
+        self.patch(syncdaemon, 'reactor', self.clock)
+        self.cache = MetadataCache(size=3)
+
+    def test_get_put(self):
+        """The stored metadata is returned, the rest is None."""
+        self.cache.put('/a', 'foo')
+        self.assertEqual(self.cache.get('/a'), 'foo')
+        self.assertEqual(self.cache.get('/b'), None)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hit_rate, .5)
+
+    def test_hit_rate_empty(self):
+        """Without lookups there's no hit rate."""
+        self.assertEqual(self.cache.hit_rate, 0)
+
+    def test_bounded(self):
+        """The least recently used entry is dropped."""
+        for path in ('/a', '/b', '/c'):
+            self.cache.put(path, path)
+        self.cache.get('/a')
+        self.cache.put('/d', '/d')
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get('/b'), None)
+        self.assertEqual(self.cache.get('/a'), '/a')
+
+    def test_ttl(self):
+        """With a TTL the entries are forgotten after a while."""
+        self.cache.ttl = 10
+        self.cache.put('/a', 'foo')
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get('/a'), 'foo')
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get('/a'), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_no_ttl(self):
+        """Without TTL the entries are kept."""
+        self.cache.put('/a', 'foo')
+        self.clock.advance(100000)
+        self.assertEqual(self.cache.get('/a'), 'foo')
+
+    def test_invalidate(self):
+        """The path, all above and all below it are forgotten."""
+        self.cache.size = 10
+        for path in ('/a', '/a/b', '/a/b/c/d', '/a/bc', '/x'):
+            self.cache.put(path, path)
+        self.cache.invalidate('/a/b/')
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get('/a/bc'), '/a/bc')
+        self.assertEqual(self.cache.get('/x'), '/x')
+
+    def test_invalidate_root(self):
+        """Invalidating the root forgets everything."""
+        for path in ('/', '/a', '/b/c'):
+            self.cache.put(path, path)
+        self.cache.invalidate('/')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_index_follows_entries(self):
+        """The paths forgotten in any way are not indexed anymore."""
+        self.cache.ttl = 10
+        for path in ('/a/b', '/a/c', '/d/e'):
+            self.cache.put(path, path)
+        self.cache.put('/f', '/f')
+        self.cache.invalidate('/a/c')
+        self.clock.advance(10)
+        self.cache.get('/d/e')
+        self.cache.get('/f')
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache._below, {})
+
+    def test_clear(self):
+        """All is forgotten."""
+        self.cache.put('/a/b', 'foo')
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache._below, {})
+
+    def test_answered_fresh(self):
+        """What was asked can be stored if nothing related was forgotten."""
+        self.cache.asking('/a/b')
+        self.cache.invalidate('/a/bc')
+        self.cache.invalidate('/x')
+        self.assertTrue(self.cache.answered('/a/b'))
+
+    def test_answered_stale(self):
+        """What was asked is not stored if a related path was forgotten."""
+        for touched in ('/a/b', '/a', '/a/b/c'):
+            self.cache.asking('/a/b')
+            self.cache.invalidate(touched)
+            self.assertFalse(self.cache.answered('/a/b'))
+            self.cache.asking('/a/b')
+            self.assertTrue(self.cache.answered('/a/b'))
+
+    def test_answered_stale_cleared(self):
+        """What was asked is not stored if all was forgotten."""
+        self.cache.asking('/a')
+        self.cache.clear()
+        self.assertFalse(self.cache.answered('/a'))
+
+
+class RefresherTestCase(TwistedTestCase):
+    """Tests for the Refresher behaviour."""
+
+    def setUp(self):
+        """Set up."""
+        self.clock = task.Clock()
+        self.patch(syncdaemon, 'reactor', self.clock)
+        self.running = []
+        self.starts = []
+        self.refresher = Refresher(1, self._refresh)
+
+    def _refresh(self):
+        """Start a refresh that the test finishes."""
+        d = defer.Deferred()
+        self.running.append((self.clock.seconds(), d))
+        self.starts.append(self.clock.seconds())
+        return d
+
+    def _finish(self, result=None):
+        """Finish the oldest running refresh."""
+        _, d = self.running.pop(0)
+        d.callback(result)
+
+    def test_first_right_away(self):
+        """A refresh starts right away if nothing is running."""
+        self.refresher.refresh()
+        self.assertEqual([t for t, _ in self.running], [0])
+
+    def test_result(self):
+        """The deferred is fired when the refresh finishes."""
+        d = self.refresher.refresh()
+        self.assertFalse(d.called)
+        self._finish('data')
+        self.assertEqual(self.successResultOf(d), 'data')
+
+    def test_one_running(self):
+        """The refreshes asked while one runs are done by only one."""
+        first = self.refresher.refresh()
+        others = [self.refresher.refresh() for _ in range(5)]
+        self.assertEqual(len(self.running), 1)
+
+        self._finish('old')
+        self.assertEqual(self.successResultOf(first), 'old')
+        self.assertEqual(len(self.running), 0)
+
+        self.clock.advance(1)
+        self.assertEqual([t for t, _ in self.running], [1])
+        self._finish('new')
+        for d in others:
+            self.assertEqual(self.successResultOf(d), 'new')
+
+    def test_pending_after_window(self):
+        """A slow refresh is followed by the pending one right away."""
+        self.refresher.refresh()
+        self.refresher.refresh()
+        self.clock.advance(3)
+        self._finish()
+        self.assertEqual([t for t, _ in self.running], [3])
+
+    def test_never_overlap(self):
+        """The refreshes asked meanwhile wait for the running one."""
+        self.refresher.refresh()
+        self.refresher.refresh()
+        self.clock.advance(5)
+        self.refresher.refresh()
+        self.assertEqual(len(self.running), 1)
+
+    def test_error(self):
+        """An error is given to the ones waiting for the refresh."""
+        d = self.refresher.refresh()
+        self.running.pop()[1].errback(ValueError('foo'))
+        self.failureResultOf(d, ValueError)
+
+    def test_stop(self):
+        """Stopping drops the pending refresh."""
+        self.refresher.refresh()
+        self.refresher.refresh()
+        self._finish()
+        self.refresher.stop()
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.clock.advance(1)
+        self.assertEqual(self.running, [])
+
+    def test_window_when_idle(self):
+        """A refresh asked when idle also waits for the window."""
+        self.refresher.refresh()
+        self._finish()
+        self.clock.advance(.3)
+        d = self.refresher.refresh()
+        self.assertEqual(self.running, [])
+        self.clock.advance(.7)
+        self.assertEqual([t for t, _ in self.running], [1])
+        self._finish('data')
+        self.assertEqual(self.successResultOf(d), 'data')
+
+    def test_spaced_signals(self):
+        """Refreshes asked just after each one finishes are capped."""
+        for _ in range(20):
+            self.refresher.refresh()
+            if self.running:
+                self._finish()
+            self.clock.advance(.05)
+        self.clock.advance(1)
+        if self.running:
+            self._finish()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 0)
+        # a second of signals, one refresh each window
+        self.assertEqual(len(self.starts), 2)
+
+    def test_stop_idle_wait(self):
+        """Stopping drops the refresh waiting for the window."""
+        self.refresher.refresh()
+        self._finish()
+        self.refresher.refresh()
+        self.refresher.stop()
+        self.assertFalse(self.clock.getDelayedCalls())
+
+
+class RefreshingTestCase(BaseTestCase):
+    """Tests for the refresh of the datasets from SyncDaemon."""
+
+    refresh_window = REFRESH_WINDOW
+
+    def setUp(self):
+        """Set up."""
+        self.clock = task.Clock()
+        self.patch(syncdaemon, 'reactor', self.clock)
+        super(RefreshingTestCase, self).setUp()
+        # let the window of the initial refreshes pass
+        self.clock.advance(REFRESH_WINDOW)
+        self.asked = []
+
+        def get_folders():
+            """Ask for the folders, the test answers."""
+            d = defer.Deferred()
+            self.asked.append(d)
+            return d
+
+        self.sd.dbus.get_folders = get_folders
+
+    def test_storm_one_in_flight(self):
+        """A storm of signals is answered by two refreshes."""
+        for _ in range(10):
+            self.sd.on_sd_folders_changed()
+        self.assertEqual(len(self.asked), 1)
+        self.asked.pop().callback(['old'])
+        self.clock.advance(REFRESH_WINDOW)
+        self.assertEqual(len(self.asked), 1)
+        self.asked.pop().callback(['new'])
+        self.clock.advance(REFRESH_WINDOW)
+        self.assertEqual(self.asked, [])
+        self.assertEqual(self.sd.folders, ['new'])
+
+    def test_newest_wins(self):
+        """A newer refresh is not started until the older one finished."""
+        self.sd.on_sd_folders_changed()
+        d = self.sd.on_sd_folders_changed()
+        self.clock.advance(REFRESH_WINDOW * 5)
+        self.assertEqual(len(self.asked), 1)
+        self.asked.pop().callback(['old'])
+        self.asked.pop().callback(['new'])
+        self.assertTrue(d.called)
+        self.assertEqual(self.sd.folders, ['new'])
+
+    def test_folder_operation_refresh(self):
+        """The folders got after a folder operation are not overlapped."""
+        self.sd.on_sd_folders_changed()
+        result = FolderData(node='n', path='p', subscribed=True, volume='v',
+                            suggested_path='p')
+        self.sd.dbus.create_folder = lambda path: defer.succeed(result)
+        self.sd.create_folder('p')
+        self.assertEqual(len(self.asked), 1)
+        self.asked.pop().callback(['old'])
+        self.clock.advance(REFRESH_WINDOW)
+        self.asked.pop().callback(['new'])
+        self.assertEqual(self.sd.folders, ['new'])
+
+    def test_shares_sides(self):
+        """Each side of the shares is refreshed on its own."""
+        asked = []
+
+        def fake_get_shares(side):
+            """Register the call."""
+            asked.append(side)
+            return defer.succeed([])
+
+        self.sd.dbus.get_shares_to_me = lambda: fake_get_shares('me')
+        self.sd.dbus.get_shares_to_others = lambda: fake_get_shares('others')
+        self.sd.on_sd_shares_changed()
+        self.assertEqual(asked, ['me', 'others'])
+
+    def test_stopped_on_shutdown(self):
+        """The pending refreshes are dropped on shutdown."""
+        self.sd.on_sd_folders_changed()
+        self.sd.on_sd_folders_changed()
+        self.asked.pop().callback(['old'])
+        self.sd.shutdown()
+        self.clock.advance(REFRESH_WINDOW)
+        self.assertEqual(self.asked, [])
+
+    def _folder(self, volume):
+        """Build a folder."""
+        return FolderData(node='n', path='p' + volume, subscribed=True,
+                          volume=volume, suggested_path='p')
+
+    def test_folder_patched_while_refreshing(self):
+        """A folder signalled during a refresh is not lost."""
+        v1, v2 = self._folder('v1'), self._folder('v2')
+        self.sd._set_folders([v1])
+        self.sd.on_sd_folders_changed()
+        self.sd.on_sd_folder_changed(v2)
+        self.asked.pop().callback([v1])
+        self.assertEqual(self.sd.folders, [v1, v2])
+
+    def test_folder_deleted_while_refreshing(self):
+        """A folder deleted during a refresh is not back."""
+        v1, v2 = self._folder('v1'), self._folder('v2')
+        self.sd._set_folders([v1, v2])
+        self.sd.on_sd_folders_changed()
+        self.sd.on_sd_folder_deleted(v2)
+        self.asked.pop().callback([v1, v2])
+        self.assertEqual(self.sd.folders, [v1])
+
+    def test_folder_patched_before_refreshing(self):
+        """The patches done before a refresh are not done again."""
+        v1, v2 = self._folder('v1'), self._folder('v2')
+        self.sd._set_folders([v1])
+        self.sd.on_sd_folders_changed()
+        self.asked.pop().callback([v1])
+        self.sd.on_sd_folder_changed(v2)
+        self.clock.advance(REFRESH_WINDOW)
+        self.sd.on_sd_folders_changed()
+        self.asked.pop().callback([v1])
+        self.assertEqual(self.sd.folders, [v1])
+
+    def test_public_file_patched_while_refreshing(self):
+        """A public file signalled during a refresh is not lost."""
+        asked = defer.Deferred()
+        self.sd.dbus.get_public_files = lambda: asked
+        pf1 = PublicFilesData(volume='v', node='n1', path='p1',
+                              public_url='u1')
+        pf2 = PublicFilesData(volume='v', node='n2', path='p2',
+                              public_url='u2')
+        called = []
+        self.sd.on_public_files_changed_callback = called.append
+        self.sd.public_files = [pf1]
+        self.sd.on_sd_public_files_changed()
+        self.sd.on_sd_public_files_changed(pf2, is_public=True)
+        self.sd.on_sd_public_files_changed(pf1, is_public=False)
+        asked.callback([pf1])
+        self.assertEqual(self.sd.public_files, [pf2])
+        self.assertEqual(called, [[pf2]])
+
+    def test_share_patched_while_refreshing(self):
+        """A share signalled during a refresh is not lost."""
+        asked = defer.Deferred()
+        self.sd.dbus.get_shares_to_me = lambda: asked
+        old = FakeDBusInterface.fake_share_data
+        new = old._replace(node_id='other')
+        called = []
+        self.sd.on_shares_to_me_changed_callback = called.append
+        self.sd.shares_to_me = [old]
+        self.sd._refreshers['shares_' + SHARES_TO_ME].refresh()
+        self.sd.on_sd_share_changed(new, SHARES_TO_ME)
+        asked.callback([old])
+        self.assertEqual(self.sd.shares_to_me, [old, new])
+        self.assertEqual(called[-1], [old, new])
+
+
+class QueueCoalescingTestCase(BaseTestCase):
+    """Tests for the gathering of the queue signals."""
+
+    def setUp(self):
+        """Set up."""
+        super(QueueCoalescingTestCase, self).setUp()
+        self.clock = task.Clock()
+        self.patch(syncdaemon, 'reactor', self.clock)
+        self.node_called = []
+        self.internal_called = []
+        self.sd.on_node_ops_changed_callback = self.node_called.append
+        self.sd.on_internal_ops_changed_callback = self.internal_called.append
+
+    def test_coalescer_instantiation(self):
+        """Get a coalescer at init time with correct config."""
+        coalescer = self.sd.queue_coalescer
+        self.assertEqual(coalescer.window, syncdaemon.QUEUE_SIGNALS_WINDOW)
+        self.assertEqual(coalescer.ceiling, syncdaemon.QUEUE_SIGNALS_CEILING)
+        self.assertEqual(coalescer.callback, self.sd._send_queue_changed)
+
+    def test_burst(self):
+        """A burst of queue signals is notified once after the first."""
+        for i in range(100):
+            self.sd.on_sd_queue_added('MakeFile', str(i), {'path': '/a%d' % i})
+        self.assertEqual(len(self.node_called), 1)
+        self.clock.advance(syncdaemon.QUEUE_SIGNALS_WINDOW)
+        self.assertEqual(len(self.node_called), 2)
+        self.assertEqual(self.internal_called, [])
+
+    def test_only_what_changed(self):
+        """Only the callbacks of what changed are called."""
+        self.sd.on_sd_queue_added('MakeFile', '1', {'path': '/a'})
+        self.sd.on_sd_queue_added('GetDelta', '2', {})
+        self.clock.advance(syncdaemon.QUEUE_SIGNALS_WINDOW)
+        self.assertEqual(len(self.node_called), 1)
+        self.assertEqual(len(self.internal_called), 1)
+
+    def test_poller_run_once(self):
+        """The transfers poller is set once for the burst."""
+        called = []
+        self.sd.transfers_poller.run = called.append
+        for i in range(10):
+            self.sd.on_sd_queue_added('Upload', str(i), {'path': '/a%d' % i})
+        self.clock.advance(syncdaemon.QUEUE_SIGNALS_WINDOW)
+        self.assertEqual(called, [True, True])
+
+    def test_shutdown(self):
+        """The gathered signals are dropped on shutdown."""
+        self.sd.on_sd_queue_added('MakeFile', '1', {'path': '/a'})
+        self.sd.on_sd_queue_added('MakeFile', '2', {'path': '/b'})
+        self.sd.shutdown()
+        self.assertFalse(self.clock.getDelayedCalls())
+
+
 class SimpleCallsTestCase(BaseTestCase):
     """Some simple calls."""
 